@@ -0,0 +1,437 @@
+#!/usr/bin/python3
+'''Iperf self benchmarks'''
+
+# pyiperf, Copyright (c) 2023 RedHat Inc
+# pyiperf, Copyright (c) 2023 Cambridge Greys Ltd
+
+# This source code is licensed under both the BSD-style license (found in the
+# LICENSE file in the root directory of this source tree) and the GPLv2 (found
+# in the COPYING file in the root directory of this source tree).
+# You may select, at your option, one of the above-listed licenses.
+
+from argparse import ArgumentParser
+import copy
+import itertools
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import psutil
+from iperf_control import TestClient
+from iperf_control_server import TestServer
+from iperf_output import VERSION
+from iperf_utils import free_threaded
+
+DEFAULT_CONFIG = "config-stock.json"
+DEFAULT_PARAMS = "params.json"
+DEFAULT_PORT = 5299
+BASELINE_FORMAT = 1
+
+# Sweep axes, each case is one combination
+DEFAULT_MATRIX = {"protocol": ["tcp", "udp"],
+                  "len": {"tcp": [131072, 16384], "udp": [1400, 32768]},
+                  "parallel": [1, 4],
+                  "reverse": [False]}
+
+# Metrics where a higher value is better, all others are costs
+HIGHER_IS_BETTER = ["gbps", "pps"]
+# Minimum change in percent reported as a regression regardless of noise
+DEFAULT_THRESHOLD = 5.0
+# Stream counts for the stream setup benchmark
+SETUP_STREAMS = [1, 8, 64, 256, 512]
+# Stream counts for the thread scaling benchmark
+SCALING_STREAMS = [1, 2, 4, 8]
+
+def run_pair(config, params):
+    '''Run one test over loopback with server and client in this process'''
+    server = TestServer(copy.deepcopy(config), copy.deepcopy(params))
+    server.needs_display = False
+    server.listen()
+    worker = threading.Thread(target=server.run, name="server")
+    worker.start()
+    client = TestClient(copy.deepcopy(config), copy.deepcopy(params))
+    client.needs_display = False
+    client.run()
+    worker.join()
+    return (client, server)
+
+def setup_latency(config, params):
+    '''Measure connect-to-first-byte and last-byte-to-results latency'''
+    (client, server) = run_pair(config, params)
+    last_byte = max([stream.start_time + stream.result["end_time"] for stream in client.tx_streams])
+    return {"connect_to_first_byte": server.timestamps["first_data"] - client.timestamps["connect"],
+            "last_byte_to_results": client.timestamps["results"] - last_byte}
+
+def cases(matrix):
+    '''Expand a sweep matrix into test cases'''
+    result = []
+    for proto in matrix["protocol"]:
+        lengths = matrix["len"]
+        if isinstance(lengths, dict):
+            lengths = lengths[proto]
+        for (length, parallel, reverse) in itertools.product(lengths, matrix["parallel"],
+                                                             matrix["reverse"]):
+            result.append({"protocol": proto, "len": length, "parallel": parallel,
+                           "reverse": reverse})
+    return result
+
+def case_name(case):
+    '''Stable key for a case in the baseline file'''
+    name = "{}-len{}-P{}".format(case["protocol"], case["len"], case["parallel"])
+    if case["reverse"]:
+        name = name + "-R"
+    return name
+
+def case_params(params, case, duration):
+    '''Test params for a case'''
+    test_params = copy.deepcopy(params)
+    test_params.pop("tcp", None)
+    test_params.pop("udp", None)
+    test_params.pop("reverse", None)
+    test_params[case["protocol"]] = True
+    test_params["len"] = case["len"]
+    if case["protocol"] == "udp":
+        # datagram size, otherwise the client takes it from the control
+        # connection MSS while the server reads len bytes
+        test_params["MSS"] = case["len"]
+    test_params["parallel"] = case["parallel"]
+    test_params["time"] = duration
+    if case["reverse"]:
+        test_params["reverse"] = 1
+    return test_params
+
+class LoopbackBench():
+    '''Run benchmark cases against a pyiperf server in a separate process'''
+
+    def __init__(self, config_file, port):
+        self.config = json.load(open(config_file))
+        self.config["target"] = "localhost"
+        self.config["config_port"] = port
+        self.config["data_port"] = port
+        self.server = subprocess.Popen(
+            [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "pyperf.py"),
+             "-s", "--config", config_file, "-p", str(port)],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        self.server_process = psutil.Process(self.server.pid)
+
+    def close(self):
+        '''Stop the server'''
+        self.server.kill()
+        self.server.wait()
+
+    def run_client(self, params, config=None):
+        '''Run a client, retrying until the server is ready for the next
+        test. With a shared control and data port a connection can land
+        on the previous test's data listener just before it closes.
+        '''
+        if config is None:
+            config = self.config
+        deadline = time.monotonic() + 10
+        while True:
+            client = TestClient(copy.deepcopy(config), copy.deepcopy(params))
+            client.needs_display = False
+            try:
+                client.run()
+                if client.timestamps.get("start") is not None:
+                    return client
+            except (ConnectionRefusedError, ConnectionResetError, BrokenPipeError):
+                pass
+            if time.monotonic() > deadline:
+                return client
+            time.sleep(0.05)
+
+    def measure(self, params, case):
+        '''Run one test and derive the benchmark metrics'''
+        local = psutil.Process()
+        local_cpu = local.cpu_times()
+        server_cpu = self.server_process.cpu_times()
+        client = self.run_client(params)
+        local_after = local.cpu_times()
+        server_after = self.server_process.cpu_times()
+        cpu = (local_after.user + local_after.system - local_cpu.user - local_cpu.system) + \
+              (server_after.user + server_after.system - server_cpu.user - server_cpu.system)
+
+        if case["reverse"]:
+            (sent, received) = (client.peer_result, client.results)
+        else:
+            (sent, received) = (client.results, client.peer_result)
+        if sent is None or received is None:
+            return None
+
+        duration = params["time"]
+        received_bytes = sum([stream["bytes"] for stream in received["streams"]])
+        sent_bytes = sum([stream["bytes"] for stream in sent["streams"]])
+        calls = None
+        if case["protocol"] == "udp":
+            # one datagram per call on each side
+            packets = sum([stream["packets"] - stream["errors"] for stream in received["streams"]])
+            calls = sum([stream["packets"] for stream in received["streams"]]) + packets
+        else:
+            # application writes, assuming full writes. Reads and short
+            # writes are unknown, syscalls are only reported if counted.
+            packets = sent_bytes / case["len"]
+        if params.get("instrument"):
+            calls = sum([stream["instrumentation"]["calls"] + stream["instrumentation"]["eagain"]
+                         for stream in sent["streams"] + received["streams"]
+                         if "instrumentation" in stream])
+        gigabytes = max(received_bytes, 1) / 1E9
+        result = {"gbps": received_bytes * 8 / duration / 1E9,
+                  "pps": packets / duration,
+                  "cpu_s_per_gb": cpu / gigabytes}
+        if calls is not None:
+            result["syscalls_per_gb"] = calls / gigabytes
+        return result
+
+    def stream_setup(self, params, proto, streams):
+        '''Seconds from the first stream connect until all are established'''
+        test_params = case_params(params, {"protocol": proto, "len": DEFAULT_MATRIX["len"][proto][0],
+                                           "parallel": streams, "reverse": False}, 1)
+        # only setup is measured, keep the test itself cheap
+        config = copy.deepcopy(self.config)
+        config["bitrate"] = "1K"
+        client = self.run_client(test_params, config)
+        if client.timestamps.get("streams_ready") is None:
+            return None
+        return client.timestamps["streams_ready"] - client.timestamps["streams"]
+
+    def run(self, matrix, params, duration, runs):
+        '''Run all cases, each repeated runs times'''
+        results = {}
+        for case in cases(matrix):
+            samples = []
+            for run in range(runs):
+                sample = self.measure(case_params(params, case, duration), case)
+                if sample is not None:
+                    samples.append(sample)
+            results[case_name(case)] = summarize(case, samples)
+            print_case(case_name(case), results[case_name(case)])
+        return results
+
+def summarize(case, samples):
+    '''Mean and spread of each metric over the runs of a case'''
+    entry = {"case": case, "runs": len(samples), "samples": samples}
+    if len(samples) == 0:
+        return entry
+    for metric in samples[0]:
+        values = [sample[metric] for sample in samples]
+        entry[metric] = statistics.mean(values)
+        if len(values) > 1:
+            entry[metric + "_stdev"] = statistics.stdev(values)
+        else:
+            entry[metric + "_stdev"] = 0.0
+    return entry
+
+def print_case(name, entry):
+    '''One line summary of a case'''
+    if entry["runs"] == 0:
+        print("{:<24} FAILED".format(name))
+        return
+    syscalls = "{:>12}".format("-")
+    if "syscalls_per_gb" in entry:
+        syscalls = "{:>12.0f}".format(entry["syscalls_per_gb"])
+    print("{:<24} {:>8.3f} Gbps {:>12.0f} pps {:>8.3f} cpu s/GB {} syscalls/GB".format(
+        name, entry["gbps"], entry["pps"], entry["cpu_s_per_gb"], syscalls))
+
+def baseline(results, duration, runs):
+    '''Wrap results into a versioned baseline document'''
+    return {"format": BASELINE_FORMAT,
+            "version": VERSION,
+            "python": platform.python_version(),
+            "implementation": platform.python_implementation(),
+            "host": platform.node(),
+            "system": " ".join(platform.uname()),
+            "cpus": os.cpu_count(),
+            "free_threaded": free_threaded(),
+            "timestamp": int(time.time()),
+            "duration": duration,
+            "runs": runs,
+            "results": results}
+
+def compare(base, current, threshold):
+    '''List the metrics which regressed by more than the threshold or
+    the noise of both measurements, whichever is larger.
+    '''
+    regressions = []
+    for (name, entry) in current["results"].items():
+        reference = base["results"].get(name)
+        if reference is None or reference.get("runs", 0) == 0:
+            continue
+        if entry.get("runs", 0) == 0:
+            regressions.append((name, "runs", 0, 0, 100.0))
+            continue
+        for metric in ["gbps", "pps", "cpu_s_per_gb", "syscalls_per_gb"]:
+            old = reference.get(metric)
+            new = entry.get(metric)
+            if old is None or new is None or old == 0:
+                continue
+            change = 100 * (new - old) / old
+            if metric not in HIGHER_IS_BETTER:
+                change = -change
+            noise = 200 * (reference.get(metric + "_stdev", 0) + entry.get(metric + "_stdev", 0)) / old
+            if change < -max(threshold, noise):
+                regressions.append((name, metric, old, new, -change))
+    return regressions
+
+def main():
+    '''Run pyiperf self benchmarks'''
+
+    aparser = ArgumentParser(description=main.__doc__)
+    aparser.add_argument(
+        'command',
+        help='latency - control setup latency, run - loopback sweep, compare - check against baseline, '
+             'setup - stream setup time by stream count, scaling - throughput by stream count',
+        choices=["latency", "run", "compare", "setup", "scaling"],
+        nargs='?',
+        default="latency")
+
+    aparser.add_argument(
+        'files',
+        help='compare: baseline and current result files',
+        nargs='*')
+
+    aparser.add_argument(
+        '--config',
+        help='config file in json format',
+        type=str,
+        default=DEFAULT_CONFIG)
+
+    aparser.add_argument(
+        '--params',
+        help='iperf3 params file in json format',
+        type=str,
+        default=DEFAULT_PARAMS)
+
+    aparser.add_argument(
+        '-p', '--port',
+        help='port for the benchmark server',
+        type=int,
+        default=DEFAULT_PORT)
+
+    aparser.add_argument(
+        '-t', '--time',
+        help='time in seconds for each test',
+        type=int,
+        default=1)
+
+    aparser.add_argument(
+        '-r', '--runs',
+        help='number of runs to average over',
+        type=int,
+        default=5)
+
+    aparser.add_argument(
+        '--matrix',
+        help='json file overriding the sweep axes: protocol, len, parallel, reverse',
+        type=str)
+
+    aparser.add_argument(
+        '-o', '--output',
+        help='run: write the results as a baseline file',
+        type=str)
+
+    aparser.add_argument(
+        '--instrument',
+        help='run: count syscalls with stream instrumentation, TCP cases only report counted syscalls',
+        action='store_true')
+
+    aparser.add_argument(
+        '--sink',
+        help='run: receivers discard data with MSG_TRUNC, compare against a run without it',
+        action='store_true')
+
+    aparser.add_argument(
+        '--threshold',
+        help='compare: minimum regression in percent, default 5',
+        type=float,
+        default=DEFAULT_THRESHOLD)
+
+    args = vars(aparser.parse_args())
+
+    if args["command"] == "compare":
+        if len(args["files"]) != 2:
+            aparser.error("compare needs a baseline and a current result file")
+        regressions = compare(json.load(open(args["files"][0])), json.load(open(args["files"][1])),
+                              args["threshold"])
+        for (name, metric, old, new, change) in regressions:
+            print("REGRESSION {} {}: {:.4g} -> {:.4g} ({:.1f}% worse)".format(name, metric, old, new, change))
+        if len(regressions) > 0:
+            sys.exit(1)
+        print("No regressions")
+        return
+
+    config = json.load(open(args["config"]))
+    params = json.load(open(args["params"]))
+    params["time"] = args["time"]
+    if args["instrument"]:
+        params["instrument"] = True
+    if args["sink"]:
+        params["sink"] = True
+
+    if args["command"] == "run":
+        matrix = copy.deepcopy(DEFAULT_MATRIX)
+        if args.get("matrix") is not None:
+            matrix.update(json.load(open(args["matrix"])))
+        bench = LoopbackBench(args["config"], args["port"])
+        try:
+            results = bench.run(matrix, params, args["time"], args["runs"])
+        finally:
+            bench.close()
+        if args.get("output") is not None:
+            with open(args["output"], "w") as output:
+                json.dump(baseline(results, args["time"], args["runs"]), output, indent=1)
+        return
+
+    if args["command"] == "setup":
+        bench = LoopbackBench(args["config"], args["port"])
+        try:
+            for proto in DEFAULT_MATRIX["protocol"]:
+                for streams in SETUP_STREAMS:
+                    samples = [bench.stream_setup(params, proto, streams) for run in range(args["runs"])]
+                    samples = [sample for sample in samples if sample is not None]
+                    if len(samples) == 0:
+                        print("{:<4} P{:<4} FAILED".format(proto, streams))
+                        continue
+                    median = statistics.median(samples)
+                    print("{:<4} P{:<4} median {:.6f}s {:.1f}us per stream".format(
+                        proto, streams, median, median * 1E6 / streams))
+        finally:
+            bench.close()
+        return
+
+    if args["command"] == "scaling":
+        # streams of a process only run in parallel without the GIL,
+        # compare the output of a free-threaded and a standard build
+        print("{} CPython {}, {} cpus".format("Free-threaded" if free_threaded() else "Standard",
+                                             platform.python_version(), os.cpu_count()))
+        bench = LoopbackBench(args["config"], args["port"])
+        try:
+            for proto in DEFAULT_MATRIX["protocol"]:
+                single = None
+                for streams in SCALING_STREAMS:
+                    case = {"protocol": proto, "len": DEFAULT_MATRIX["len"][proto][0],
+                            "parallel": streams, "reverse": False}
+                    samples = [bench.measure(case_params(params, case, args["time"]), case)
+                               for run in range(args["runs"])]
+                    samples = [sample for sample in samples if sample is not None]
+                    if len(samples) == 0:
+                        print("{:<4} P{:<4} FAILED".format(proto, streams))
+                        continue
+                    gbps = statistics.median([sample["gbps"] for sample in samples])
+                    if single is None:
+                        single = gbps
+                    print("{:<4} P{:<4} {:>8.3f} Gbps {:>6.2f}x".format(proto, streams, gbps,
+                                                                       gbps / max(single, 1E-9)))
+        finally:
+            bench.close()
+        return
+
+    samples = [setup_latency(config, params) for run in range(args["runs"])]
+    for key in samples[0]:
+        print("{} median {:.6f}s".format(key, statistics.median([sample[key] for sample in samples])))
+
+if __name__ == "__main__":
+    main()
@@ -9,14 +9,21 @@
 # in the COPYING file in the root directory of this source tree).
 # You may select, at your option, one of the above-listed licenses.
 
+import select
 import struct
 import socket
 import time
-import threading
 import psutil
 from iperf_utils import json_send, json_recv, make_cookie
-from iperf_data import UDPClient, TCPClient
+from iperf_data import UDPClient, TCPClient, UnixClient, StreamConnector, CONNECT_ATTEMPT
 from iperf_data_plugin import PluginClient
+from iperf_packet import PacketClient
+from iperf_rr import RRLoop, TCPRRClient, UDPRRClient, rr_results
+from iperf_crr import TCPCRRClient, crr_results
+from iperf_netstat import NetSampler
+from iperf_soak import SoakRecorder
+from iperf_output import ResultWriter, start_record, interval_record, end_record
+from iperf_timer import TimerWheel
 
 #IPERF FSM STATES
 
@@ -86,54 +93,171 @@ class TestClient():
         self.peer_result = None
         self.test_ended = False
         self.timers = {}
+        # drives all test timers from the control thread
+        self.wheel = TimerWheel()
         self.server = False
         self.needs_display = True
         self.start_time = None
+        self.timestamps = {}
+        self.writer = None
+        self.last_interval = None
+        self.netstat = None
+        self.soak = None
 
     def send_parameters(self):
         '''Exchange Test Params'''
         return json_send(self.ctrl_sock, self.params)
 
+    def is_sender(self):
+        '''This side sends the test data'''
+        return (self.params.get("reverse") is None) != self.server
+
+    def stream_totals(self):
+        '''Running byte and packet totals for each stream'''
+        return [{"socket": stream.result["id"],
+                 "bytes": stream.total,
+                 "packets": max(stream.counters.parsed.packet_count, stream.counters.packet_count),
+                 "cpu": stream.counters.cpu.seconds()}
+                for stream in self.tx_streams]
+
+    def open_output(self):
+        '''Start JSON output if requested'''
+        if self.config.get("json") or self.config.get("json_stream"):
+            self.writer = ResultWriter(self.config)
+            self.writer.start(start_record(self))
+
+    def report_interval(self, final=False):
+        '''Report stream progress since the last interval. Like iperf3 a
+        final interval shorter than a tenth of the reporting interval is
+        not reported, its data is still accounted in the end results.
+        '''
+        if self.timers.get("interval") is None or self.last_interval is None:
+            return
+        now = time.clock_gettime(time.CLOCK_MONOTONIC)
+        (start, previous) = self.last_interval
+        totals = self.stream_totals()
+        if now > start and not (final and now - start < self.config.get("interval", 1) / 10):
+            samples = []
+            for sample in totals:
+                last = previous.get(sample["socket"], {"bytes": 0, "packets": 0, "cpu": 0.0})
+                delta = {"socket": sample["socket"],
+                         "bytes": sample["bytes"] - last["bytes"],
+                         "packets": sample["packets"] - last["packets"]}
+                if sample.get("cpu") is not None:
+                    delta["cpu"] = sample["cpu"] - (last.get("cpu") or 0.0)
+                samples.append(delta)
+            if self.soak is not None:
+                # rolled up instead of reported
+                netstat = None
+                if self.netstat is not None:
+                    netstat = self.netstat.interval()
+                self.soak.add(start - self.timestamps["start"], now - start, samples, netstat)
+            else:
+                record = interval_record(samples, start - self.timestamps["start"],
+                                         now - self.timestamps["start"],
+                                         self.is_sender(), self.params.get("udp") is not None)
+                if self.netstat is not None:
+                    record["netstat"] = self.netstat.interval()
+                self.writer.interval(record)
+        self.last_interval = (now, {sample["socket"]: sample for sample in totals})
+        if now - self.timestamps["start"] < self.params["time"]:
+            interval = min(self.config.get("interval", 1),
+                           self.params["time"] - (now - self.timestamps["start"]))
+            self.timers["interval"] = self.wheel.schedule(interval, self.report_interval)
+
+    def start_intervals(self):
+        '''Start periodic interval reports'''
+        self.soak = None
+        if self.params.get("soak"):
+            self.soak = SoakRecorder(self.config.get("interval", 1))
+        elif self.writer is None:
+            return
+        self.last_interval = (self.timestamps["start"], {})
+        self.timers["interval"] = self.wheel.schedule(self.config.get("interval", 1), self.report_interval)
+
+    def finish_intervals(self):
+        '''Report the final partial interval'''
+        if self.timers.get("interval") is not None:
+            self.timers["interval"].cancel()
+            self.report_interval(final=True)
+            self.timers["interval"].cancel()
+            self.timers["interval"] = None
+
     def collate_results(self):
         '''TX results'''
+        self.finish_intervals()
         self.results = {}
+        # process wide, in percent of wall time like iperf3, per stream
+        # figures come from the stream threads themselves
         cpu_usage = psutil.Process().cpu_times()
-        self.results["cpu_util_system"] = cpu_usage.system - self.cpu_usage.system
-        self.results["cpu_util_user"] = cpu_usage.user - self.cpu_usage.user
+        wall = time.time() - self.start_time
+        if wall <= 0:
+            wall = 1
+        self.results["cpu_util_system"] = 100 * (cpu_usage.system - self.cpu_usage.system) / wall
+        self.results["cpu_util_user"] = 100 * (cpu_usage.user - self.cpu_usage.user) / wall
         self.results["cpu_util_total"] = self.results["cpu_util_user"] + self.results["cpu_util_system"]
         self.results["sender_has_retransmits"] = 0
+        if self.netstat is not None:
+            self.results["netstat"] = self.netstat.total()
+        if self.soak is not None:
+            self.results["soak"] = self.soak.to_json()
+        # how late the test timers fired, their jitter under load
+        self.results["timers"] = self.wheel.lateness.percentiles()
+        self.results["timers"]["count"] = self.wheel.lateness.total
+        self.wheel.lateness.reset()
         self.results["streams"] = []
 
         for stream in self.tx_streams:
             stream.lock.acquire()
             self.results["streams"].append(stream.result)
             stream.lock.release()
+        if self.params.get("crr") and not self.server:
+            self.results["crr"] = crr_results(self.results["streams"])
+        elif self.params.get("rr") and not self.server:
+            self.results["rr"] = rr_results(self.results["streams"])
+        self.release_streams()
+
+    def release_streams(self):
+        '''Shut down streams once their results are collected'''
+        for stream in self.tx_streams:
             stream.shutdown()
 
     def display_results(self):
         '''Display results'''
         if self.needs_display:
             self.needs_display = False
+            if self.writer is not None:
+                self.writer.end(end_record(self.results, self.peer_result,
+                                           self.is_sender(), self.params.get("udp") is not None))
+                return
             print("My result {}".format(self.results))
             print("Peer result {}".format(self.peer_result))
 
     def exchange_results(self):
         '''Exchange results at the end of test'''
-        self.collate_results()
         if self.server:
+            # the client has drained its streams by the time it sends
+            # its results, collate ours only after that
             self.peer_result = json_recv(self.ctrl_sock)
+            self.collate_results()
             json_send(self.ctrl_sock, self.results)
             return True
+        self.collate_results()
         if json_send(self.ctrl_sock, self.results):
             self.peer_result = json_recv(self.ctrl_sock)
+            self.timestamps["results"] = time.clock_gettime(time.CLOCK_MONOTONIC)
             return True
         return False
 
     def create_streams(self):
         '''Create Stream'''
-        if self.params.get("udp") is not None and self.ctrl_sock is not None:
+        if self.params.get("udp") is not None and self.ctrl_sock is not None and \
+           self.params.get("MSS") is None:
             self.params["MSS"] = self.ctrl_sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_MAXSEG)
         off = 1
+        loop = None
+        if self.params.get("rr") or self.params.get("crr"):
+            loop = RRLoop(self.params)
         for stream_id in range(self.params["parallel"]):
             # This is a bug in iperf. It numbers treams in the following ingenious way
             # 1 3 4...
@@ -141,30 +265,61 @@ class TestClient():
                 off = 2
             if self.config.get("plugin") is not None:
                 self.tx_streams.append(PluginClient(self.config, self.params, stream_id + off))
+            elif self.params.get("crr"):
+                self.tx_streams.append(TCPCRRClient(self.config, self.params, stream_id + off, loop))
+            elif loop is not None:
+                if self.params.get("udp") is not None:
+                    self.tx_streams.append(UDPRRClient(self.config, self.params, stream_id + off, loop))
+                if self.params.get("tcp") is not None:
+                    self.tx_streams.append(TCPRRClient(self.config, self.params, stream_id + off, loop))
+            elif self.params.get("local") is not None:
+                self.tx_streams.append(UnixClient(self.config, self.params, stream_id + off))
+            elif self.config.get("backend") == "packet":
+                self.tx_streams.append(PacketClient(self.config, self.params, stream_id + off))
             else:
                 if self.params.get("udp") is not None:
                     self.tx_streams.append(UDPClient(self.config, self.params, stream_id + off))
                 if self.params.get("tcp") is not None:
                     self.tx_streams.append(TCPClient(self.config, self.params, stream_id + off))
-        for stream in self.tx_streams:
-            stream.connect()
+        # connect all streams at once, setup time no longer grows with
+        # the number of streams times the round trip
+        attempt = CONNECT_ATTEMPT
+        if self.config.get("connect_timeout") is not None:
+            attempt = self.config["connect_timeout"] / 1000
+        self.timestamps["streams"] = time.clock_gettime(time.CLOCK_MONOTONIC)
+        StreamConnector(self.tx_streams, attempt).run()
+        self.timestamps["streams_ready"] = time.clock_gettime(time.CLOCK_MONOTONIC)
         return True
 
     def start_test(self):
         '''Start Stream'''
         self.cpu_usage = psutil.Process().cpu_times()
         self.start_time = time.time()
+        self.timestamps["start"] = time.clock_gettime(time.CLOCK_MONOTONIC)
+        self.start_netstat()
+        self.open_output()
 
-        self.timers["end"] = threading.Timer(self.params["time"], self.end_test_timer)
-        self.timers["end"].start()
-        self.timers["failsafe"] = threading.Timer(self.params["time"] + 10, self.end_test_failsafe)
-        self.timers["failsafe"].start()
+        self.timers["end"] = self.wheel.schedule(self.params["time"], self.end_test_timer)
+        self.timers["failsafe"] = self.wheel.schedule(self.params["time"] + 10, self.end_test_failsafe)
 
         for stream in self.tx_streams:
             stream.start()
 
+        self.start_intervals()
         return True
 
+    def start_netstat(self):
+        '''Snapshot kernel network counters if the client asked for them'''
+        if not self.params.get("netstat") or self.ctrl_sock is None:
+            return
+        if self.netstat is None:
+            try:
+                self.netstat = NetSampler(self.ctrl_sock.getsockname()[0])
+            except OSError:
+                # no /proc/net, not Linux
+                return
+        self.netstat.start()
+
     def end_test_timer(self):
         '''Timer to end the test'''
         self.timers["end"] = None
@@ -188,15 +343,27 @@ class TestClient():
             return True
         if self.ctrl_sock is not None:
             self.ctrl_sock.close()
-        if self.timers.get("end") is not None:
-            self.timers["end"].cancel()
-        if self.timers.get("failsafe") is not None:
-            self.timers["failsafe"].cancel()
+        self.cancel_timers()
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+        if self.netstat is not None:
+            self.netstat.close()
+            self.netstat = None
         self.test_ended = True
         return False
 
+    def cancel_timers(self):
+        '''Cancel any outstanding test timers'''
+        timers = self.timers
+        self.timers = {}
+        for timer in timers.values():
+            if timer is not None:
+                timer.cancel()
+
     def connect(self):
         '''Connect to server'''
+        self.timestamps["connect"] = time.clock_gettime(time.CLOCK_MONOTONIC)
         self.ctrl_sock = socket.socket() # defaults to AF_INET/STREAM
         self.ctrl_sock.connect((self.config["target"], self.config["config_port"]))
 
@@ -240,18 +407,30 @@ class TestClient():
         if self.params.get("MSS") is not None:
             return
 
+    def wait_for_state(self):
+        '''Wait for the next state from the server, firing any timers
+        which come due meanwhile. None if only timers fired or one of
+        them ended the test, the failsafe closes the control socket.
+        '''
+        (readable, _, _) = select.select([self.ctrl_sock], [], [], self.wheel.timeout())
+        self.wheel.run()
+        if len(readable) == 0 or self.test_ended:
+            return None
+        return self.ctrl_sock.recv(1)
+
     def run(self):
         '''Run the client'''
 
         self.connect()
         self.authorize()
         try:
-            while True:
-                data = self.ctrl_sock.recv(1)
-                self.state_transition(struct.unpack(STATE, data)[0])
+            while not self.test_ended:
+                data = self.wait_for_state()
+                if data is not None:
+                    self.state_transition(struct.unpack(STATE, data)[0])
         except struct.error:
             self.state_transition(DISPLAY_RESULTS)
-        except OSError:
+        except (OSError, ValueError):
             self.state_transition(DISPLAY_RESULTS)
         except KeyboardInterrupt:
             self.state_transition(DISPLAY_RESULTS)
@@ -10,15 +10,18 @@
 # You may select, at your option, one of the above-listed licenses.
 
 import struct
+import select
 import socket
 import time
 import iperf_control
-from iperf_data_server import UDPDataServer, TCPDataServer
-from iperf_utils import COOKIE_SIZE
+from iperf_data_server import UDPDataServer, TCPDataServer, UnixDataServer
+from iperf_utils import COOKIE_SIZE, json_recv
+from iperf_histogram import merge_histograms
 
-IGNORE_IO_STATES = [iperf_control.EXCHANGE_RESULTS,
-                    iperf_control.DISPLAY_RESULTS,
-                    iperf_control.TEST_END]
+# Seconds to wait for all data streams to connect after CREATE_STREAMS
+STREAM_TIMEOUT = 10
+# Seconds past the test duration to wait for TEST_END from the client
+END_GRACE = 2
 
 class TestServer(iperf_control.TestClient):
     '''Iperf3 compatible test server'''
@@ -29,89 +32,171 @@ class TestServer(iperf_control.TestClient):
 
         self.control_listener = None
         self.test_server = None
-        self.schedule = [(iperf_control.PARAM_EXCHANGE, 0.1)]
         self.start_time = None
         self.server = True
         self.control_active = True
+        self.metrics = None
 
     def end_test(self):
         '''Cleanup Test'''
         super().end_test()
+        if self.metrics is not None:
+            self.metrics.session_ended(self)
+        self.stop_test_server()
+
+    def create_test_server(self):
+        '''Create the data server for the test. A data server left over
+        from the previous test in a session is rearmed if it fits.
+        '''
+        if self.params.get("udp"):
+            server_class = UDPDataServer
+        if self.params.get("tcp"):
+            server_class = TCPDataServer
+        if self.params.get("local") is not None:
+            server_class = UnixDataServer
+        if type(self.test_server) is server_class and \
+           bool(self.test_server.params.get("crr")) == bool(self.params.get("crr")) and \
+           self.test_server.params.get("local") == self.params.get("local"):
+            self.test_server.rearm(self.params)
+            return
+        self.stop_test_server()
+        self.test_server = server_class(self.config, self.params)
+        self.test_server.start()
+
+    def stop_test_server(self):
+        '''Shut down the data server'''
         if self.test_server is not None:
+            self.timestamps["first_data"] = self.test_server.first_data
             self.test_server.shutdown()
             self.test_server.worker.join()
+            self.test_server.server_close()
             self.test_server = None
 
+    def next_test(self):
+        '''Get ready for the next test in a session'''
+        self.cancel_timers()
+        if self.metrics is not None:
+            self.metrics.session_ended(self)
+        self.results = None
+        self.peer_result = None
+        self.needs_display = True
+        self.state = iperf_control.IPERF_START
+
     def collate_results(self):
         '''Collate Results'''
 
         super().collate_results()
+        wall = time.time() - self.start_time
         stream_id = 1
-        for state_entry in self.test_server.state.values():
+        for (_, state_entry) in self.test_server.streams():
             entry = {"bytes": state_entry.bytes_received,
                     "retransmits": 0,
                     "jitter": state_entry.jitter,
                     "errors": state_entry.cnt_error,
                     "packets": state_entry.packet_count,
+                    "out_of_order": state_entry.outoforder_packets,
                     "start_time": 0,
-                    "end_time":time.time() - self.start_time,
+                    "end_time":wall,
                     "id":stream_id}
+            entry.update(state_entry.histograms())
+            if state_entry.payload is not None:
+                entry.update(state_entry.payload.results())
+            entry.update(state_entry.cpu.results(wall, state_entry.bytes_received))
+            if state_entry.stats is not None:
+                entry["instrumentation"] = state_entry.stats.to_json()
             stream_id = stream_id + 1
             if stream_id == 2:
                 stream_id = 3
 
             self.results["streams"].append(entry)
 
-    def state_transition(self, new_state):
-        '''Transition iperf state'''
+        if self.params.get("crr"):
+            self.results["crr"] = self.test_server.crr_totals()
+            self.results["crr"]["connections_per_second"] = self.results["crr"]["connections"] / wall
 
-        result = False
-        peer_state = None
-
-        # These two states are special - we ignore anything from the peer
-        # while handling them
-        if self.control_active:
-            if not new_state in IGNORE_IO_STATES:
-                try:
-                    self.ctrl_sock.setblocking(False)
-                    buff = self.ctrl_sock.recv(1)
-                    if len(buff) > 0:
-                        peer_state = struct.unpack(iperf_control.STATE, buff)[0]
-                except BlockingIOError:
-                    pass
-                except OSError:
-                    new_state = iperf_control.TEST_END
-                    self.control_active = False
+        # UDP streams share the serving thread, its CPU is reported here
+        self.results["data_server_cpu"] = self.test_server.cpu.results(
+            wall, sum([stream["bytes"] for stream in self.results["streams"]]))
+
+        delay = merge_histograms(self.results["streams"], "delay_histogram")
+        if delay is not None:
+            self.results["delay"] = delay.percentiles()
+
+    def stream_totals(self):
+        '''Running byte and packet totals for each stream'''
+        totals = []
+        stream_id = 1
+        for (_, state_entry) in self.test_server.streams():
+            totals.append({"socket": stream_id,
+                           "bytes": state_entry.bytes_received,
+                           "packets": state_entry.packet_count,
+                           "cpu": state_entry.cpu.seconds()})
+            stream_id = stream_id + 1
+            if stream_id == 2:
+                stream_id = 3
+        return totals
+
+    def send_state(self, new_state):
+        '''Notify the peer of a state change'''
+        try:
+            self.ctrl_sock.send(struct.pack(iperf_control.STATE, new_state))
+        except OSError:
+            self.control_active = False
+            return False
+        return True
 
+    def wait_for_peer(self, deadline):
+        '''Wait for the peer to change state, firing any timers which
+        come due meanwhile. Returns None on deadline.
+        '''
+        while True:
+            timeout = max(deadline - time.clock_gettime(time.CLOCK_MONOTONIC), 0)
+            if self.wheel.timeout() is not None:
+                timeout = min(timeout, self.wheel.timeout())
             try:
-                self.ctrl_sock.setblocking(True)
-                if peer_state is None and (not self.state == new_state):
-                    self.ctrl_sock.send(struct.pack(iperf_control.STATE, new_state))
-            except OSError:
-                new_state = iperf_control.TEST_END
-                self.control_active = False
+                (readable, _, _) = select.select([self.ctrl_sock], [], [], timeout)
+                self.wheel.run()
+                if len(readable) > 0:
+                    buff = self.ctrl_sock.recv(1)
+                    break
+            except (OSError, ValueError):
+                buff = b""
+                break
+            if self.test_ended or time.clock_gettime(time.CLOCK_MONOTONIC) >= deadline:
+                return None
+        if len(buff) == 0:
+            self.control_active = False
+            return iperf_control.TEST_END
+        return struct.unpack(iperf_control.STATE, buff)[0]
+
+    def state_transition(self, new_state, peer=False):
+        '''Transition iperf state. States originating locally are
+        sent to the peer, states received from the peer are not echoed.
+        '''
+
+        result = False
 
-            if peer_state is not None:
-                new_state = peer_state
+        if self.control_active and not peer and \
+           not new_state == iperf_control.TEST_END and not self.state == new_state:
+            if not self.send_state(new_state):
+                new_state = iperf_control.TEST_END
 
         self.state = new_state
 
         if new_state == iperf_control.PARAM_EXCHANGE:
             self.params = json_recv(self.ctrl_sock)
             if self.params is not None:
-                self.amend_schedule()
-                if self.params.get("udp"):
-                    self.test_server = UDPDataServer(self.config, self.params)
-                if self.params.get("tcp"):
-                    self.test_server = TCPDataServer(self.config, self.params)
-                self.test_server.start()
+                self.create_test_server()
                 result = True
             else:
                 return False
         elif new_state == iperf_control.TEST_START:
             result = self.start_test()
+            if self.metrics is not None:
+                self.metrics.session_started(self)
         elif new_state == iperf_control.CREATE_STREAMS:
-            result = True
+            result = self.test_server.wait_for_streams(STREAM_TIMEOUT)
+            self.test_server.reset_counters()
         elif new_state == iperf_control.TEST_RUNNING:
             result = True
         elif new_state == iperf_control.EXCHANGE_RESULTS:
@@ -121,14 +206,20 @@ class TestServer(iperf_control.TestClient):
             self.display_results()
             result = True
         elif new_state == iperf_control.TEST_END:
-            self.state_transition(iperf_control.EXCHANGE_RESULTS)
-            self.state_transition(iperf_control.DISPLAY_RESULTS)
-            self.end_test()
+            if self.control_active:
+                self.state_transition(iperf_control.EXCHANGE_RESULTS)
+                self.state_transition(iperf_control.DISPLAY_RESULTS)
+            if self.control_active and self.params.get("session"):
+                self.next_test()
+            else:
+                self.end_test()
             result =  True
-        elif new_state == iperf_control.SERVER_TERMINATE:
+        elif new_state in [iperf_control.SERVER_TERMINATE, iperf_control.CLIENT_TERMINATE]:
             self.state_transition(iperf_control.DISPLAY_RESULTS)
             self.state = iperf_control.IPERF_DONE
             result = True
+        elif new_state == iperf_control.IPERF_DONE:
+            result = True
         elif new_state == iperf_control.ACCESS_DENIED:
             result = False
         elif new_state == iperf_control.SERVER_ERROR:
@@ -136,38 +227,50 @@ class TestServer(iperf_control.TestClient):
 
         return result
 
-    def amend_schedule(self):
-        '''Create a test schedule'''
-        self.schedule.extend([
-            (iperf_control.CREATE_STREAMS, 0.1),
-            (iperf_control.TEST_START, 0.1)
-        ])
-        dur = 0
-        while dur < self.params["time"] + 2:
-            self.schedule.append(
-                (iperf_control.TEST_RUNNING, self.config["interval"])
-            )
-            dur = dur + self.config["interval"]
-        self.schedule.append((iperf_control.IPERF_DONE, 0.1))
+    def run_fsm(self):
+        '''Drive the test. Each state is entered as soon as its
+        precondition holds - params received, all streams connected,
+        TEST_END from the client or the test deadline expiring.
+        In a session the FSM restarts from PARAM_EXCHANGE on the same
+        control connection after each test.
+        '''
+        while True:
+            for state in [iperf_control.PARAM_EXCHANGE,
+                          iperf_control.CREATE_STREAMS,
+                          iperf_control.TEST_START,
+                          iperf_control.TEST_RUNNING]:
+                if not self.state_transition(state) or self.test_ended:
+                    return False
+
+            deadline = time.clock_gettime(time.CLOCK_MONOTONIC) + self.params["time"] + END_GRACE
+            while not self.test_ended and \
+                  self.state not in [iperf_control.IPERF_DONE, iperf_control.IPERF_START]:
+                peer_state = self.wait_for_peer(deadline)
+                if peer_state is None:
+                    self.state_transition(iperf_control.IPERF_DONE)
+                else:
+                    self.state_transition(peer_state, peer=True)
+            if not self.state == iperf_control.IPERF_START:
+                return True
+
+    def listen(self):
+        '''Open the control listener'''
+        self.control_listener = \
+            socket.create_server((self.config["target"], self.config["config_port"]), reuse_port=True)
 
     def run(self):
         '''Run the server'''
         running = False
         try:
-            self.control_listener = \
-                socket.create_server((self.config["target"], self.config["config_port"]), reuse_port=True)
+            if self.control_listener is None:
+                self.listen()
             #pylint: disable=unused-variable
             self.ctrl_sock, addr = self.control_listener.accept()
             running = True
             self.ctrl_sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
             self.control_listener.close()
             self.config["cookie"] = self.ctrl_sock.recv(COOKIE_SIZE)
-            for (state, duration) in self.schedule:
-                if self.state_transition(state):
-                    time.sleep(duration)
-                else:
-                    self.end_test()
-                    break
+            self.run_fsm()
             self.end_test()
         except KeyboardInterrupt:
             if running:
@@ -0,0 +1,69 @@
+#!/usr/bin/python3
+'''Iperf per thread CPU accounting'''
+
+# pyiperf, Copyright (c) 2023 RedHat Inc
+# pyiperf, Copyright (c) 2023 Cambridge Greys Ltd
+
+# This source code is licensed under both the BSD-style license (found in the
+# LICENSE file in the root directory of this source tree) and the GPLv2 (found
+# in the COPYING file in the root directory of this source tree).
+# You may select, at your option, one of the above-listed licenses.
+
+import threading
+import time
+
+class ThreadCPU():
+    '''CPU time used by one thread. Started and stopped by the thread
+    itself, can be sampled from any other thread while it runs.
+    '''
+    def __init__(self):
+        self.clock = None
+        self.start = 0.0
+        self.used = None
+
+    def begin(self):
+        '''Start accounting for the calling thread'''
+        try:
+            self.clock = time.pthread_getcpuclockid(threading.get_ident())
+            self.start = time.clock_gettime(self.clock)
+        except (AttributeError, OSError):
+            self.clock = None
+        self.used = None
+
+    def rebase(self):
+        '''Restart accounting from now, the thread keeps running'''
+        if self.clock is not None:
+            try:
+                self.start = time.clock_gettime(self.clock)
+            except OSError:
+                pass
+        self.used = None
+
+    def end(self):
+        '''Stop accounting, must be called by the thread itself'''
+        self.used = self.seconds()
+        self.clock = None
+        return self.used
+
+    def seconds(self):
+        '''CPU seconds used so far, None if not accounted'''
+        if self.used is not None:
+            return self.used
+        if self.clock is None:
+            return None
+        try:
+            return time.clock_gettime(self.clock) - self.start
+        except OSError:
+            return None
+
+    def results(self, wall, nbytes):
+        '''CPU use normalized to wall time and to data moved'''
+        used = self.seconds()
+        if used is None:
+            return {}
+        result = {"cpu_seconds": used, "cpu_percent": 0.0, "cpu_per_gbit": 0.0}
+        if wall > 0:
+            result["cpu_percent"] = 100 * used / wall
+        if nbytes > 0:
+            result["cpu_per_gbit"] = used / (nbytes * 8 / 1E9)
+        return result
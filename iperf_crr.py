@@ -0,0 +1,293 @@
+#!/usr/bin/python3
+'''Iperf connect/request/response streams'''
+
+# pyiperf, Copyright (c) 2023 RedHat Inc
+# pyiperf, Copyright (c) 2023 Cambridge Greys Ltd
+
+# This source code is licensed under both the BSD-style license (found in the
+# LICENSE file in the root directory of this source tree) and the GPLv2 (found
+# in the COPYING file in the root directory of this source tree).
+# You may select, at your option, one of the above-listed licenses.
+
+import errno
+import selectors
+import socket
+from iperf_data import TCPClient
+from iperf_histogram import Histogram, merge_histograms
+from iperf_rr import RRStream, RECV_SIZE, rr_sizes, rr_results
+from iperf_utils import COOKIE_SIZE
+
+# connections accepted per wakeup of an acceptor
+ACCEPT_BATCH = 64
+POLL_INTERVAL = 0.1
+# failed connection attempts of a transaction are retried this long
+# later, at the loop's next timeout check, and given up after the retries
+CONNECT_BACKOFF = 0.001
+CONNECT_RETRIES = 3
+
+class TCPCRRClient(RRStream, TCPClient):
+    '''Each transaction connects, sends the cookie and a request, reads
+    the response and closes once the server has closed. The server
+    closes first so TIME_WAIT is kept there and the client does not
+    run out of ports. The stream connection made by connect() only
+    registers the stream with the server.
+    '''
+    def __init__(self, config, params, stream_id, loop):
+        super().__init__(config, params, stream_id)
+        self.setup_rr(loop)
+        self.conn = None
+        self.connected = False
+        self.selector = None
+        self.attempts = 0
+        self.retry_at = None
+        self.connect_errors = 0
+        self.connect_time = Histogram()
+        self.payload = None
+
+    def reset(self, params):
+        '''Prepare an already connected stream for another test'''
+        super().reset(params)
+        self.connect_errors = 0
+        self.connect_time = Histogram()
+
+    def begin(self, selector, now):
+        '''Start the first transaction'''
+        self.selector = selector
+        self.payload = self.config["cookie"] + bytes(self.request_buff)
+        self.request(now)
+
+    def request(self, now):
+        '''Start the next transaction'''
+        self.attempts = 0
+        self.open_conn(now)
+
+    def open_conn(self, now):
+        '''Open the connection for the transaction'''
+        self.retry_at = None
+        self.sent_at = now
+        self.pending = self.response_size
+        self.connected = False
+        self.conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.conn.setblocking(False)
+        result = self.conn.connect_ex((self.config["target"], self.config["data_port"]))
+        if result not in [0, errno.EINPROGRESS]:
+            self.connect_failed(now)
+            return
+        self.selector.register(self.conn, selectors.EVENT_WRITE, self)
+
+    def close_conn(self):
+        '''Drop the transaction connection'''
+        try:
+            self.selector.unregister(self.conn)
+        except KeyError:
+            pass
+        self.conn.close()
+        self.conn = None
+
+    def connect_failed(self, now):
+        '''Count a failed connection attempt and try again from the loop,
+        abandoning the transaction once its retries are spent
+        '''
+        self.connect_errors = self.connect_errors + 1
+        self.close_conn()
+        self.attempts = self.attempts + 1
+        if self.attempts > CONNECT_RETRIES:
+            self.timeouts = self.timeouts + 1
+            self.attempts = 0
+        self.retry_at = now + CONNECT_BACKOFF
+
+    def send_payload(self, now):
+        '''Send as much of the cookie and request as the socket takes,
+        the rest goes out once it is writable again
+        '''
+        view = memoryview(self.payload)
+        while self.unsent < len(view):
+            try:
+                self.unsent = self.unsent + self.conn.send(view[self.unsent:])
+            except BlockingIOError:
+                return
+            except OSError:
+                self.connect_failed(now)
+                return
+        self.selector.modify(self.conn, selectors.EVENT_READ, self)
+
+    def event(self, mask, now):
+        '''Connection established, request writable or response data arrived'''
+        if not self.connected:
+            if self.conn.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) != 0:
+                self.connect_failed(now)
+                return
+            self.connected = True
+            self.connect_time.record(now - self.sent_at)
+            self.unsent = 0
+            self.send_payload(now)
+            return
+        if self.unsent < len(self.payload):
+            self.send_payload(now)
+            return
+        try:
+            data = self.conn.recv(RECV_SIZE)
+        except BlockingIOError:
+            return
+        except ConnectionResetError:
+            data = b""
+        if len(data) > 0:
+            self.total = self.total + len(data)
+            self.pending = self.pending - len(data)
+            return
+        # the server has closed
+        self.close_conn()
+        if self.pending <= 0:
+            self.complete(now)
+        else:
+            self.timeouts = self.timeouts + 1
+            self.request(now)
+
+    def check_timeout(self, now):
+        '''Retry a failed connection attempt which is due and abandon a
+        transaction which is not progressing
+        '''
+        if self.conn is None:
+            if self.retry_at is not None and now >= self.retry_at:
+                self.open_conn(now)
+            return
+        if now - self.sent_at > self.timeout:
+            self.timeouts = self.timeouts + 1
+            self.close_conn()
+            self.request(now)
+
+    def stop(self, selector):
+        '''Abandon the transaction in progress'''
+        if self.conn is not None:
+            self.close_conn()
+
+    def finish(self, now):
+        '''Fill in the stream result'''
+        super().finish(now)
+        self.result["errors"] = self.timeouts + self.connect_errors
+        self.result["connections"] = self.transactions
+        self.result["connections_per_second"] = self.result["transactions_per_second"]
+        if self.connect_time.total > 0:
+            self.result["connect"] = self.connect_time.percentiles()
+            self.result["connect_histogram"] = self.connect_time.to_json()
+
+def crr_results(streams):
+    '''Connection totals and merged connect time distribution'''
+    result = rr_results(streams)
+    result["connections_per_second"] = result["transactions_per_second"]
+    connect = merge_histograms(streams, "connect_histogram")
+    if connect is not None:
+        result["connect"] = connect.percentiles()
+    return result
+
+class CRRConnection():
+    '''A connection accepted by a CRR acceptor'''
+    __slots__ = ["sock", "addr", "head", "received", "stream", "sent"]
+
+    def __init__(self, sock, addr):
+        self.sock = sock
+        self.addr = addr
+        self.head = b""
+        self.received = 0
+        self.stream = False
+        # bytes of the response sent, None until the request is complete
+        self.sent = None
+
+class CRRAcceptor():
+    '''Accept and answer short lived connections on one listener from a
+    single thread, in batches and without a thread per connection.
+    '''
+    def __init__(self, server, listener):
+        self.server = server
+        self.listener = listener
+        (self.request_size, response_size) = rr_sizes(server.params)
+        self.response = bytes(response_size)
+        self.connections = 0
+        self.bytes = 0
+        self.worker = None
+
+    def run(self):
+        '''Serve until the data server is shut down'''
+        selector = selectors.DefaultSelector()
+        self.listener.setblocking(False)
+        selector.register(self.listener, selectors.EVENT_READ, None)
+        while not self.server.crr_done:
+            for (key, mask) in selector.select(POLL_INTERVAL):
+                if key.data is None:
+                    self.accept(selector)
+                elif mask & selectors.EVENT_WRITE:
+                    self.respond(selector, key.data)
+                else:
+                    self.readable(selector, key.data)
+        for key in list(selector.get_map().values()):
+            if key.data is not None:
+                key.data.sock.close()
+        selector.close()
+
+    def accept(self, selector):
+        '''Accept the connections which are waiting'''
+        for _ in range(ACCEPT_BATCH):
+            try:
+                (sock, addr) = self.listener.accept()
+            except BlockingIOError:
+                return
+            sock.setblocking(False)
+            selector.register(sock, selectors.EVENT_READ, CRRConnection(sock, addr))
+
+    def close(self, selector, conn):
+        '''Close a connection'''
+        selector.unregister(conn.sock)
+        conn.sock.close()
+
+    def readable(self, selector, conn):
+        '''Cookie or request data arrived'''
+        try:
+            data = conn.sock.recv(RECV_SIZE)
+        except BlockingIOError:
+            return
+        except ConnectionResetError:
+            data = b""
+        if len(data) == 0:
+            self.close(selector, conn)
+            return
+        if conn.stream:
+            return
+        if len(conn.head) < COOKIE_SIZE:
+            needed = COOKIE_SIZE - len(conn.head)
+            conn.head = conn.head + data[:needed]
+            data = data[needed:]
+            if len(conn.head) < COOKIE_SIZE:
+                return
+            if conn.head != self.server.config.get("cookie"):
+                self.close(selector, conn)
+                return
+            # one of the stream connections made before the test starts,
+            # acceptors on other threads may be adding the others
+            if self.server.add_stream("{}:{}".format(conn.addr[0], conn.addr[1]),
+                                      self.server.params["parallel"]) is not None:
+                conn.stream = True
+                return
+        conn.received = conn.received + len(data)
+        if conn.received >= self.request_size and conn.sent is None:
+            if self.server.first_data is None:
+                self.server.data_arrived()
+            conn.sent = 0
+            self.respond(selector, conn)
+
+    def respond(self, selector, conn):
+        '''Send what the socket takes of the response, the connection is
+        closed and counted once all of it has gone out
+        '''
+        view = memoryview(self.response)
+        while conn.sent < len(view):
+            try:
+                conn.sent = conn.sent + conn.sock.send(view[conn.sent:])
+            except BlockingIOError:
+                selector.modify(conn.sock, selectors.EVENT_WRITE, conn)
+                return
+            except OSError:
+                self.close(selector, conn)
+                return
+        self.connections = self.connections + 1
+        self.bytes = self.bytes + conn.received
+        self.close(selector, conn)
@@ -9,17 +9,41 @@
 # in the COPYING file in the root directory of this source tree).
 # You may select, at your option, one of the above-listed licenses.
 
+import errno
+import os
+import selectors
 import struct
 import socket
+import sys
+import tempfile
 import threading
 import time
 from iperf_utils import bandwidth
+from iperf_histogram import Histogram
+from iperf_instrument import StreamStats
+from iperf_cpu import ThreadCPU
+from iperf_trace import TraceRecorder, trace_path, DEFAULT_RECORDS
+from iperf_verify import Payload
 
 FORMAT32 = "!iii"
 FORMAT64 = "!iil"
 # this for some reason is in host order
 UDP_CONNECT_MSG = struct.pack("i", 0x36373839)
 UDP_CONNECT_REPLY = 0x39383736
+# bytes of a UDP datagram read in sink mode, enough for either header
+UDP_HEADER_SIZE = struct.calcsize(FORMAT64)
+# socket types of the local transports
+LOCAL_TYPES = {"stream": socket.SOCK_STREAM,
+               "seqpacket": socket.SOCK_SEQPACKET,
+               "socketpair": socket.SOCK_STREAM}
+# data servers of this process accepting socketpair streams, by path
+LOCAL_SERVERS = {}
+# seconds allowed for each attempt to establish a stream and the retries
+CONNECT_ATTEMPT = 1.0
+CONNECT_RETRIES = 5
+# longest a stream held back by the bitrate limit waits before it looks
+# at the clock again, stopping the stream wakes it at once
+PACING_SLICE = 0.1
 
 class Header():
     '''Packet Header'''
@@ -53,9 +77,94 @@ class Header():
             struct.pack_into(FORMAT64, buff, 0, self.sec, self.usec, self.packet_count)
         struct.pack_into(FORMAT32, buff, 0, self.sec, self.usec, self.packet_count)
 
+# Not exported by the socket module on all versions, this is the
+# generic Linux value which also applies to x86 and ARM
+SO_TIMESTAMPNS = getattr(socket, "SO_TIMESTAMPNS", 35)
+TIMESPEC = struct.Struct("@ll")
+ANCBUFSIZE = socket.CMSG_SPACE(TIMESPEC.size)
+# how often the realtime to monotonic clock offset is refreshed, in ns
+OFFSET_REFRESH = 1000000000
+
+class RxTimestamps():
+    '''Kernel software receive timestamps. The kernel stamps packets
+    with CLOCK_REALTIME while senders use CLOCK_MONOTONIC, so stamps
+    are converted using an offset between the clocks which is
+    refreshed once a second of packet time.
+    '''
+    def __init__(self):
+        self.offset = 0
+        self.refreshed = None
+
+    def refresh(self, stamp):
+        '''Recompute the clock offset'''
+        self.offset = time.clock_gettime_ns(time.CLOCK_REALTIME) - \
+                      time.clock_gettime_ns(time.CLOCK_MONOTONIC)
+        self.refreshed = stamp
+
+    def decode(self, ancdata):
+        '''Receive time in seconds of CLOCK_MONOTONIC, None if the
+        packet was not stamped
+        '''
+        for (level, kind, data) in ancdata:
+            if level == socket.SOL_SOCKET and kind == SO_TIMESTAMPNS:
+                (sec, nsec) = TIMESPEC.unpack_from(data)
+                return self.monotonic(sec * 1000000000 + nsec)
+        return None
+
+    def monotonic(self, stamp):
+        '''Convert a CLOCK_REALTIME stamp in ns to seconds of CLOCK_MONOTONIC'''
+        if self.refreshed is None or stamp - self.refreshed > OFFSET_REFRESH:
+            self.refresh(stamp)
+        return (stamp - self.offset) / 1E9
+
+def rx_timestamps(sock):
+    '''Enable kernel receive timestamps on sock, None if not supported'''
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, SO_TIMESTAMPNS, 1)
+    except OSError:
+        return None
+    return RxTimestamps()
+
+def sink_buffer(params, size):
+    '''Buffer for a sink mode receiver, which drains data with MSG_TRUNC
+    so the kernel does not copy it. None if sink mode is off or if
+    MSG_TRUNC does not discard stream data on this platform.
+    '''
+    if not params.get("sink") or not sys.platform.startswith("linux"):
+        return None
+    return bytearray(size)
+
+def unix_path(config):
+    '''Path of the UNIX socket of the data server, the data port keeps
+    servers on different ports apart
+    '''
+    if config.get("unix_path") is not None:
+        return config["unix_path"]
+    return os.path.join(tempfile.gettempdir(), "pyiperf-{}.sock".format(config["data_port"]))
+
 class Counters():
-    '''Packet Counters'''
+    '''Packet Counters. Only the thread serving a stream updates them,
+    others may read them while it runs.
+    '''
     def __init__(self):
+        self.stats = None
+        # CPU of the thread owning the stream, if it has a thread of its own
+        self.cpu = ThreadCPU()
+        # optional per packet trace of the receive side
+        self.trace = None
+        # optional payload verification of the receive side
+        self.payload = None
+        self.reset()
+
+    def reset(self):
+        '''Reset counters to initial state'''
+        if self.stats is not None:
+            self.stats = StreamStats()
+        if self.payload is not None:
+            self.payload.reset()
+        self.cpu.rebase()
         self.packet_count = 0
         self.peer_packet_count = 0
         self.jitter = 0.0
@@ -66,12 +175,20 @@ class Counters():
 
         self.first_packet = True
         self.parsed = Header()
+        # one way delay is only meaningful if sender and receiver clocks agree
+        self.delay = Histogram()
+        self.ipdv = Histogram()
 
-    def process_header(self, buff):
-        '''Process an incoming packet header'''
+    def process_header(self, buff, now=None, size=None):
+        '''Process an incoming packet header, now is the kernel receive
+        timestamp if there is one. size is the length of the packet if
+        buff holds only its start.
+        '''
 
         self.parsed.parse(buff[:12])
-        self.bytes_received = self.bytes_received + len(buff)
+        if size is None:
+            size = len(buff)
+        self.bytes_received = self.bytes_received + size
 
         if self.parsed.packet_count > self.packet_count:
             # seq going forward
@@ -84,7 +201,11 @@ class Counters():
             self.outoforder_packets = self.outoforder_packets + 1
             if self.cnt_error > 0:
                 self.cnt_error = self.cnt_error - 1
-        transit = time.clock_gettime(time.CLOCK_MONOTONIC) - self.parsed.sec - self.parsed.usec / 1E6
+        if now is None:
+            now = time.clock_gettime(time.CLOCK_MONOTONIC)
+        if self.trace is not None:
+            self.trace.record(self.parsed.packet_count, self.parsed.sec, self.parsed.usec, int(now * 1E9))
+        transit = now - self.parsed.sec - self.parsed.usec / 1E6
 
         if self.first_packet:
             self.prev_transit = transit
@@ -93,9 +214,24 @@ class Counters():
         diff = abs(transit - self.prev_transit)
         self.prev_transit = transit
         self.jitter = self.jitter + (diff - self.jitter)/16.0
+        self.delay.record(transit)
+        self.ipdv.record(diff)
+
+    def histograms(self):
+        '''Delay and delay variation distributions for the results'''
+        if self.delay.total == 0:
+            return {}
+        return {"delay": self.delay.percentiles(),
+                "delay_histogram": self.delay.to_json(),
+                "ipdv": self.ipdv.percentiles(),
+                "ipdv_histogram": self.ipdv.to_json()}
 
 class Client():
-    '''Iperf compatible sender/receiver'''
+    '''Iperf compatible sender/receiver. Each stream runs in a thread of
+    its own which is the only one updating its total and counters, the
+    control thread reads them for interval reports and takes the result
+    under the lock once the thread is done.
+    '''
     def __init__(self, config, params, stream_id):
         self.config = config
         self.params = params
@@ -105,74 +241,164 @@ class Client():
             self.buff = bytearray(self.params["len"])
 
         self.length = len(self.buff)
+        self.sink = sink_buffer(self.params, self.sink_size())
+        self.payload = None
+        if self.params.get("verify"):
+            self.payload = Payload(self.params, self.length)
 
         self.counters = Counters()
         self.worker = None
-        self.done = False
+        self.stopping = threading.Event()
         self.result = {"id":stream_id}
         self.total = 0
         self.sock = None
+        self.rx_stamps = None
         self.start_time = 0
         self.lock = threading.Lock()
+        self.stats = None
+        if self.params.get("instrument"):
+            self.stats = StreamStats()
         try:
             self.limit = bandwidth(self.config["bitrate"])
         except KeyError:
             self.limit = 0
 
-    # pylint: disable=unused-argument
+    def reset(self, params):
+        '''Prepare an already connected stream for another test'''
+        self.params = params
+        self.counters = Counters()
+        self.worker = None
+        self.stopping = threading.Event()
+        self.result = {"id":self.result["id"]}
+        self.total = 0
+        self.sink = sink_buffer(self.params, self.sink_size())
+        if self.payload is not None:
+            self.payload.reset()
+        self.stats = None
+        if self.params.get("instrument"):
+            self.stats = StreamStats()
+
+    def can_send(self, now):
+        '''Check if sending now keeps us within the bitrate limit'''
+        return ((not now == self.start_time) and \
+               self.total/(now - self.start_time) <= self.limit or \
+               self.limit == 0)
+
     def send(self, now):
-        '''Send a UDP frame with appropriate information for jitter/delay'''
+        '''Send a frame if the bitrate limit allows it. Returns the
+        bytes sent, 0 on EAGAIN or None if held back by the limit.
+        '''
+        if self.can_send(now):
+            return self.transmit(now)
+        return None
+
+    def pace(self, now, end):
+        '''Sleep until the bitrate limit allows the next frame instead
+        of spinning on the clock
+        '''
+        if self.limit > 0:
+            self.stopping.wait(max(min(self.start_time + self.total / self.limit, end,
+                                       now + PACING_SLICE) - now, 0))
+
+    # pylint: disable=unused-argument
+    def transmit(self, now):
+        '''Transmit a frame'''
         try:
-            if ((not now == self.start_time) and \
-               self.total/(now - self.start_time) <= self.limit or \
-               self.limit == 0):
-                self.total = self.total + self.sock.send(self.buff)
+            if self.payload is not None:
+                sent = self.sock.send(self.payload.chunk(self.length))
+                self.payload.sent(sent)
+            else:
+                sent = self.sock.send(self.buff)
+            self.total = self.total + sent
+            return sent
         except BlockingIOError:
-            pass
+            return 0
+
+    def sink_size(self):
+        '''Bytes drained by one read in sink mode'''
+        return self.length
 
     # pylint: disable=unused-argument
     def receive(self, now):
-        '''Send a UDP frame with appropriate information for jitter/delay'''
+        '''Receive a frame. Returns the bytes received, 0 on EAGAIN'''
         try:
-            self.buff = self.sock.recv(self.length, socket.MSG_DONTWAIT)
-            self.total = self.total + len(self.buff)
+            if self.sink is not None:
+                received = self.sock.recv_into(self.sink, len(self.sink),
+                                               socket.MSG_TRUNC | socket.MSG_DONTWAIT)
+            else:
+                self.buff = self.sock.recv(self.length, socket.MSG_DONTWAIT)
+                received = len(self.buff)
+                if self.payload is not None:
+                    self.check_payload()
+            self.total = self.total + received
+            return received
         except BlockingIOError:
-            pass
+            return 0
+
+    def check_payload(self):
+        '''Verify the payload just received'''
+        self.payload.check_stream(self.buff)
 
     def shutdown(self):
         '''Shutdown the server'''
-        self.done = True
+        self.stopping.set()
         if self.worker is not None:
             self.worker.join()
         self.sock.close()
 
     def run_test(self):
         '''Run the actual test'''
+        self.counters.cpu.begin()
         self.start_time = now = time.clock_gettime(time.CLOCK_MONOTONIC)
+        # params are shared by all streams, the loop only touches locals
+        # and objects of its own stream
+        end = self.start_time + self.params["time"]
+        sender = self.params.get("reverse") is None
         self.lock.acquire()
         try:
-            while now < self.start_time + self.params["time"]:
-                if self.params.get("reverse") is None:
-                    self.send(now)
+            if self.stats is not None:
+                if sender:
+                    operation = self.send
                 else:
+                    operation = self.receive
+                now = self.stats.run(operation, now, end, self)
+            elif sender:
+                while now < end:
+                    if self.send(now) is None:
+                        self.pace(now, end)
+                    now = time.clock_gettime(time.CLOCK_MONOTONIC)
+                    if self.stopping.is_set():
+                        break
+            else:
+                while now < end:
                     self.receive(now)
-                now = time.clock_gettime(time.CLOCK_MONOTONIC)
-                if self.done:
-                    break
+                    now = time.clock_gettime(time.CLOCK_MONOTONIC)
+                    if self.stopping.is_set():
+                        break
         except ConnectionRefusedError:
             pass
         except ConnectionResetError:
             pass
         except BrokenPipeError:
             pass
+        if self.stats is not None:
+            now = self.stats.now
+        self.counters.cpu.end()
 
         self.result.update({"bytes": self.total,
                         "retransmits": 0,
                         "jitter": self.counters.jitter,
                         "errors": self.counters.cnt_error,
                         "packets": self.counters.packet_count,
+                        "out_of_order": self.counters.outoforder_packets,
                         "start_time": 0,
                         "end_time":now - self.start_time})
+        self.result.update(self.counters.histograms())
+        if self.payload is not None and self.params.get("reverse") is not None:
+            self.result.update(self.payload.results())
+        self.result.update(self.counters.cpu.results(now - self.start_time, self.total))
+        if self.stats is not None:
+            self.result["instrumentation"] = self.stats.to_json()
         self.lock.release()
 
     def connect(self):
@@ -180,31 +406,116 @@ class Client():
 
         self.sock.connect((self.config["target"], self.config["data_port"]))
 
+    def begin_connect(self):
+        '''Start establishing the stream. Returns the selector events
+        to wait for, None if the stream is already established.
+        '''
+        self.connect()
+        return None
+
+    def continue_connect(self):
+        '''Progress establishing the stream once its socket is ready.
+        Returns the events to wait for next, None once established.
+        '''
+        return None
+
+    def abandon_connect(self):
+        '''Drop a connection attempt which failed or timed out'''
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
     def start(self):
         '''Run a sender'''
-        self.worker = threading.Thread(target=self.run_test)
+        self.worker = threading.Thread(target=self.run_test, name="stream-{}".format(self.result["id"]))
         self.worker.start()
 
 class UDPClient(Client):
     '''UDP Specific Client'''
 
-    def send(self, now):
-        '''Send a UDP frame with appropriate information for jitter/delay'''
+    def transmit(self, now):
+        '''Send a UDP frame with appropriate information for jitter/delay.
+        The sequence number is consumed only if the frame went out.
+        '''
         self.counters.parsed.packet_count = self.counters.parsed.packet_count + 1
         self.counters.parsed.sec = int(abs(now))
         self.counters.parsed.usec = int((now - self.counters.parsed.sec) * 1E6)
+        if self.payload is not None:
+            self.buff = self.payload.datagram(self.counters.parsed.packet_count)
         self.counters.parsed.pack_into(self.buff)
-        super().send(now)
+        try:
+            sent = self.sock.send(self.buff)
+            self.total = self.total + sent
+            return sent
+        except BlockingIOError:
+            self.counters.parsed.packet_count = self.counters.parsed.packet_count - 1
+            return 0
+
+    def sink_size(self):
+        '''Only the header is read in sink mode, MSG_TRUNC still
+        returns the length of the whole datagram
+        '''
+        return UDP_HEADER_SIZE
+
+    def check_payload(self):
+        '''Verify the payload of the datagram just received'''
+        self.payload.check_datagram(self.buff)
+
+    def received_header(self):
+        '''Buffer holding the start of the last datagram received'''
+        if self.sink is not None:
+            return self.sink
+        return self.buff
 
     def receive(self, now):
-        '''RX a UDP frame with appropriate information for jitter/delay'''
-        super().receive(now)
-        if len(self.buff) > 0:
-            self.counters.process_header(self.buff)
+        '''RX a UDP frame with appropriate information for jitter/delay.
+        Datagrams shorter than a header are late duplicate connect
+        replies to a retried handshake and are dropped.
+        '''
+        if self.rx_stamps is None:
+            received = super().receive(now)
+            if 0 < received < UDP_HEADER_SIZE:
+                self.total = self.total - received
+                return 0
+            if received > 0:
+                self.counters.process_header(self.received_header(), None, received)
+            return received
+        try:
+            #pylint: disable=unused-variable
+            if self.sink is not None:
+                (received, ancdata, flags, addr) = self.sock.recvmsg_into(
+                    [self.sink], ANCBUFSIZE, socket.MSG_TRUNC | socket.MSG_DONTWAIT)
+            else:
+                (self.buff, ancdata, flags, addr) = self.sock.recvmsg(self.length, ANCBUFSIZE,
+                                                                      socket.MSG_DONTWAIT)
+                received = len(self.buff)
+                if self.payload is not None:
+                    self.check_payload()
+        except BlockingIOError:
+            return 0
+        if 0 < received < UDP_HEADER_SIZE:
+            return 0
+        self.total = self.total + received
+        if received > 0:
+            self.counters.process_header(self.received_header(), self.rx_stamps.decode(ancdata),
+                                         received)
+        return received
+
+    def run_test(self):
+        '''Run the test, tracing received packets if asked to'''
+        if self.params.get("reverse") is not None and self.config.get("trace") is not None:
+            self.counters.trace = TraceRecorder(trace_path(self.config["trace"], self.result["id"]),
+                                                self.config.get("trace_records", DEFAULT_RECORDS))
+        try:
+            super().run_test()
+        finally:
+            if self.counters.trace is not None:
+                self.counters.trace.close()
 
     def connect(self):
         '''Connect to the other side'''
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.rx_stamps = rx_timestamps(self.sock)
         super().connect()
         self.sock.send(UDP_CONNECT_MSG)
         if struct.unpack("i", self.sock.recv(4))[0] == 0x39383736:
@@ -212,6 +523,28 @@ class UDPClient(Client):
         self.sock.setblocking(False)
         return False
 
+    def begin_connect(self):
+        '''Send the connect message, retries resend it on the same socket'''
+        if self.sock is None:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.rx_stamps = rx_timestamps(self.sock)
+            self.sock.setblocking(False)
+            super().connect()
+        self.sock.send(UDP_CONNECT_MSG)
+        return selectors.EVENT_READ
+
+    def continue_connect(self):
+        '''Wait for the connect reply'''
+        reply = self.sock.recv(4)
+        if len(reply) == 4 and struct.unpack("i", reply)[0] == UDP_CONNECT_REPLY:
+            # as after connect()
+            self.sock.setblocking(True)
+            return None
+        return selectors.EVENT_READ
+
+    def abandon_connect(self):
+        '''The connect message or its reply was lost, keep the socket'''
+
 class TCPClient(Client):
     '''UDP Specific Client'''
 
@@ -222,3 +555,110 @@ class TCPClient(Client):
         self.sock.send(self.config["cookie"])
         self.sock.setblocking(False)
         return True
+
+    def begin_connect(self):
+        '''Start a non-blocking connect'''
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setblocking(False)
+        result = self.sock.connect_ex((self.config["target"], self.config["data_port"]))
+        if result not in [0, errno.EINPROGRESS]:
+            raise OSError(result, os.strerror(result))
+        return selectors.EVENT_WRITE
+
+    def continue_connect(self):
+        '''Connected, identify the stream to the server'''
+        result = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if result != 0:
+            raise OSError(result, os.strerror(result))
+        self.sock.send(self.config["cookie"])
+        return None
+
+class UnixClient(Client):
+    '''Stream over a UNIX socket, or over a socketpair with a data
+    server in the same process
+    '''
+
+    def connect(self):
+        '''Connect to the other side'''
+        if self.params["local"] == "socketpair":
+            server = LOCAL_SERVERS.get(unix_path(self.config))
+            if server is None:
+                raise ValueError("No data server in this process for socketpair streams")
+            self.sock = server.connect_pair()
+        else:
+            self.sock = socket.socket(socket.AF_UNIX, LOCAL_TYPES[self.params["local"]])
+            self.sock.connect(unix_path(self.config))
+        self.sock.send(self.config["cookie"])
+        self.sock.setblocking(False)
+        return True
+
+class StreamConnector():
+    '''Establish many streams at once. Connects and UDP handshakes are
+    multiplexed in one selector, an attempt which fails or does not
+    complete in time is retried.
+    '''
+    def __init__(self, streams, attempt=CONNECT_ATTEMPT, retries=CONNECT_RETRIES):
+        self.streams = streams
+        self.attempt = attempt
+        self.retries = retries
+        self.selector = selectors.DefaultSelector()
+        self.attempts = {}
+        self.deadlines = {}
+
+    def begin(self, stream, now):
+        '''Start an attempt to establish a stream'''
+        self.attempts[stream] = self.attempts.get(stream, 0) + 1
+        events = stream.begin_connect()
+        if events is not None:
+            self.selector.register(stream.sock, events, stream)
+            self.deadlines[stream] = now + self.attempt
+
+    def fail(self, stream, now, error):
+        '''Retry a stream or give up on the test'''
+        try:
+            self.selector.unregister(stream.sock)
+        except (KeyError, ValueError):
+            pass
+        del self.deadlines[stream]
+        stream.abandon_connect()
+        if self.attempts[stream] > self.retries:
+            raise error
+        self.begin(stream, now)
+
+    def ready(self, stream, now):
+        '''Progress a stream whose socket is ready'''
+        try:
+            events = stream.continue_connect()
+        except BlockingIOError:
+            return
+        except OSError as error:
+            self.fail(stream, now, error)
+            return
+        if events is None:
+            self.selector.unregister(stream.sock)
+            del self.deadlines[stream]
+        else:
+            self.selector.modify(stream.sock, events, stream)
+
+    def run(self):
+        '''Establish all streams'''
+        now = time.clock_gettime(time.CLOCK_MONOTONIC)
+        try:
+            for stream in self.streams:
+                try:
+                    self.begin(stream, now)
+                except OSError as error:
+                    self.deadlines[stream] = now
+                    self.fail(stream, now, error)
+            while len(self.deadlines) > 0:
+                timeout = max(min(self.deadlines.values()) - now, 0)
+                for (key, _) in self.selector.select(timeout):
+                    self.ready(key.data, now)
+                now = time.clock_gettime(time.CLOCK_MONOTONIC)
+                for (stream, deadline) in list(self.deadlines.items()):
+                    if deadline <= now:
+                        self.fail(stream, now, TimeoutError("stream {} did not connect".format(
+                            stream.result["id"])))
+        finally:
+            self.selector.close()
+        return True
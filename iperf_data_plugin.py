@@ -36,7 +36,6 @@ class PluginClient(Client):
                     break
                 if data["final"]:
                     break
-                time.sleep(0.1)
         except BrokenPipeError:
             pass
         self.lock.release()
@@ -9,11 +9,25 @@
 # in the COPYING file in the root directory of this source tree).
 # You may select, at your option, one of the above-listed licenses.
 
+import itertools
+import os
+import socket
 import struct
 import threading
-from socketserver import TCPServer, UDPServer, BaseRequestHandler
-from iperf_data import Counters, UDP_CONNECT_REPLY
+import time
+from socketserver import ThreadingTCPServer, UDPServer, BaseRequestHandler
+from iperf_data import Counters, UDP_CONNECT_MSG, UDP_CONNECT_REPLY, UDP_HEADER_SIZE, ANCBUFSIZE
+from iperf_data import rx_timestamps, sink_buffer, unix_path, LOCAL_TYPES, LOCAL_SERVERS
+from iperf_instrument import StreamStats
+from iperf_cpu import ThreadCPU
+from iperf_trace import TraceRecorder, trace_path, DEFAULT_RECORDS
+from iperf_rr import RRResponder
+from iperf_crr import CRRAcceptor
 from iperf_utils import COOKIE_SIZE
+from iperf_verify import Payload
+
+# streams connect concurrently, the default backlog of 5 drops their SYNs
+LISTEN_BACKLOG = 1024
 
 class UDPRequestHandler(BaseRequestHandler):
     '''Handler for UDP Data'''
@@ -25,77 +39,404 @@ class UDPRequestHandler(BaseRequestHandler):
         addr = "{}:{}".format(self.client_address[0], self.client_address[1])
 
         if buff is not None:
-            if self.server.state.get(addr) is not None:
-                self.server.state[addr].process_header(buff)
-                self.server.bytes_received = self.server.bytes_received + len(buff)
-            else:
-                self.server.state[addr] = Counters()
+            counters = self.server.state.get(addr)
+            if buff == UDP_CONNECT_MSG:
+                # a repeated connect message is a client retry, answer it again
+                if counters is None:
+                    self.connect_stream(addr)
                 self.request[1].sendto(struct.pack("i", UDP_CONNECT_REPLY), self.client_address)
+            elif counters is not None:
+                if self.server.first_data is None:
+                    self.server.data_arrived()
+                if self.server.responder is not None:
+                    counters.bytes_received = counters.bytes_received + len(buff)
+                    counters.packet_count = counters.packet_count + 1
+                    self.server.responder.respond_udp(self.request[1], buff, self.client_address)
+                    return
+                # buff is only the header in sink mode
+                size = self.request[3]
+                counters.process_header(buff, self.request[2], size)
+                if counters.payload is not None:
+                    counters.payload.check_datagram(buff)
+                if counters.stats is not None:
+                    counters.stats.record(size)
+
+    def connect_stream(self, addr):
+        '''Register the stream of a new client address'''
+        counters = self.server.add_stream(addr)
+        if self.server.config.get("trace") is not None:
+            # streams are numbered in the order they connect, as in the results
+            stream_id = len(self.server.state)
+            if stream_id > 1:
+                stream_id = stream_id + 1
+            counters.trace = TraceRecorder(trace_path(self.server.config["trace"], stream_id),
+                                           self.server.config.get("trace_records", DEFAULT_RECORDS))
+
+
+class DataServerMixin():
+    '''Stream tracking common to all data servers. Streams are added by
+    handler threads while the control thread reads them, the stream
+    table is only changed and copied under the lock. The counters of a
+    stream belong to the thread serving it.
+    '''
+
+    def add_stream(self, addr, limit=None):
+        '''Register a new stream and wake up anyone waiting for all of
+        them. With a limit the stream is only added while fewer streams
+        are connected, None is returned otherwise.
+        '''
+        counters = Counters()
+        if self.params.get("instrument"):
+            counters.stats = StreamStats()
+        if self.params.get("verify"):
+            counters.payload = Payload(self.params, self.payload_size())
+        with self.lock:
+            if limit is not None and len(self.state) >= limit:
+                return None
+            self.state[addr] = counters
+            if len(self.state) >= self.params["parallel"]:
+                self.streams_ready.set()
+        return counters
+
+    def streams(self):
+        '''Names and counters of the connected streams in the order they connected'''
+        with self.lock:
+            return list(self.state.items())
+
+    def data_arrived(self):
+        '''Note when the first data of the test arrived, callers check
+        first_data first so the lock is only taken at the start
+        '''
+        with self.lock:
+            if self.first_data is None:
+                self.first_data = time.clock_gettime(time.CLOCK_MONOTONIC)
+
+    def stream_name(self, address):
+        '''Key of the stream connected from address'''
+        return "{}:{}".format(address[0], address[1])
+
+    def payload_size(self):
+        '''Largest datagram or read the payload of a stream is checked in'''
+        return self.max_packet_size
 
+    def wait_for_streams(self, timeout):
+        '''Wait until all streams announced in params have connected'''
+        return self.streams_ready.wait(timeout)
 
-class UDPDataServer(UDPServer):
+    def reset_counters(self):
+        '''Zero the counters of all connected streams'''
+        for (_, counters) in self.streams():
+            counters.reset()
+        self.cpu.rebase()
+        self.first_data = None
+
+    def close_traces(self):
+        '''Finish the packet traces of all streams'''
+        for (_, counters) in self.streams():
+            if counters.trace is not None:
+                counters.trace.close()
+
+    def rearm(self, params):
+        '''Reuse the server for the next test in a session. Streams are
+        kept if the client announced it is reusing them.
+        '''
+        self.params = params
+        self.apply_params()
+        if not params.get("warm_streams"):
+            self.close_traces()
+            with self.lock:
+                self.state = {}
+                self.streams_ready.clear()
+
+    def serve(self):
+        '''Serve requests, accounting the CPU used by the serving thread'''
+        self.cpu.begin()
+        try:
+            self.serve_forever()
+        finally:
+            self.cpu.end()
+
+    def server_close(self):
+        '''Close the listener and any packet traces'''
+        self.close_traces()
+        super().server_close()
+
+    def start(self):
+        '''Run the Server side'''
+        self.worker = threading.Thread(target=self.serve, name=self.name)
+        self.worker.start()
+
+
+class UDPDataServer(DataServerMixin, UDPServer):
     '''Data channel server'''
     def __init__(self, config, params):
         self.config = config
         self.params = params
         self.worker_data = {}
-        self.bytes_received = 0
         self.worker = None
         self.state = {}
-        try:
-            self.max_packet_size = self.params["MSS"]
-        except KeyError:
-            self.max_packet_size = self.params["len"]
+        self.lock = threading.Lock()
+        self.streams_ready = threading.Event()
+        self.first_data = None
+        self.cpu = ThreadCPU()
+        self.name = "UDP"
+        self.apply_params()
 
         super().__init__((config["target"], config["data_port"]), UDPRequestHandler, True)
+        self.rx_stamps = rx_timestamps(self.socket)
 
-    def start(self):
-        '''Run the Server side'''
-        self.worker = threading.Thread(target=self.serve_forever, name="UDP")
-        self.worker.start()
+    def get_request(self):
+        '''Receive a datagram along with its kernel receive timestamp and
+        its length. In sink mode only the header is copied.
+        '''
+        if self.sink is not None:
+            return self.get_header()
+        if self.rx_stamps is None:
+            (data, addr) = self.socket.recvfrom(self.max_packet_size)
+            return ((data, self.socket, None, len(data)), addr)
+        #pylint: disable=unused-variable
+        (data, ancdata, flags, addr) = self.socket.recvmsg(self.max_packet_size, ANCBUFSIZE)
+        return ((data, self.socket, self.rx_stamps.decode(ancdata), len(data)), addr)
 
+    def get_header(self):
+        '''Receive the header of a datagram, MSG_TRUNC discards the rest
+        and returns the length of the whole datagram
+        '''
+        stamp = None
+        if self.rx_stamps is None:
+            (size, addr) = self.socket.recvfrom_into(self.sink, len(self.sink), socket.MSG_TRUNC)
+        else:
+            #pylint: disable=unused-variable
+            (size, ancdata, flags, addr) = self.socket.recvmsg_into([self.sink], ANCBUFSIZE,
+                                                                    socket.MSG_TRUNC)
+            stamp = self.rx_stamps.decode(ancdata)
+        return ((self.sink[:size], self.socket, stamp, size), addr)
+
+    def apply_params(self):
+        '''Size buffers according to params'''
+        try:
+            self.max_packet_size = self.params["MSS"]
+        except KeyError:
+            self.max_packet_size = self.params["len"]
+        self.responder = None
+        if self.params.get("rr"):
+            self.responder = RRResponder(self.params)
+            self.max_packet_size = max(self.max_packet_size, self.responder.request_size)
+        self.sink = None
+        if self.responder is None:
+            self.sink = sink_buffer(self.params, UDP_HEADER_SIZE)
 
 
 class TCPRequestHandler(BaseRequestHandler):
-    '''Handler for UDP Data'''
+    '''Handler for TCP Data'''
 
     def handle(self):
 
-        (buff, addr) = self.request.recvfrom(COOKIE_SIZE)
+        buff = self.request.recv(COOKIE_SIZE)
+        if not buff == self.server.config.get("cookie"):
+            # not a stream of this test, f.e. a control connection for
+            # the next test arriving while the data listener is still up
+            return
+        addr = self.server.stream_name(self.client_address)
 
-        if self.server.state.get(addr) is None:
-            self.server.state[addr] = Counters()
+        counters = self.server.add_stream(addr)
+        counters.cpu.begin()
+        if self.server.responder is not None:
+            self.respond(counters)
+            counters.cpu.end()
+            return
 
+        sink = sink_buffer(self.server.params, self.server.bufsize)
+        if counters.payload is not None:
+            buff = bytearray(self.server.bufsize)
+            view = memoryview(buff)
         while True:
             try:
-                buff = self.request.recv(self.server.bufsize)
-                if buff is not None:
-                    self.server.state[addr].bytes_received = \
-                        self.server.state[addr].bytes_received + len(buff)
+                if sink is not None:
+                    received = self.request.recv_into(sink, self.server.bufsize, socket.MSG_TRUNC)
+                elif counters.payload is not None:
+                    received = self.request.recv_into(buff, self.server.bufsize)
+                else:
+                    received = len(self.request.recv(self.server.bufsize))
+                if received == 0:
+                    break
+                if sink is None and counters.payload is not None:
+                    counters.payload.check_stream(view[:received])
+                if self.server.first_data is None:
+                    self.server.data_arrived()
+                counters.bytes_received = counters.bytes_received + received
+                if counters.stats is not None:
+                    counters.stats.record(received)
             except BlockingIOError:
                 pass
             except ConnectionResetError:
                 break
+        counters.cpu.end()
+
+
+    def respond(self, counters):
+        '''Answer requests until the client closes the stream'''
+        responder = self.server.responder
+        pending = 0
+        while True:
+            try:
+                buff = self.request.recv(self.server.bufsize)
+            except ConnectionResetError:
+                break
+            if len(buff) == 0:
+                break
+            if self.server.first_data is None:
+                self.server.data_arrived()
+            counters.bytes_received = counters.bytes_received + len(buff)
+            pending = responder.respond_tcp(self.request, pending, len(buff))
+            counters.packet_count = counters.bytes_received // responder.request_size
 
 
-class TCPDataServer(TCPServer):
+class TCPDataServer(DataServerMixin, ThreadingTCPServer):
     '''Data channel server'''
     def __init__(self, config, params):
         self.config = config
         self.params = params
         self.worker_data = {}
-        self.bytes_received = 0
         self.worker = None
         self.state = {}
+        self.lock = threading.Lock()
+        self.streams_ready = threading.Event()
+        self.first_data = None
+        self.cpu = ThreadCPU()
+        self.name = "TCP"
+        self.request_queue_size = LISTEN_BACKLOG
         self.allow_reuse_address = True
+        self.daemon_threads = True
+        self.acceptors = None
+        self.crr_done = False
+        self.apply_params()
+        super().__init__(self.data_address(), TCPRequestHandler, True)
+        if params.get("crr"):
+            # further listeners on the same port, the kernel spreads
+            # incoming connections between them
+            listeners = [self.socket]
+            for _ in range(config.get("crr_listeners", 1) - 1):
+                listener = socket.socket(self.address_family, self.socket_type)
+                listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+                listener.bind(self.server_address)
+                listener.listen(self.request_queue_size)
+                listeners.append(listener)
+            self.acceptors = [CRRAcceptor(self, listener) for listener in listeners]
+
+    def data_address(self):
+        '''Address to listen on'''
+        return (self.config["target"], self.config["data_port"])
+
+    def server_bind(self):
+        '''Allow further listeners on the port for connection rate tests'''
+        if self.params.get("crr"):
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        super().server_bind()
+
+    def serve(self):
+        '''Serve connection rate tests with the acceptors, one thread each'''
+        if self.acceptors is None:
+            super().serve()
+            return
+        self.cpu.begin()
+        try:
+            for acceptor in self.acceptors[1:]:
+                acceptor.worker = threading.Thread(target=acceptor.run, name="CRR")
+                acceptor.worker.start()
+            self.acceptors[0].run()
+            for acceptor in self.acceptors[1:]:
+                acceptor.worker.join()
+        finally:
+            self.cpu.end()
+
+    def shutdown(self):
+        '''Stop serving'''
+        if self.acceptors is None:
+            super().shutdown()
+            return
+        self.crr_done = True
+
+    def server_close(self):
+        '''Close the listeners'''
+        if self.acceptors is not None:
+            for acceptor in self.acceptors[1:]:
+                acceptor.listener.close()
+        super().server_close()
+
+    def reset_counters(self):
+        '''Zero the counters of all connected streams and acceptors'''
+        super().reset_counters()
+        if self.acceptors is not None:
+            for acceptor in self.acceptors:
+                acceptor.connections = 0
+                acceptor.bytes = 0
+
+    def payload_size(self):
+        '''Reads are checked in one piece'''
+        return self.bufsize
+
+    def crr_totals(self):
+        '''Connections answered by all acceptors'''
+        return {"connections": sum([acceptor.connections for acceptor in self.acceptors]),
+                "bytes": sum([acceptor.bytes for acceptor in self.acceptors])}
+
+    def apply_params(self):
+        '''Size buffers according to params'''
         try:
             self.bufsize = self.params["MSS"]
         except KeyError:
             self.bufsize = self.params["len"]
-        super().__init__((config["target"], config["data_port"]), TCPRequestHandler, True)
+        self.responder = None
+        if self.params.get("rr"):
+            self.responder = RRResponder(self.params)
 
-    def start(self):
-        '''Run the Server side'''
+class UnixDataServer(TCPDataServer):
+    '''Data server for local transports. Streams connect to a UNIX socket
+    or, for socketpair streams, are handed over directly by a client in
+    the same process. Streams are accounted as for TCP.
+    '''
+    address_family = socket.AF_UNIX
 
-        self.worker = threading.Thread(target=self.serve_forever, name="UDP")
-        self.worker.start()
+    def __init__(self, config, params):
+        self.socket_type = LOCAL_TYPES[params["local"]]
+        self.path = unix_path(config)
+        self.stream_ids = itertools.count(1)
+        super().__init__(config, params)
+        self.name = "UNIX"
+        if params["local"] == "socketpair":
+            LOCAL_SERVERS[self.path] = self
+
+    def data_address(self):
+        '''Path to listen on'''
+        return self.path
+
+    def server_bind(self):
+        '''Replace a socket left behind by a previous server'''
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+        super().server_bind()
+
+    def stream_name(self, address):
+        '''UNIX socket peers are unnamed, number the streams instead'''
+        return "unix:{}".format(next(self.stream_ids))
+
+    def connect_pair(self):
+        '''Connect a stream of a client in this process, returns the
+        client end of the pair
+        '''
+        (server_end, client_end) = socket.socketpair(socket.AF_UNIX, self.socket_type)
+        self.process_request(server_end, "")
+        return client_end
+
+    def server_close(self):
+        '''Close the listener and remove its socket'''
+        super().server_close()
+        if LOCAL_SERVERS.get(self.path) is self:
+            del LOCAL_SERVERS[self.path]
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,126 @@
+#!/usr/bin/python3
+'''Iperf fixed memory latency histograms'''
+
+# pyiperf, Copyright (c) 2023 RedHat Inc
+# pyiperf, Copyright (c) 2023 Cambridge Greys Ltd
+
+# This source code is licensed under both the BSD-style license (found in the
+# LICENSE file in the root directory of this source tree) and the GPLv2 (found
+# in the COPYING file in the root directory of this source tree).
+# You may select, at your option, one of the above-listed licenses.
+
+from array import array
+
+# Each power of two is split into 2^SUB_BITS linear buckets giving
+# a worst case relative error of 1/2^SUB_BITS (~3%)
+SUB_BITS = 5
+SUB_COUNT = 1 << SUB_BITS
+# Values are recorded in microseconds, up to 2^MAX_BITS (~71 minutes)
+MAX_BITS = 32
+MAX_VALUE = (1 << MAX_BITS) - 1
+BUCKETS = (MAX_BITS - SUB_BITS + 1) * SUB_COUNT
+UNIT = 1E-6
+
+PERCENTILES = [50, 90, 99, 99.9]
+
+def bucket_index(value):
+    '''Map a non-negative integer value to its bucket'''
+    if value < 2 * SUB_COUNT:
+        return value
+    shift = value.bit_length() - SUB_BITS - 1
+    return shift * SUB_COUNT + (value >> shift)
+
+def bucket_value(index):
+    '''Midpoint of the values mapped to a bucket'''
+    if index < 2 * SUB_COUNT:
+        return index
+    shift = index // SUB_COUNT - 1
+    mantissa = index - shift * SUB_COUNT
+    return (mantissa << shift) + ((1 << shift) >> 1)
+
+class Histogram():
+    '''Log bucketed (HDR style) histogram of durations. Memory use
+    is fixed and recording a value does not allocate.
+    '''
+    def __init__(self):
+        self.counts = array("q", bytes(8 * BUCKETS))
+        self.total = 0
+        self.min = MAX_VALUE
+        self.max = 0
+
+    def reset(self):
+        '''Clear the histogram'''
+        for index in range(BUCKETS):
+            self.counts[index] = 0
+        self.total = 0
+        self.min = MAX_VALUE
+        self.max = 0
+
+    def record(self, seconds):
+        '''Record a duration given in seconds'''
+        value = int(seconds / UNIT)
+        if value < 0:
+            value = 0
+        elif value > MAX_VALUE:
+            value = MAX_VALUE
+        self.counts[bucket_index(value)] += 1
+        self.total = self.total + 1
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        '''Add the counts from another histogram'''
+        for index in range(BUCKETS):
+            self.counts[index] += other.counts[index]
+        self.total = self.total + other.total
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    def percentile(self, percent):
+        '''Value in seconds below which percent of the samples fall'''
+        if self.total == 0:
+            return 0.0
+        target = self.total * percent / 100
+        seen = 0
+        for index in range(BUCKETS):
+            seen = seen + self.counts[index]
+            if seen >= target and seen > 0:
+                return min(max(bucket_value(index), self.min), self.max) * UNIT
+        return self.max * UNIT
+
+    def percentiles(self):
+        '''Summary of the common percentiles'''
+        return {"p{}".format(percent): self.percentile(percent) for percent in PERCENTILES}
+
+    def to_json(self):
+        '''Compact form for the result exchange - non-empty buckets only'''
+        return {"unit": UNIT,
+                "sub_bits": SUB_BITS,
+                "min": self.min,
+                "max": self.max,
+                "buckets": [[index, self.counts[index]]
+                            for index in range(BUCKETS) if self.counts[index] > 0]}
+
+    @classmethod
+    def from_json(cls, data):
+        '''Rebuild a histogram received in results'''
+        histogram = cls()
+        for (index, count) in data["buckets"]:
+            histogram.counts[index] = count
+            histogram.total = histogram.total + count
+        histogram.min = data["min"]
+        histogram.max = data["max"]
+        return histogram
+
+def merge_histograms(streams, key):
+    '''Merge the histograms stored under key in a list of stream results'''
+    merged = None
+    for stream in streams:
+        if stream.get(key) is None:
+            continue
+        if merged is None:
+            merged = Histogram()
+        merged.merge(Histogram.from_json(stream[key]))
+    return merged
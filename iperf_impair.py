@@ -0,0 +1,508 @@
+#!/usr/bin/python3
+'''Iperf network impairment proxy'''
+
+# pyiperf, Copyright (c) 2023 RedHat Inc
+# pyiperf, Copyright (c) 2023 Cambridge Greys Ltd
+
+# This source code is licensed under both the BSD-style license (found in the
+# LICENSE file in the root directory of this source tree) and the GPLv2 (found
+# in the COPYING file in the root directory of this source tree).
+# You may select, at your option, one of the above-listed licenses.
+
+from argparse import ArgumentParser
+import heapq
+import itertools
+import math
+import queue
+import random
+import selectors
+import socket
+import threading
+import time
+from iperf_data import UDP_HEADER_SIZE
+from iperf_utils import bandwidth
+
+# UDP datagrams read from one socket before looking at the others
+BATCH = 256
+# random values generated at a time for each schedule
+SCHEDULE_BLOCK = 4096
+# select timeout, bounds the time it takes to notice a stop
+POLL = 0.1
+# TCP relay, bytes read at a time and chunks in flight per direction
+TCP_CHUNK = 65536
+TCP_QUEUE = 64
+# longest the relay loop waits for the server to accept a TCP connection
+CONNECT_TIMEOUT = 1.0
+# default extra delay in seconds for a reordered packet
+DEFAULT_REORDER_DELAY = 0.001
+# default rate limiter queue in seconds, packets beyond it are tail dropped
+DEFAULT_QUEUE = 0.1
+MAX_DATAGRAM = 65536
+
+class Events():
+    '''Seeded schedule of the packets which an event with probability
+    chance applies to. The gaps between events are drawn from the
+    geometric distribution ahead of time, so checking a packet is a
+    single comparison.
+    '''
+    def __init__(self, chance, rng):
+        self.chance = chance
+        self.rng = rng
+        self.gaps = []
+        self.next_event = math.inf
+        if chance > 0:
+            self.next_event = self.gap()
+
+    def gap(self):
+        '''Packets until the next event'''
+        if self.chance >= 1:
+            return 1
+        if len(self.gaps) == 0:
+            scale = math.log(1 - self.chance)
+            self.gaps = [int(math.log(1 - self.rng.random()) / scale) + 1 for _ in range(SCHEDULE_BLOCK)]
+            self.gaps.reverse()
+        return self.gaps.pop()
+
+    def hit(self, index):
+        '''The event applies to packet index'''
+        if index < self.next_event:
+            return False
+        self.next_event = self.next_event + self.gap()
+        return True
+
+class Impairment():
+    '''Loss, duplication, reordering, delay and rate limit for one
+    direction of traffic. Probabilities are fractions, times are in
+    seconds, rate is in bits/s with 0 meaning unlimited. The same seed
+    gives the same decisions for the same packet sequence.
+    '''
+
+    # pylint: disable=too-many-instance-attributes,too-many-arguments
+    def __init__(self, loss=0, duplicate=0, reorder=0, delay=0, jitter=0, rate=0,
+                 queue_time=DEFAULT_QUEUE, reorder_delay=DEFAULT_REORDER_DELAY, seed=None):
+        self.delay = delay
+        self.jitter = jitter
+        self.rate = rate
+        self.queue_time = queue_time
+        self.reorder_delay = reorder_delay
+        # every datagram has to be queued, there is no fast path
+        self.shaped = delay > 0 or jitter > 0 or rate > 0
+        rng = random.Random(seed)
+        self.events = [Events(loss, rng), Events(duplicate, rng), Events(reorder, rng)]
+        self.next_event = min([events.next_event for events in self.events])
+        self.rng = rng
+        self.jitters = []
+        self.link_free = 0
+        self.lock = threading.Lock()
+        self.packets = 0
+        self.bytes = 0
+        self.dropped = 0
+        self.duplicated = 0
+        self.reordered = 0
+        self.queue_dropped = 0
+        self.stream_bytes = 0
+
+    def counters(self):
+        '''Injected impairment counts'''
+        return {"packets": self.packets, "bytes": self.bytes, "dropped": self.dropped,
+                "duplicated": self.duplicated, "reordered": self.reordered,
+                "queue_dropped": self.queue_dropped, "stream_bytes": self.stream_bytes}
+
+    def passes(self, size):
+        '''Count a datagram which goes out at once and unchanged, False if
+        it has to be scheduled instead
+        '''
+        if self.shaped or self.packets >= self.next_event:
+            return False
+        self.packets = self.packets + 1
+        self.bytes = self.bytes + size
+        return True
+
+    def transit(self):
+        '''Delay plus jitter for the next packet'''
+        if self.jitter == 0:
+            return self.delay
+        if len(self.jitters) == 0:
+            self.jitters = [self.rng.uniform(-self.jitter, self.jitter) for _ in range(SCHEDULE_BLOCK)]
+        return max(0, self.delay + self.jitters.pop())
+
+    def serialize(self, now, size):
+        '''Time the packet leaves the rate limiter, None if the queue is full'''
+        if self.rate == 0:
+            return now
+        start = max(self.link_free, now)
+        if start - now > self.queue_time:
+            self.queue_dropped = self.queue_dropped + 1
+            return None
+        self.link_free = start + size * 8 / self.rate
+        return self.link_free
+
+    def schedule(self, now, size):
+        '''Due times of the copies of a datagram, empty if it is dropped'''
+        with self.lock:
+            index = self.packets
+            self.packets = index + 1
+            self.bytes = self.bytes + size
+            (loss, duplicate, reorder) = [events.hit(index) for events in self.events]
+            self.next_event = min([events.next_event for events in self.events])
+            if loss:
+                self.dropped = self.dropped + 1
+                return []
+            copies = 1
+            if duplicate:
+                self.duplicated = self.duplicated + 1
+                copies = 2
+            extra = 0
+            if reorder:
+                self.reordered = self.reordered + 1
+                extra = self.reorder_delay
+            due = []
+            for _ in range(copies):
+                sent = self.serialize(now, size)
+                if sent is not None:
+                    due.append(sent + self.transit() + extra)
+            return due
+
+    def pace(self, now, size):
+        '''Due time of a chunk of a byte stream. Only delay and rate apply,
+        jitter never reorders a stream.
+        '''
+        with self.lock:
+            self.stream_bytes = self.stream_bytes + size
+            if self.rate > 0:
+                self.link_free = max(self.link_free, now) + size * 8 / self.rate
+            return max(self.link_free, now) + self.transit()
+
+class TCPPipe():
+    '''Relay one direction of a TCP connection. The reader and writer
+    threads are decoupled by a bounded queue, so delay does not reduce
+    throughput and a slow receiver pushes back on the sender.
+    '''
+    def __init__(self, source, sink, impairment, finished):
+        self.source = source
+        self.sink = sink
+        self.impairment = impairment
+        self.finished = finished
+        self.chunks = queue.Queue(TCP_QUEUE)
+        self.threads = [threading.Thread(target=self.reader, name="impair-rx", daemon=True),
+                        threading.Thread(target=self.writer, name="impair-tx", daemon=True)]
+        for thread in self.threads:
+            thread.start()
+
+    def reader(self):
+        '''Read from the source and schedule the chunks'''
+        while True:
+            try:
+                data = self.source.recv(TCP_CHUNK)
+            except OSError:
+                data = b''
+            if len(data) == 0:
+                self.chunks.put(None)
+                return
+            self.chunks.put((self.impairment.pace(time.monotonic(), len(data)), data))
+
+    def writer(self):
+        '''Write the chunks to the sink when they are due. Once the sink
+        fails the rest is discarded, so the reader never blocks on a full
+        queue.
+        '''
+        failed = False
+        while True:
+            chunk = self.chunks.get()
+            if chunk is None:
+                break
+            if failed:
+                continue
+            wait = chunk[0] - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            try:
+                self.sink.sendall(chunk[1])
+            except OSError:
+                failed = True
+        try:
+            self.sink.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass
+        self.finished()
+
+class TCPRelay():
+    '''Both directions of a relayed TCP connection, the sockets are
+    closed once both pipes have finished
+    '''
+    def __init__(self, client, server, forward, reverse):
+        self.sockets = [client, server]
+        self.lock = threading.Lock()
+        self.running = 2
+        self.pipes = [TCPPipe(client, server, forward, self.finished),
+                      TCPPipe(server, client, reverse, self.finished)]
+
+    def finished(self):
+        '''A pipe has finished, close the sockets after the last one'''
+        with self.lock:
+            self.running = self.running - 1
+            if self.running > 0:
+                return
+        for sock in self.sockets:
+            sock.close()
+
+    def abort(self):
+        '''Wake up both pipes, they finish and close the sockets'''
+        for sock in self.sockets:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+def transmit(sock, data, addr):
+    '''Send a datagram on a connected socket if addr is None'''
+    try:
+        if addr is None:
+            sock.send(data)
+        else:
+            sock.sendto(data, addr)
+    except OSError:
+        pass
+
+class ImpairmentProxy():
+    '''Userspace relay between an iperf client and server. TCP
+    connections and UDP flows arriving on the listen port are forwarded
+    to the server port. UDP datagrams are impaired, TCP streams are only
+    delayed and rate limited. The 4 byte UDP stream setup messages are
+    never impaired so stream setup does not skew the counts.
+    '''
+
+    # pylint: disable=too-many-instance-attributes
+    def __init__(self, listen, target, forward, reverse):
+        self.target = target
+        self.forward = forward
+        self.reverse = reverse
+        self.running = True
+        self.pending = []
+        self.sequence = itertools.count()
+        self.flows = {}
+        self.clients = {}
+        self.relays = []
+        self.selector = selectors.DefaultSelector()
+        self.tcp_listener = socket.create_server(listen, reuse_port=True)
+        self.tcp_listener.setblocking(False)
+        self.selector.register(self.tcp_listener, selectors.EVENT_READ, self.accept)
+        self.udp_listener = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.udp_listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.udp_listener.bind(listen)
+        self.udp_listener.setblocking(False)
+        self.selector.register(self.udp_listener, selectors.EVENT_READ, self.from_client)
+
+    def accept(self, sock):
+        '''Relay a new TCP connection'''
+        try:
+            (client, _) = sock.accept()
+        except BlockingIOError:
+            return
+        client.setblocking(True)
+        try:
+            server = socket.create_connection(self.target, CONNECT_TIMEOUT)
+        except OSError:
+            # the server is down or slow, drop this connection and keep relaying
+            client.close()
+            return
+        server.settimeout(None)
+        for conn in [client, server]:
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.relays = [relay for relay in self.relays if relay.running > 0]
+        self.relays.append(TCPRelay(client, server, self.forward, self.reverse))
+
+    def submit(self, impairment, data, sock, addr):
+        '''Impair a datagram and send or queue its copies'''
+        if len(data) < UDP_HEADER_SIZE or impairment.passes(len(data)):
+            transmit(sock, data, addr)
+            return
+        now = time.monotonic()
+        for due in impairment.schedule(now, len(data)):
+            if due <= now:
+                transmit(sock, data, addr)
+            else:
+                heapq.heappush(self.pending, (due, next(self.sequence), data, sock, addr))
+
+    def from_client(self, sock):
+        '''Forward datagrams from clients, each client address gets its
+        own upstream socket so the server still sees one flow per stream
+        '''
+        for _ in range(BATCH):
+            try:
+                (data, addr) = sock.recvfrom(MAX_DATAGRAM)
+            except BlockingIOError:
+                return
+            upstream = self.flows.get(addr)
+            if upstream is None:
+                upstream = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                upstream.connect(self.target)
+                upstream.setblocking(False)
+                self.flows[addr] = upstream
+                self.clients[upstream] = addr
+                self.selector.register(upstream, selectors.EVENT_READ, self.from_server)
+            self.submit(self.forward, data, upstream, None)
+
+    def from_server(self, sock):
+        '''Return datagrams from the server to the client of the flow'''
+        addr = self.clients[sock]
+        for _ in range(BATCH):
+            try:
+                data = sock.recv(MAX_DATAGRAM)
+            except (BlockingIOError, ConnectionRefusedError):
+                return
+            self.submit(self.reverse, data, self.udp_listener, addr)
+
+    def flush(self):
+        '''Send the queued datagrams which are due'''
+        now = time.monotonic()
+        while len(self.pending) > 0 and self.pending[0][0] <= now:
+            (_, _, data, sock, addr) = heapq.heappop(self.pending)
+            transmit(sock, data, addr)
+
+    def run(self):
+        '''Relay until stopped'''
+        while self.running:
+            timeout = POLL
+            if len(self.pending) > 0:
+                timeout = min(POLL, max(0, self.pending[0][0] - time.monotonic()))
+            for (key, _) in self.selector.select(timeout):
+                key.data(key.fileobj)
+            self.flush()
+
+    def stop(self):
+        '''Stop relaying'''
+        self.running = False
+
+    def close(self):
+        '''Release all sockets, relayed TCP connections are cut'''
+        for relay in self.relays:
+            relay.abort()
+        self.relays = []
+        for sock in [self.tcp_listener, self.udp_listener] + list(self.flows.values()):
+            self.selector.unregister(sock)
+            sock.close()
+        self.flows = {}
+        self.clients = {}
+        self.selector.close()
+
+    def stats(self):
+        '''Injected impairment counts for each direction'''
+        return {"forward": self.forward.counters(), "reverse": self.reverse.counters()}
+
+def main():
+    '''Relay iperf traffic with injected loss, duplication, reordering, delay and rate limits'''
+
+    aparser = ArgumentParser(description=main.__doc__)
+    aparser.add_argument(
+        '--listen',
+        help='address to listen on, default localhost',
+        type=str,
+        default="localhost")
+
+    aparser.add_argument(
+        '-l', '--listen-port',
+        help='port to listen on, point the client here',
+        type=int,
+        required=True)
+
+    aparser.add_argument(
+        '--target',
+        help='server address, default localhost',
+        type=str,
+        default="localhost")
+
+    aparser.add_argument(
+        '-p', '--port',
+        help='server port',
+        type=int,
+        default=5201)
+
+    aparser.add_argument(
+        '--loss',
+        help='UDP datagrams to drop in percent',
+        type=float,
+        default=0)
+
+    aparser.add_argument(
+        '--duplicate',
+        help='UDP datagrams to duplicate in percent',
+        type=float,
+        default=0)
+
+    aparser.add_argument(
+        '--reorder',
+        help='UDP datagrams to hold back by --reorder-delay in percent',
+        type=float,
+        default=0)
+
+    aparser.add_argument(
+        '--reorder-delay',
+        help='extra delay of a reordered datagram in ms, default 1',
+        type=float,
+        default=DEFAULT_REORDER_DELAY * 1E3)
+
+    aparser.add_argument(
+        '--delay',
+        help='one way delay in ms',
+        type=float,
+        default=0)
+
+    aparser.add_argument(
+        '--jitter',
+        help='uniform delay variation in ms, may reorder UDP datagrams',
+        type=float,
+        default=0)
+
+    aparser.add_argument(
+        '--rate',
+        help='rate limit in bits/s [KMG], default unlimited',
+        type=str,
+        default=None)
+
+    aparser.add_argument(
+        '--queue',
+        help='rate limiter queue in ms, default 100',
+        type=float,
+        default=DEFAULT_QUEUE * 1E3)
+
+    aparser.add_argument(
+        '--reverse',
+        help='impair the server to client direction as well',
+        action='store_true')
+
+    aparser.add_argument(
+        '--seed',
+        help='random seed, default 0',
+        type=int,
+        default=0)
+
+    args = vars(aparser.parse_args())
+
+    rate = 0
+    if args["rate"] is not None:
+        rate = bandwidth(args["rate"]) * 8
+    impairments = []
+    for direction in range(2):
+        if direction == 1 and not args["reverse"]:
+            impairments.append(Impairment())
+            continue
+        impairments.append(Impairment(args["loss"] / 100, args["duplicate"] / 100,
+                                      args["reorder"] / 100, args["delay"] / 1E3,
+                                      args["jitter"] / 1E3, rate, args["queue"] / 1E3,
+                                      args["reorder_delay"] / 1E3, args["seed"] + direction))
+
+    proxy = ImpairmentProxy((args["listen"], args["listen_port"]), (args["target"], args["port"]),
+                            impairments[0], impairments[1])
+    try:
+        proxy.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        proxy.close()
+    for (direction, counters) in proxy.stats().items():
+        print("{:<8} {}".format(direction, " ".join(["{} {}".format(key, value)
+                                                    for (key, value) in counters.items()])))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+#!/usr/bin/python3
+'''Iperf hot path instrumentation'''
+
+# pyiperf, Copyright (c) 2023 RedHat Inc
+# pyiperf, Copyright (c) 2023 Cambridge Greys Ltd
+
+# This source code is licensed under both the BSD-style license (found in the
+# LICENSE file in the root directory of this source tree) and the GPLv2 (found
+# in the COPYING file in the root directory of this source tree).
+# You may select, at your option, one of the above-listed licenses.
+
+import time
+
+class StreamStats():
+    '''Per stream loop and syscall counters. Streams without
+    instrumentation do not have one of these and run the plain loop.
+    '''
+    __slots__ = ["loops", "calls", "eagain", "bytes", "throttled", "max_stall", "last_io", "now"]
+
+    def __init__(self):
+        self.loops = 0
+        self.calls = 0
+        self.eagain = 0
+        self.bytes = 0
+        self.throttled = 0.0
+        self.max_stall = 0.0
+        self.last_io = None
+        self.now = 0.0
+
+    def run(self, operation, now, end, stream):
+        '''Instrumented version of the stream loop. Operation returns
+        the number of bytes moved, 0 on EAGAIN or None if the bitrate
+        limit held it back.
+        '''
+        self.last_io = self.now = now
+        while now < end:
+            result = operation(now)
+            after = time.clock_gettime(time.CLOCK_MONOTONIC)
+            self.loops = self.loops + 1
+            if result is None:
+                self.throttled = self.throttled + after - now
+            elif result == 0:
+                self.eagain = self.eagain + 1
+            else:
+                self.calls = self.calls + 1
+                self.bytes = self.bytes + result
+                if after - self.last_io > self.max_stall:
+                    self.max_stall = after - self.last_io
+                self.last_io = after
+            now = self.now = after
+            if stream.stopping.is_set():
+                break
+        return now
+
+    def record(self, nbytes):
+        '''Account one successful call made by a data server handler'''
+        now = time.clock_gettime(time.CLOCK_MONOTONIC)
+        self.loops = self.loops + 1
+        self.calls = self.calls + 1
+        self.bytes = self.bytes + nbytes
+        if self.last_io is not None and now - self.last_io > self.max_stall:
+            self.max_stall = now - self.last_io
+        self.last_io = now
+
+    def to_json(self):
+        '''Counters for the results'''
+        bytes_per_call = 0.0
+        if self.calls > 0:
+            bytes_per_call = self.bytes / self.calls
+        return {"loops": self.loops,
+                "calls": self.calls,
+                "eagain": self.eagain,
+                "bytes_per_call": bytes_per_call,
+                "throttled": self.throttled,
+                "max_stall": self.max_stall}
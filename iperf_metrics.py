@@ -0,0 +1,157 @@
+#!/usr/bin/python3
+'''Iperf OpenMetrics exporter'''
+
+# pyiperf, Copyright (c) 2023 RedHat Inc
+# pyiperf, Copyright (c) 2023 Cambridge Greys Ltd
+
+# This source code is licensed under both the BSD-style license (found in the
+# LICENSE file in the root directory of this source tree) and the GPLv2 (found
+# in the COPYING file in the root directory of this source tree).
+# You may select, at your option, one of the above-listed licenses.
+
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import psutil
+
+CONTENT_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+PREFIX = "pyiperf"
+PROTOCOLS = ["tcp", "udp"]
+
+def protocol(params):
+    '''Protocol label for a test'''
+    if params is not None and params.get("udp"):
+        return "udp"
+    return "tcp"
+
+class ServerMetrics():
+    '''Metrics for a long running server. Cumulative counters are
+    updated once per test when it completes, live values are read
+    from the counters of the active data servers when scraped.
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sessions = {}
+        self.totals = {}
+        for proto in PROTOCOLS:
+            self.totals[proto] = {"tests": 0,
+                                  "bytes": 0,
+                                  "packets": 0,
+                                  "lost": 0,
+                                  "duration": 0.0}
+        self.created = time.time()
+        self.process = psutil.Process()
+
+    def session_started(self, server):
+        '''A test has started on server'''
+        with self.lock:
+            self.sessions[id(server)] = server
+
+    def session_ended(self, server):
+        '''A test on server has completed, add its results to the totals'''
+        with self.lock:
+            if self.sessions.pop(id(server), None) is None:
+                return
+            if server.results is None:
+                return
+            totals = self.totals[protocol(server.params)]
+            totals["tests"] = totals["tests"] + 1
+            for stream in server.results["streams"]:
+                totals["bytes"] = totals["bytes"] + stream.get("bytes", 0)
+                totals["packets"] = totals["packets"] + stream.get("packets", 0)
+                totals["lost"] = totals["lost"] + stream.get("errors", 0)
+            if server.timestamps.get("start") is not None:
+                totals["duration"] = totals["duration"] + \
+                    time.clock_gettime(time.CLOCK_MONOTONIC) - server.timestamps["start"]
+
+    def render(self):
+        '''Produce the metrics in OpenMetrics text format'''
+        lines = []
+        with self.lock:
+            for (name, kind, key, help_text) in [
+                    ("tests", "counter", "tests", "Completed tests"),
+                    ("received_bytes", "counter", "bytes", "Bytes received by completed tests"),
+                    ("received_packets", "counter", "packets", "Highest sequence numbers seen by completed tests"),
+                    ("lost_packets", "counter", "lost", "Packets lost in completed tests")]:
+                lines.append("# TYPE {}_{} {}".format(PREFIX, name, kind))
+                lines.append("# HELP {}_{} {}".format(PREFIX, name, help_text))
+                for proto in PROTOCOLS:
+                    lines.append('{}_{}_total{{protocol="{}"}} {}'.format(
+                        PREFIX, name, proto, self.totals[proto][key]))
+
+            lines.append("# TYPE {}_test_duration_seconds summary".format(PREFIX))
+            lines.append("# HELP {}_test_duration_seconds Duration of completed tests".format(PREFIX))
+            for proto in PROTOCOLS:
+                lines.append('{}_test_duration_seconds_count{{protocol="{}"}} {}'.format(
+                    PREFIX, proto, self.totals[proto]["tests"]))
+                lines.append('{}_test_duration_seconds_sum{{protocol="{}"}} {}'.format(
+                    PREFIX, proto, self.totals[proto]["duration"]))
+
+            lines.append("# TYPE {}_active_sessions gauge".format(PREFIX))
+            lines.append("# HELP {}_active_sessions Tests in progress".format(PREFIX))
+            lines.append("{}_active_sessions {}".format(PREFIX, len(self.sessions)))
+
+            live = []
+            for server in self.sessions.values():
+                data_server = server.test_server
+                if data_server is None:
+                    continue
+                cookie = server.config.get("cookie", b"")
+                if isinstance(cookie, bytes):
+                    cookie = cookie.decode("ascii", "ignore")
+                for (stream, counters) in data_server.streams():
+                    live.append(('session="{}",stream="{}",protocol="{}"'.format(
+                        cookie, stream, protocol(server.params)), counters))
+
+        for (name, kind, attr, help_text) in [
+                ("session_received_bytes", "gauge", "bytes_received", "Bytes received so far"),
+                ("session_received_packets", "gauge", "packet_count", "Highest sequence number received"),
+                ("session_lost_packets", "gauge", "cnt_error", "Packets lost so far"),
+                ("session_jitter_seconds", "gauge", "jitter", "Smoothed jitter")]:
+            lines.append("# TYPE {}_{} {}".format(PREFIX, name, kind))
+            lines.append("# HELP {}_{} {}".format(PREFIX, name, help_text))
+            for (labels, counters) in live:
+                lines.append("{}_{}{{{}}} {}".format(PREFIX, name, labels, getattr(counters, attr)))
+
+        cpu = self.process.cpu_times()
+        lines.append("# TYPE {}_process_cpu_seconds counter".format(PREFIX))
+        lines.append("# HELP {}_process_cpu_seconds CPU time used by the server".format(PREFIX))
+        lines.append('{}_process_cpu_seconds_total{{mode="user"}} {}'.format(PREFIX, cpu.user))
+        lines.append('{}_process_cpu_seconds_total{{mode="system"}} {}'.format(PREFIX, cpu.system))
+        lines.append("# EOF")
+        return ("\n".join(lines) + "\n").encode("utf-8")
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    '''Serve /metrics'''
+
+    # pylint: disable=invalid-name
+    def do_GET(self):
+        '''Handle a scrape'''
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = self.server.metrics.render()
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    # pylint: disable=redefined-builtin
+    def log_message(self, format, *args):
+        '''Scrapes are not logged'''
+
+class MetricsServer(ThreadingHTTPServer):
+    '''Local HTTP endpoint exposing ServerMetrics'''
+
+    daemon_threads = True
+
+    def __init__(self, metrics, port, address="127.0.0.1"):
+        self.metrics = metrics
+        self.worker = None
+        super().__init__((address, port), MetricsRequestHandler)
+
+    def start(self):
+        '''Serve in the background'''
+        self.worker = threading.Thread(target=self.serve_forever, name="metrics", daemon=True)
+        self.worker.start()
@@ -0,0 +1,306 @@
+#!/usr/bin/python3
+'''Iperf UDP multicast fan-out'''
+
+# pyiperf, Copyright (c) 2023 RedHat Inc
+# pyiperf, Copyright (c) 2023 Cambridge Greys Ltd
+
+# This source code is licensed under both the BSD-style license (found in the
+# LICENSE file in the root directory of this source tree) and the GPLv2 (found
+# in the COPYING file in the root directory of this source tree).
+# You may select, at your option, one of the above-listed licenses.
+
+from argparse import ArgumentParser
+import ipaddress
+import json
+import selectors
+import socket
+import sys
+import threading
+import time
+from iperf_data import UDPClient, Counters, UDP_HEADER_SIZE, ANCBUFSIZE, rx_timestamps
+from iperf_cpu import ThreadCPU
+from iperf_histogram import merge_histograms
+from iperf_verify import Payload
+
+# datagram size, iperf2 uses the same default for multicast
+MULTICAST_LEN = 1470
+DEFAULT_TTL = 1
+# a receiver considers a test over this long after its last datagram
+IDLE_TIMEOUT = 2.0
+# time for in-process receivers to drain their sockets after the senders stop
+LINGER = 0.2
+POLL = 0.1
+RCVBUF = 1 << 24
+MAX_DATAGRAM = 65536
+
+def is_multicast(address):
+    '''The address is an IPv4 multicast group'''
+    try:
+        return ipaddress.IPv4Address(address).is_multicast
+    except ValueError:
+        return False
+
+def is_multicast6(address):
+    '''The address is an IPv6 multicast group, which is not supported'''
+    try:
+        return ipaddress.IPv6Address(address).is_multicast
+    except ValueError:
+        return False
+
+def multicast_params(config, params):
+    '''Datagram size for multicast, there is no control connection to
+    take it from the MSS
+    '''
+    params["MSS"] = config.get("multicast_len", MULTICAST_LEN)
+    return params
+
+class MulticastClient(UDPClient):
+    '''Sends one stream to a multicast group. There is no handshake,
+    receivers pick up a stream when its first datagram arrives.
+    '''
+
+    def connect(self):
+        '''Set up the socket to send to the group'''
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL,
+                             self.config.get("ttl", DEFAULT_TTL))
+        self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+        if self.config.get("multicast_interface") is not None:
+            self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF,
+                                 socket.inet_aton(self.config["multicast_interface"]))
+        self.sock.connect((self.config["target"], self.config["data_port"]))
+        return True
+
+    def begin_connect(self):
+        '''Nothing to wait for'''
+        self.connect()
+        return None
+
+class MulticastReceiver():
+    '''Joins a group and accounts the datagrams of every sender with the
+    usual counters. Only the header is copied out of the kernel unless
+    payloads are verified.
+    '''
+
+    # pylint: disable=too-many-instance-attributes
+    def __init__(self, config, params, group):
+        self.config = config
+        self.params = params
+        self.group = group
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        # every socket bound to the group gets its own copy of each datagram
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RCVBUF)
+        self.sock.bind((group, config["data_port"]))
+        interface = config.get("multicast_interface", "0.0.0.0")
+        self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP,
+                             socket.inet_aton(group) + socket.inet_aton(interface))
+        self.sock.setblocking(False)
+        self.rx_stamps = rx_timestamps(self.sock)
+        self.flags = 0
+        if not params.get("verify") and sys.platform.startswith("linux"):
+            # MSG_TRUNC returns the length of the whole datagram
+            self.buff = bytearray(UDP_HEADER_SIZE)
+            self.flags = socket.MSG_TRUNC
+        else:
+            self.buff = bytearray(MAX_DATAGRAM)
+        self.view = memoryview(self.buff)
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.sock, selectors.EVENT_READ)
+        self.cpu = ThreadCPU()
+        self.running = True
+        self.reset()
+
+    def reset(self):
+        '''Forget all senders for the next test'''
+        self.streams = {}
+        self.first_data = None
+        self.last_data = None
+        self.cpu.rebase()
+
+    def add_stream(self, addr):
+        '''Account a new sender'''
+        counters = Counters()
+        if self.params.get("verify"):
+            counters.payload = Payload(self.params, len(self.buff))
+        self.streams[addr] = counters
+        return counters
+
+    def drain(self):
+        '''Account every datagram queued on the socket, returns how many'''
+        received = 0
+        stamp = None
+        while True:
+            try:
+                if self.rx_stamps is None:
+                    (size, addr) = self.sock.recvfrom_into(self.buff, len(self.buff), self.flags)
+                else:
+                    #pylint: disable=unused-variable
+                    (size, ancdata, flags, addr) = self.sock.recvmsg_into([self.buff], ANCBUFSIZE,
+                                                                          self.flags)
+                    stamp = self.rx_stamps.decode(ancdata)
+            except BlockingIOError:
+                return received
+            counters = self.streams.get(addr)
+            if counters is None:
+                counters = self.add_stream(addr)
+            counters.process_header(self.buff, stamp, size)
+            if counters.payload is not None:
+                counters.payload.check_datagram(self.view[:size])
+            received = received + 1
+
+    def run(self, idle=IDLE_TIMEOUT):
+        '''Receive until stopped or idle for a while after the first datagram'''
+        self.cpu.begin()
+        try:
+            while self.running:
+                self.selector.select(POLL)
+                now = time.clock_gettime(time.CLOCK_MONOTONIC)
+                if self.drain() > 0:
+                    if self.first_data is None:
+                        self.first_data = now
+                    self.last_data = now
+                elif self.last_data is not None and now - self.last_data > idle:
+                    break
+            self.drain()
+        finally:
+            self.cpu.end()
+        return self.results()
+
+    def stop(self):
+        '''Stop receiving'''
+        self.running = False
+
+    def close(self):
+        '''Leave the group'''
+        self.selector.close()
+        self.sock.close()
+
+    def results(self):
+        '''Per sender results in the format of the server results'''
+        seconds = 0
+        if self.first_data is not None:
+            seconds = self.last_data - self.first_data
+        streams = []
+        for (addr, counters) in self.streams.items():
+            entry = {"sender": "{}:{}".format(addr[0], addr[1]),
+                     "bytes": counters.bytes_received,
+                     "jitter": counters.jitter,
+                     "errors": counters.cnt_error,
+                     "packets": counters.packet_count,
+                     "out_of_order": counters.outoforder_packets,
+                     "start_time": 0,
+                     "end_time": seconds}
+            entry.update(counters.histograms())
+            if counters.payload is not None:
+                entry.update(counters.payload.results())
+            streams.append(entry)
+        results = {"group": self.group, "streams": streams}
+        results["data_server_cpu"] = self.cpu.results(
+            seconds, sum([stream["bytes"] for stream in streams]))
+        return results
+
+def aggregate(receivers):
+    '''Combine the results of many receivers of the same senders'''
+    streams = [stream for receiver in receivers for stream in receiver["streams"]]
+    total = {"receivers": len(receivers),
+             "senders": len(set([stream["sender"] for stream in streams])),
+             "bytes": sum([stream["bytes"] for stream in streams]),
+             "packets": sum([stream["packets"] for stream in streams]),
+             "errors": sum([stream["errors"] for stream in streams]),
+             "out_of_order": sum([stream["out_of_order"] for stream in streams]),
+             "lost_percent": 0.0,
+             "worst_lost_percent": 0.0,
+             "max_jitter": max([stream["jitter"] for stream in streams], default=0.0)}
+    if total["packets"] > 0:
+        total["lost_percent"] = 100 * total["errors"] / total["packets"]
+    for stream in streams:
+        if stream["packets"] > 0:
+            total["worst_lost_percent"] = max(total["worst_lost_percent"],
+                                              100 * stream["errors"] / stream["packets"])
+    for key in ["delay", "ipdv"]:
+        merged = merge_histograms(streams, key + "_histogram")
+        if merged is not None:
+            total[key] = merged.percentiles()
+    return total
+
+class MulticastTest():
+    '''Send to a group for the test duration, optionally with receivers
+    in this process whose results are aggregated
+    '''
+    def __init__(self, config, params, receivers=0, output=sys.stdout):
+        self.config = config
+        self.params = multicast_params(config, params)
+        self.receivers = [MulticastReceiver(config, self.params, config["target"])
+                          for _ in range(receivers)]
+        self.output = output
+        self.tx_streams = []
+        self.results = None
+
+    def run(self):
+        '''Run the test and write the results as JSON'''
+        workers = []
+        for receiver in self.receivers:
+            workers.append(threading.Thread(target=receiver.run, name="multicast-rx"))
+            workers[-1].start()
+        off = 1
+        for stream_id in range(self.params["parallel"]):
+            # numbered as unicast streams, 1 3 4...
+            if stream_id == 1:
+                off = 2
+            self.tx_streams.append(MulticastClient(self.config, self.params, stream_id + off))
+        for stream in self.tx_streams:
+            stream.connect()
+        for stream in self.tx_streams:
+            stream.start()
+        for stream in self.tx_streams:
+            stream.worker.join()
+            stream.sock.close()
+        time.sleep(LINGER)
+        for receiver in self.receivers:
+            receiver.stop()
+        for worker in workers:
+            worker.join()
+        self.results = {"sender": {"streams": [stream.result for stream in self.tx_streams]}}
+        if len(self.receivers) > 0:
+            received = [receiver.results() for receiver in self.receivers]
+            self.results["receivers"] = received
+            self.results["sum"] = aggregate(received)
+        for receiver in self.receivers:
+            receiver.close()
+        self.output.write(json.dumps(self.results) + "\n")
+        self.output.flush()
+        return True
+
+def serve(config, params, group, output=sys.stdout):
+    '''Receive tests sent to a group until interrupted, a line of JSON for each test'''
+    receiver = MulticastReceiver(config, params, group)
+    try:
+        while True:
+            results = receiver.run()
+            output.write(json.dumps(results) + "\n")
+            output.flush()
+            receiver.reset()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        receiver.close()
+
+def main():
+    '''Aggregate the results of multicast receivers'''
+
+    aparser = ArgumentParser(description=main.__doc__)
+    aparser.add_argument(
+        'files',
+        help='JSON lines written by receivers, one test each, default stdin',
+        nargs='*')
+
+    args = vars(aparser.parse_args())
+    receivers = []
+    for name in args["files"] or ["-"]:
+        source = sys.stdin if name == "-" else open(name)
+        receivers.extend([json.loads(line) for line in source if line.strip() != ""])
+    print(json.dumps(aggregate(receivers)))
+
+if __name__ == "__main__":
+    main()
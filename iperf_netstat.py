@@ -0,0 +1,181 @@
+#!/usr/bin/python3
+'''Iperf kernel network counter sampler'''
+
+# pyiperf, Copyright (c) 2023 RedHat Inc
+# pyiperf, Copyright (c) 2023 Cambridge Greys Ltd
+
+# This source code is licensed under both the BSD-style license (found in the
+# LICENSE file in the root directory of this source tree) and the GPLv2 (found
+# in the COPYING file in the root directory of this source tree).
+# You may select, at your option, one of the above-listed licenses.
+
+from array import array
+import os
+import psutil
+
+SNMP = "/proc/net/snmp"
+DEV = "/proc/net/dev"
+SOFTIRQS = "/proc/softirqs"
+BUFSIZE = 16384
+
+# protocol line in /proc/net/snmp and the columns we report from it
+SNMP_FIELDS = [(b"\nUdp: ", [(b"InDatagrams", "udp_in_datagrams"),
+                             (b"InErrors", "udp_in_errors"),
+                             (b"RcvbufErrors", "udp_rcvbuf_errors"),
+                             (b"SndbufErrors", "udp_sndbuf_errors")]),
+               (b"\nTcp: ", [(b"OutSegs", "tcp_out_segs"),
+                             (b"RetransSegs", "tcp_retrans_segs"),
+                             (b"InErrs", "tcp_in_errs")])]
+
+# column in a /proc/net/dev interface line
+DEV_FIELDS = [(0, "rx_bytes"), (1, "rx_packets"), (2, "rx_errs"), (3, "rx_drop"),
+              (8, "tx_bytes"), (9, "tx_packets"), (10, "tx_errs"), (11, "tx_drop")]
+
+SOFTIRQ_FIELDS = [(b"NET_RX:", "softirq_net_rx"), (b"NET_TX:", "softirq_net_tx")]
+
+def interface_for(address):
+    '''Name of the interface an address is bound to, None if unknown'''
+    address = address.split("%")[0]
+    if address.startswith("::ffff:"):
+        address = address[7:]
+    for (name, addrs) in psutil.net_if_addrs().items():
+        for addr in addrs:
+            if addr.address.split("%")[0] == address:
+                return name
+    return None
+
+class ProcFile():
+    '''A /proc file re-read into the same buffer on every sample'''
+    def __init__(self, path):
+        self.fd = os.open(path, os.O_RDONLY)
+        self.buff = bytearray(BUFSIZE)
+        self.size = 0
+
+    def read(self):
+        '''Re-read the file, growing the buffer if it does not fit'''
+        while True:
+            self.size = os.preadv(self.fd, [self.buff], 0)
+            if self.size < len(self.buff):
+                return self.size
+            self.buff = bytearray(len(self.buff) * 2)
+
+    def line(self, key, start=0):
+        '''Offsets of the rest of the line following key, None if absent'''
+        pos = self.buff.find(key, start, self.size)
+        if pos < 0:
+            return None
+        end = self.buff.find(b"\n", pos + len(key), self.size)
+        if end < 0:
+            end = self.size
+        return (pos + len(key), end)
+
+    def close(self):
+        '''Close the file'''
+        os.close(self.fd)
+
+class NetSampler():
+    '''Snapshots of UDP and TCP error counters, the counters of the
+    interface the test runs over and network softirqs. Values are kept
+    in preallocated arrays, a sample only allocates while splitting
+    the few lines it needs.
+    '''
+    def __init__(self, address):
+        self.interface = interface_for(address)
+        self.keys = []
+        self.snmp = ProcFile(SNMP)
+        self.dev = ProcFile(DEV)
+        self.softirqs = ProcFile(SOFTIRQS)
+
+        # column positions never change, find them once
+        self.snmp.read()
+        self.snmp_columns = []
+        for (prefix, fields) in SNMP_FIELDS:
+            span = self.snmp.line(prefix)
+            header = []
+            if span is not None:
+                header = bytes(self.snmp.buff[span[0]:span[1]]).split()
+            columns = []
+            for (name, key) in fields:
+                if name in header:
+                    columns.append(header.index(name))
+                    self.keys.append(key)
+            self.snmp_columns.append((prefix, columns))
+        if self.interface is not None:
+            self.dev_key = b" " + self.interface.encode("ascii") + b":"
+            self.keys.extend([key for (column, key) in DEV_FIELDS])
+        self.keys.extend([key for (name, key) in SOFTIRQ_FIELDS])
+
+        self.first = array("q", [0] * len(self.keys))
+        self.last = array("q", [0] * len(self.keys))
+        self.current = array("q", [0] * len(self.keys))
+
+    def sample(self, values):
+        '''Read all counters into values'''
+        index = 0
+        self.snmp.read()
+        for (prefix, columns) in self.snmp_columns:
+            # the first line for a protocol is the header, the second the values
+            header = self.snmp.line(prefix)
+            span = None
+            if header is not None:
+                span = self.snmp.line(prefix, header[1])
+            fields = []
+            if span is not None:
+                fields = self.snmp.buff[span[0]:span[1]].split()
+            for column in columns:
+                if column < len(fields):
+                    values[index] = int(fields[column])
+                index = index + 1
+
+        if self.interface is not None:
+            self.dev.read()
+            # names are right aligned, long ones start the line
+            span = self.dev.line(self.dev_key)
+            if span is None:
+                span = self.dev.line(b"\n" + self.dev_key[1:])
+            fields = []
+            if span is not None:
+                fields = self.dev.buff[span[0]:span[1]].split()
+            for (column, _) in DEV_FIELDS:
+                if column < len(fields):
+                    values[index] = int(fields[column])
+                index = index + 1
+
+        self.softirqs.read()
+        for (name, _) in SOFTIRQ_FIELDS:
+            span = self.softirqs.line(name)
+            total = 0
+            if span is not None:
+                for count in self.softirqs.buff[span[0]:span[1]].split():
+                    total = total + int(count)
+            values[index] = total
+            index = index + 1
+
+    def deltas(self, before, after):
+        '''Counter changes between two samples'''
+        result = {"interface": self.interface}
+        for index in range(len(self.keys)):
+            result[self.keys[index]] = after[index] - before[index]
+        return result
+
+    def start(self):
+        '''Sample at test start'''
+        self.sample(self.first)
+        self.last[:] = self.first
+
+    def interval(self):
+        '''Changes since the previous interval'''
+        self.sample(self.current)
+        result = self.deltas(self.last, self.current)
+        (self.last, self.current) = (self.current, self.last)
+        return result
+
+    def total(self):
+        '''Changes since the start of the test'''
+        self.sample(self.current)
+        return self.deltas(self.first, self.current)
+
+    def close(self):
+        '''Close the /proc files'''
+        for proc in [self.snmp, self.dev, self.softirqs]:
+            proc.close()
@@ -0,0 +1,251 @@
+#!/usr/bin/python3
+'''Iperf3 compatible JSON output'''
+
+# pyiperf, Copyright (c) 2023 RedHat Inc
+# pyiperf, Copyright (c) 2023 Cambridge Greys Ltd
+
+# This source code is licensed under both the BSD-style license (found in the
+# LICENSE file in the root directory of this source tree) and the GPLv2 (found
+# in the COPYING file in the root directory of this source tree).
+# You may select, at your option, one of the above-listed licenses.
+
+import json
+import platform
+import sys
+import time
+from iperf_utils import free_threaded
+
+VERSION = "pyiperf 3.11"
+BUFSIZE = 65536
+
+class ResultWriter():
+    '''Write results in iperf3 JSON format. The document is written
+    incrementally - start, each interval as it completes and end - so
+    nothing is held in memory for long runs. In streaming mode each
+    event is written as a separate line of JSON instead.
+    '''
+    def __init__(self, config):
+        self.streaming = config.get("json_stream") is True
+        self.forceflush = config.get("forceflush") is True
+        self.owned = config.get("logfile") is not None
+        if self.owned:
+            self.output = open(config["logfile"], "a", buffering=BUFSIZE)
+        else:
+            self.output = sys.stdout
+        self.started = False
+        self.intervals = 0
+
+    def write_event(self, event, data):
+        '''Write one part of the result document'''
+        if self.streaming:
+            self.output.write(json.dumps({"event": event, "data": data}))
+            self.output.write("\n")
+        elif event == "start":
+            self.output.write('{"start": ')
+            self.output.write(json.dumps(data))
+            self.output.write(', "intervals": [')
+        elif event == "interval":
+            if self.intervals > 0:
+                self.output.write(", ")
+            self.output.write(json.dumps(data))
+        elif event == "end":
+            self.output.write('], "end": ')
+            self.output.write(json.dumps(data))
+            self.output.write("}\n")
+
+    def start(self, data):
+        '''Test started'''
+        self.started = True
+        self.write_event("start", data)
+        if self.forceflush:
+            self.output.flush()
+
+    def interval(self, data):
+        '''Interval completed'''
+        if not self.started:
+            self.start({})
+        self.write_event("interval", data)
+        self.intervals = self.intervals + 1
+        if self.forceflush:
+            self.output.flush()
+
+    def end(self, data):
+        '''Test completed'''
+        if not self.started:
+            self.start({})
+        self.write_event("end", data)
+        self.output.flush()
+
+    def close(self):
+        '''Flush and close the output'''
+        self.output.flush()
+        if self.owned:
+            self.output.close()
+
+def start_record(client):
+    '''Build the "start" section for a test client or server'''
+    now = time.time()
+    params = client.params
+    if params.get("udp"):
+        protocol = "UDP"
+    else:
+        protocol = "TCP"
+    cookie = client.config.get("cookie")
+    if isinstance(cookie, bytes):
+        cookie = cookie.decode("ascii", "ignore")
+    return {"connected": [{"socket": sample["socket"]} for sample in client.stream_totals()],
+            "version": VERSION,
+            "system_info": " ".join(platform.uname()),
+            "free_threaded": free_threaded(),
+            "timestamp": {"time": time.strftime("%a, %d %b %Y %H:%M:%S GMT", time.gmtime(now)),
+                          "timesecs": int(now)},
+            "connecting_to": {"host": client.config["target"], "port": client.config["config_port"]},
+            "cookie": cookie,
+            "test_start": {"protocol": protocol,
+                           "num_streams": params.get("parallel", 1),
+                           "blksize": params.get("len", 0),
+                           "omit": params.get("omit", 0),
+                           "duration": params.get("time", 0),
+                           "bytes": params.get("num", 0),
+                           "blocks": params.get("blockcount", 0),
+                           "reverse": int(params.get("reverse") is not None)}}
+
+def cpu_fields(entry, cpu, seconds):
+    '''Add CPU use in percent of the interval and per gigabit moved'''
+    entry["cpu_percent"] = 100 * cpu / seconds
+    entry["cpu_per_gbit"] = 0.0
+    if entry["bytes"] > 0:
+        entry["cpu_per_gbit"] = cpu / (entry["bytes"] * 8 / 1E9)
+
+def interval_record(samples, start, end, sender, udp):
+    '''Build an interval entry from per stream byte, packet and CPU deltas'''
+    seconds = end - start
+    streams = []
+    total = {"start": start, "end": end, "seconds": seconds, "bytes": 0,
+             "bits_per_second": 0.0, "omitted": False, "sender": sender}
+    if udp:
+        total["packets"] = 0
+    cpu = None
+    for sample in samples:
+        entry = {"socket": sample["socket"],
+                 "start": start,
+                 "end": end,
+                 "seconds": seconds,
+                 "bytes": sample["bytes"],
+                 "bits_per_second": sample["bytes"] * 8 / seconds,
+                 "omitted": False,
+                 "sender": sender}
+        total["bytes"] = total["bytes"] + sample["bytes"]
+        if udp:
+            entry["packets"] = sample["packets"]
+            total["packets"] = total["packets"] + sample["packets"]
+        if sample.get("cpu") is not None:
+            cpu_fields(entry, sample["cpu"], seconds)
+            cpu = (cpu or 0.0) + sample["cpu"]
+        streams.append(entry)
+    total["bits_per_second"] = total["bytes"] * 8 / seconds
+    if cpu is not None:
+        cpu_fields(total, cpu, seconds)
+    return {"streams": streams, "sum": total}
+
+def summary(stream_id, stream, sender):
+    '''Summary of one direction of a TCP stream'''
+    if stream is None:
+        stream = {"bytes": 0, "end_time": 0}
+    seconds = stream.get("end_time", 0)
+    entry = {"socket": stream_id,
+             "start": 0,
+             "end": seconds,
+             "seconds": seconds,
+             "bytes": stream["bytes"],
+             "bits_per_second": 0.0,
+             "sender": sender}
+    if seconds > 0:
+        entry["bits_per_second"] = stream["bytes"] * 8 / seconds
+    if sender:
+        entry["retransmits"] = stream.get("retransmits", 0)
+    for key in ["cpu_percent", "cpu_per_gbit"]:
+        if key in stream:
+            entry[key] = stream[key]
+    for key in ["instrumentation", "verify"]:
+        if key in stream:
+            entry[key] = stream[key]
+    return entry
+
+def udp_summary(stream_id, sent, received, sender):
+    '''Summary of a UDP stream, loss and jitter as seen by the receiver'''
+    entry = summary(stream_id, sent, sender)
+    if received is None:
+        received = {}
+    entry["jitter_ms"] = received.get("jitter", 0.0) * 1000
+    entry["lost_packets"] = received.get("errors", 0)
+    entry["packets"] = received.get("packets", 0)
+    entry["out_of_order"] = received.get("out_of_order", 0)
+    if "verify" in received:
+        entry["verify"] = received["verify"]
+    entry["lost_percent"] = 0.0
+    if entry["packets"] > 0:
+        entry["lost_percent"] = 100 * entry["lost_packets"] / entry["packets"]
+    return entry
+
+def add_sum(total, entry):
+    '''Accumulate a stream summary into a sum'''
+    for key in ["bytes", "retransmits", "lost_packets", "packets", "out_of_order"]:
+        if key in entry:
+            total[key] = total.get(key, 0) + entry[key]
+    total["end"] = max(total["end"], entry["end"])
+    total["seconds"] = total["end"]
+    if total["seconds"] > 0:
+        total["bits_per_second"] = total["bytes"] * 8 / total["seconds"]
+
+def cpu_percent(results, prefix):
+    '''CPU use in percent of the test duration'''
+    if results is None:
+        return {}
+    return {prefix + "_total": results.get("cpu_util_total", 0.0),
+            prefix + "_user": results.get("cpu_util_user", 0.0),
+            prefix + "_system": results.get("cpu_util_system", 0.0)}
+
+def end_record(results, peer_result, sender, udp):
+    '''Build the "end" section from local and peer results'''
+    local = {}
+    remote = {}
+    if results is not None:
+        local = {stream["id"]: stream for stream in results["streams"]}
+    if peer_result is not None:
+        remote = {stream["id"]: stream for stream in peer_result["streams"]}
+    if sender:
+        (sent, received) = (local, remote)
+    else:
+        (sent, received) = (remote, local)
+
+    streams = []
+    sum_sent = {"start": 0, "end": 0, "seconds": 0, "bytes": 0, "bits_per_second": 0.0, "sender": True}
+    sum_received = {"start": 0, "end": 0, "seconds": 0, "bytes": 0, "bits_per_second": 0.0, "sender": False}
+    for stream_id in sorted(set(sent) | set(received)):
+        if udp:
+            entry = udp_summary(stream_id, sent.get(stream_id), received.get(stream_id), sender)
+            streams.append({"udp": entry})
+            add_sum(sum_sent, entry)
+            add_sum(sum_received, summary(stream_id, received.get(stream_id), False))
+        else:
+            entry = {"sender": summary(stream_id, sent.get(stream_id), True),
+                     "receiver": summary(stream_id, received.get(stream_id), False)}
+            streams.append(entry)
+            add_sum(sum_sent, entry["sender"])
+            add_sum(sum_received, entry["receiver"])
+
+    end = {"streams": streams, "sum_sent": sum_sent, "sum_received": sum_received}
+    if udp:
+        end["sum"] = sum_sent
+        if sum_sent.get("packets", 0) > 0:
+            sum_sent["lost_percent"] = 100 * sum_sent["lost_packets"] / sum_sent["packets"]
+    cpu = cpu_percent(results, "host")
+    cpu.update(cpu_percent(peer_result, "remote"))
+    end["cpu_utilization_percent"] = cpu
+    for key in ["netstat", "soak", "rr", "crr", "timers"]:
+        if results is not None and key in results:
+            end[key] = {"host": results[key]}
+            if peer_result is not None and key in peer_result:
+                end[key]["remote"] = peer_result[key]
+    return end
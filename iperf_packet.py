@@ -0,0 +1,396 @@
+#!/usr/bin/python3
+'''Iperf AF_PACKET memory mapped ring backend'''
+
+# pyiperf, Copyright (c) 2023 RedHat Inc
+# pyiperf, Copyright (c) 2023 Cambridge Greys Ltd
+
+# This source code is licensed under both the BSD-style license (found in the
+# LICENSE file in the root directory of this source tree) and the GPLv2 (found
+# in the COPYING file in the root directory of this source tree).
+# You may select, at your option, one of the above-listed licenses.
+
+import ctypes
+import errno
+import mmap
+import socket
+import struct
+from iperf_data import UDPClient, RxTimestamps, UDP_HEADER_SIZE, FORMAT32, FORMAT64
+from iperf_netstat import interface_for
+
+# linux/if_packet.h
+SOL_PACKET = 263
+PACKET_RX_RING = 5
+PACKET_VERSION = 10
+PACKET_TX_RING = 13
+TPACKET_V3 = 2
+TP_STATUS_KERNEL = 0
+TP_STATUS_USER = 1
+TP_STATUS_AVAILABLE = 0
+TP_STATUS_SEND_REQUEST = 1
+TP_STATUS_WRONG_FORMAT = 4
+PACKET_OUTGOING = 4
+ETH_P_IP = 0x0800
+IFF_LOOPBACK = 0x8
+# asm-generic/socket.h
+SO_ATTACH_FILTER = 26
+
+# classic BPF - code, jump if true, jump if false, constant
+SOCK_FILTER = struct.Struct("HBBI")
+BPF_LDH_ABS = 0x28
+BPF_LDB_ABS = 0x30
+BPF_LDW_ABS = 0x20
+BPF_LDX_MSH = 0xb1
+BPF_LDH_IND = 0x48
+BPF_JEQ = 0x15
+BPF_JSET = 0x45
+BPF_RET = 0x06
+# bytes of a matching packet passed to the ring
+SNAP_LEN = 0x40000
+
+# block size, block count, frame size, frame count, block retire timeout,
+# private area size, features
+TPACKET_REQ3 = struct.Struct("IIIIIII")
+# tpacket3_hdr - next offset, sec, nsec, snaplen, len, status, mac, net
+TPACKET3_HDR = struct.Struct("IIIIIIHH")
+# TPACKET_ALIGN(sizeof(struct tpacket3_hdr)), transmitted frames start
+# here and received frames are followed by a sockaddr_ll here
+TPACKET3_HDRLEN = 48
+TPACKET_ALIGNMENT = 16
+TP_LEN = 16
+TP_STATUS = 20
+# sockaddr_ll packet type
+SLL_PKTTYPE = TPACKET3_HDRLEN + 10
+# tpacket_block_desc - version, private offset, status, packets, first packet
+BLOCK_DESC = struct.Struct("IIIII")
+BLOCK_STATUS = 8
+STATUS = struct.Struct("I")
+
+ETHERNET = struct.Struct("!6s6sH")
+IPV4 = struct.Struct("!BBHHHBBH4s4s")
+UDP = struct.Struct("!HHHH")
+
+BLOCK_SIZE = 1 << 20
+DEFAULT_BLOCKS = 8
+# ms before the kernel hands over a receive block which is not full
+RETIRE_TIMEOUT = 10
+RX_FRAME_SIZE = 2048
+# frames queued before the transmit ring is flushed to the kernel
+TX_BATCH = 64
+
+def align(size, alignment=TPACKET_ALIGNMENT):
+    '''Round size up to a multiple of alignment'''
+    return (size + alignment - 1) & ~(alignment - 1)
+
+def checksum(data):
+    '''Internet checksum'''
+    if len(data) % 2 == 1:
+        data = data + b"\0"
+    total = sum(struct.unpack("!{}H".format(len(data) // 2), data))
+    while total >> 16:
+        total = (total & 0xffff) + (total >> 16)
+    return ~total & 0xffff
+
+def sysfs(interface, name):
+    '''Read an interface attribute'''
+    with open("/sys/class/net/{}/{}".format(interface, name)) as attribute:
+        return attribute.read().strip()
+
+def mac_address(text):
+    '''Binary MAC address'''
+    return bytes.fromhex(text.replace(":", ""))
+
+def neighbour(interface, address):
+    '''MAC address of the next hop to address. The UDP handshake has
+    already resolved it if the peer is reachable.
+    '''
+    hops = [address]
+    with open("/proc/net/route") as routes:
+        for fields in [line.split() for line in routes.readlines()[1:]]:
+            if fields[0] == interface and int(fields[1], 16) == 0 and int(fields[2], 16) != 0:
+                hops.append(socket.inet_ntoa(struct.pack("<I", int(fields[2], 16))))
+    with open("/proc/net/arp") as arp:
+        entries = {fields[0]: fields[3] for fields in [line.split() for line in arp.readlines()[1:]]
+                   if fields[5] == interface}
+    for hop in hops:
+        if entries.get(hop, "00:00:00:00:00:00") != "00:00:00:00:00:00":
+            return mac_address(entries[hop])
+    raise ValueError("No neighbour entry for {} on {}".format(address, interface))
+
+def udp_frame(source, destination, payload):
+    '''Ethernet, IPv4 and UDP headers followed by a zeroed payload.
+    source and destination are (mac, address, port). The UDP checksum
+    is left out, IP ids are not needed as fragmenting is not allowed.
+    '''
+    ip = bytearray(IPV4.pack(0x45, 0, IPV4.size + UDP.size + payload, 0, 0x4000, 64,
+                             socket.IPPROTO_UDP, 0, socket.inet_aton(source[1]),
+                             socket.inet_aton(destination[1])))
+    struct.pack_into("!H", ip, 10, checksum(ip))
+    return ETHERNET.pack(destination[0], source[0], ETH_P_IP) + bytes(ip) + \
+           UDP.pack(source[2], destination[2], UDP.size + payload, 0) + bytes(payload)
+
+def stream_filter(local, peer):
+    '''Classic BPF program passing only the first fragments of the UDP
+    datagrams from peer to local, both (address, port), in Ethernet frames
+    '''
+    program = [(BPF_LDH_ABS, 0, 0, 12),
+               (BPF_JEQ, 0, None, ETH_P_IP),
+               (BPF_LDB_ABS, 0, 0, ETHERNET.size + 9),
+               (BPF_JEQ, 0, None, socket.IPPROTO_UDP),
+               (BPF_LDW_ABS, 0, 0, ETHERNET.size + 12),
+               (BPF_JEQ, 0, None, struct.unpack("!I", socket.inet_aton(peer[0]))[0]),
+               (BPF_LDW_ABS, 0, 0, ETHERNET.size + 16),
+               (BPF_JEQ, 0, None, struct.unpack("!I", socket.inet_aton(local[0]))[0]),
+               (BPF_LDH_ABS, 0, 0, ETHERNET.size + 6),
+               (BPF_JSET, None, 0, 0x1fff),
+               # X = IP header length
+               (BPF_LDX_MSH, 0, 0, ETHERNET.size),
+               (BPF_LDH_IND, 0, 0, ETHERNET.size),
+               (BPF_JEQ, 0, None, peer[1]),
+               (BPF_LDH_IND, 0, 0, ETHERNET.size + 2),
+               (BPF_JEQ, 0, None, local[1]),
+               (BPF_RET, 0, 0, SNAP_LEN)]
+    drop = len(program)
+    program.append((BPF_RET, 0, 0, 0))
+    # None jumps to the drop at the end
+    return [(code, drop - index - 1 if true is None else true, drop - index - 1 if false is None else false,
+             constant) for (index, (code, true, false, constant)) in enumerate(program)]
+
+def attach_filter(sock, program):
+    '''Attach a classic BPF program to a socket'''
+    code = ctypes.create_string_buffer(b"".join([SOCK_FILTER.pack(*op) for op in program]))
+    # struct sock_fprog - length, pointer to the instructions
+    sock.setsockopt(socket.SOL_SOCKET, SO_ATTACH_FILTER,
+                    struct.pack("HP", len(program), ctypes.addressof(code)))
+
+class PacketRing():
+    '''A TPACKET_V3 ring shared with the kernel through an AF_PACKET socket'''
+    # pylint: disable=too-many-arguments
+    def __init__(self, interface, protocol, option, request, size, program=None):
+        self.sock = socket.socket(socket.AF_PACKET, socket.SOCK_RAW, socket.htons(protocol))
+        if program is not None:
+            # before binding, so the ring never sees other traffic
+            attach_filter(self.sock, program)
+        self.sock.setsockopt(SOL_PACKET, PACKET_VERSION, TPACKET_V3)
+        self.sock.setsockopt(SOL_PACKET, option, request)
+        self.sock.bind((interface, protocol))
+        self.map = mmap.mmap(self.sock.fileno(), size)
+        self.view = memoryview(self.map)
+
+    def close(self):
+        '''Unmap the ring and close the socket'''
+        if self.map is None:
+            return
+        self.view.release()
+        self.map.close()
+        self.map = None
+        self.sock.close()
+
+class TxRing(PacketRing):
+    '''Transmit ring. Every frame is filled with the frame template when
+    the ring is set up, only the iperf header is written per packet.
+    Frames are handed to the kernel in batches.
+    '''
+    def __init__(self, interface, template, blocks):
+        frame_size = align(TPACKET3_HDRLEN + len(template))
+        block_size = max(BLOCK_SIZE, align(frame_size, mmap.PAGESIZE))
+        per_block = block_size // frame_size
+        self.frames = per_block * blocks
+        # frames are not received on protocol 0
+        super().__init__(interface, 0, PACKET_TX_RING,
+                         TPACKET_REQ3.pack(block_size, blocks, frame_size, self.frames, 0, 0, 0),
+                         block_size * blocks)
+        self.offsets = [block * block_size + index * frame_size
+                        for block in range(blocks) for index in range(per_block)]
+        for offset in self.offsets:
+            self.map[offset + TPACKET3_HDRLEN:offset + TPACKET3_HDRLEN + len(template)] = template
+            STATUS.pack_into(self.map, offset + TP_LEN, len(template))
+        self.head = 0
+        self.pending = 0
+
+    def reserve(self):
+        '''Offset of the next free frame, None if the kernel still owns it'''
+        offset = self.offsets[self.head]
+        status = STATUS.unpack_from(self.map, offset + TP_STATUS)[0]
+        if status == TP_STATUS_AVAILABLE:
+            return offset
+        if status == TP_STATUS_WRONG_FORMAT:
+            raise OSError(errno.EMSGSIZE, "Frame rejected by the kernel")
+        return None
+
+    def commit(self, offset):
+        '''Queue a filled in frame for transmission'''
+        STATUS.pack_into(self.map, offset + TP_STATUS, TP_STATUS_SEND_REQUEST)
+        self.head = (self.head + 1) % self.frames
+        self.pending = self.pending + 1
+        if self.pending >= TX_BATCH:
+            self.flush()
+
+    def flush(self):
+        '''Ask the kernel to send all queued frames'''
+        if self.pending == 0:
+            return
+        try:
+            self.sock.send(b"", socket.MSG_DONTWAIT)
+            self.pending = 0
+        except (BlockingIOError, InterruptedError):
+            pass
+        except OSError as error:
+            if error.errno != errno.ENOBUFS:
+                raise
+
+class RxRing(PacketRing):
+    '''Receive ring. The kernel hands over a block of packets once it is
+    full or RETIRE_TIMEOUT has passed. A filter program keeps the traffic
+    of other streams out of it.
+    '''
+    def __init__(self, interface, blocks, program=None):
+        frames = BLOCK_SIZE // RX_FRAME_SIZE * blocks
+        super().__init__(interface, ETH_P_IP, PACKET_RX_RING,
+                         TPACKET_REQ3.pack(BLOCK_SIZE, blocks, RX_FRAME_SIZE, frames,
+                                           RETIRE_TIMEOUT, 0, 0),
+                         BLOCK_SIZE * blocks, program)
+        self.blocks = blocks
+        self.block = 0
+
+    def next_block(self):
+        '''Offset of the next block, None if the kernel still owns it'''
+        offset = self.block * BLOCK_SIZE
+        if STATUS.unpack_from(self.map, offset + BLOCK_STATUS)[0] & TP_STATUS_USER == 0:
+            return None
+        return offset
+
+    def release(self, offset):
+        '''Return a block to the kernel'''
+        STATUS.pack_into(self.map, offset + BLOCK_STATUS, TP_STATUS_KERNEL)
+        self.block = (self.block + 1) % self.blocks
+
+class PacketClient(UDPClient):
+    '''UDP stream which sends or receives through a memory mapped
+    AF_PACKET ring instead of one system call per datagram. The UDP
+    socket is kept for the handshake and to hold the port.
+    '''
+    def __init__(self, config, params, stream_id):
+        super().__init__(config, params, stream_id)
+        self.ring = None
+        self.local = None
+        self.peer = None
+        self.stamps = RxTimestamps()
+
+    def open_ring(self):
+        '''Set up the ring for the direction of the test'''
+        self.local = self.sock.getsockname()
+        self.peer = self.sock.getpeername()
+        interface = self.config.get("packet_interface") or interface_for(self.local[0])
+        blocks = self.config.get("packet_blocks") or DEFAULT_BLOCKS
+        if int(sysfs(interface, "flags"), 16) & IFF_LOOPBACK:
+            # frames injected on loopback have no route attached and
+            # are dropped as martians
+            raise ValueError("The packet backend needs a peer reachable over a network interface")
+        if self.params.get("reverse") is not None:
+            # each stream's ring only gets its own datagrams from the kernel
+            self.ring = RxRing(interface, blocks, stream_filter(self.local, self.peer))
+            return
+        if IPV4.size + UDP.size + self.length > int(sysfs(interface, "mtu")):
+            raise ValueError("Datagrams of {} bytes do not fit the MTU of {}".format(
+                self.length, interface))
+        template = udp_frame((mac_address(sysfs(interface, "address")),) + self.local,
+                             (neighbour(interface, self.peer[0]),) + self.peer, self.length)
+        self.ring = TxRing(interface, template, blocks)
+
+    def connect(self):
+        '''Connect to the other side, then set up the ring'''
+        result = super().connect()
+        self.open_ring()
+        return result
+
+    def continue_connect(self):
+        '''Set up the ring once the handshake has completed'''
+        events = super().continue_connect()
+        if events is None:
+            self.open_ring()
+        return events
+
+    def reset(self, params):
+        '''Prepare an already connected stream for another test, which
+        may run in the other direction
+        '''
+        super().reset(params)
+        self.ring.close()
+        self.open_ring()
+
+    def send(self, now):
+        '''Send a frame if the bitrate limit allows it, flush the queued
+        frames while held back
+        '''
+        if self.can_send(now):
+            return self.transmit(now)
+        self.ring.flush()
+        return None
+
+    def transmit(self, now):
+        '''Write the iperf header into the next free frame'''
+        offset = self.ring.reserve()
+        if offset is None:
+            self.ring.flush()
+            return 0
+        parsed = self.counters.parsed
+        parsed.packet_count = parsed.packet_count + 1
+        parsed.sec = int(abs(now))
+        parsed.usec = int((now - parsed.sec) * 1E6)
+        data = offset + TPACKET3_HDRLEN + ETHERNET.size + IPV4.size + UDP.size
+        if parsed.long_counters:
+            struct.pack_into(FORMAT64, self.ring.map, data, parsed.sec, parsed.usec,
+                             parsed.packet_count)
+        else:
+            struct.pack_into(FORMAT32, self.ring.map, data, parsed.sec, parsed.usec,
+                             parsed.packet_count)
+        self.ring.commit(offset)
+        self.total = self.total + self.length
+        return self.length
+
+    def receive(self, now):
+        '''Account for a block of received frames. Returns the payload
+        bytes of this stream's datagrams in it, 0 if there is none.
+        '''
+        offset = self.ring.next_block()
+        if offset is None:
+            return 0
+        ring = self.ring.map
+        (_, _, _, count, packet) = BLOCK_DESC.unpack_from(ring, offset)
+        packet = offset + packet
+        received = 0
+        peer = socket.inet_aton(self.peer[0])
+        for _ in range(count):
+            (next_offset, sec, nsec, _, _, _, _, net) = TPACKET3_HDR.unpack_from(ring, packet)
+            if ring[packet + SLL_PKTTYPE] != PACKET_OUTGOING:
+                (version, _, _, _, fragment, _, protocol, _, source, _) = IPV4.unpack_from(
+                    ring, packet + net)
+                # only the first fragment carries the UDP header
+                if protocol == socket.IPPROTO_UDP and source == peer and fragment & 0x1fff == 0:
+                    udp = packet + net + (version & 0xf) * 4
+                    (sport, dport, length, _) = UDP.unpack_from(ring, udp)
+                    if sport == self.peer[1] and dport == self.local[1]:
+                        size = length - UDP.size
+                        data = udp + UDP.size
+                        self.counters.process_header(self.ring.view[data:data + UDP_HEADER_SIZE],
+                                                     self.stamps.monotonic(sec * 1000000000 + nsec),
+                                                     size)
+                        received = received + size
+            packet = packet + next_offset
+        self.ring.release(offset)
+        self.total = self.total + received
+        return received
+
+    def run_test(self):
+        '''Run the test, sending whatever is still queued at the end'''
+        try:
+            super().run_test()
+        finally:
+            if isinstance(self.ring, TxRing):
+                self.ring.flush()
+
+    def shutdown(self):
+        '''Shut down the stream and release the ring'''
+        super().shutdown()
+        if self.ring is not None:
+            self.ring.close()
@@ -0,0 +1,311 @@
+#!/usr/bin/python3
+'''Iperf request/response streams'''
+
+# pyiperf, Copyright (c) 2023 RedHat Inc
+# pyiperf, Copyright (c) 2023 Cambridge Greys Ltd
+
+# This source code is licensed under both the BSD-style license (found in the
+# LICENSE file in the root directory of this source tree) and the GPLv2 (found
+# in the COPYING file in the root directory of this source tree).
+# You may select, at your option, one of the above-listed licenses.
+
+import selectors
+import struct
+import threading
+import time
+from iperf_data import UDPClient, TCPClient
+from iperf_histogram import Histogram, merge_histograms
+
+DEFAULT_REQUEST = 1
+DEFAULT_RESPONSE = 1
+# UDP requests carry a sequence number in their first bytes, echoed
+# back by the server so late responses to retried requests are ignored
+SEQ = struct.Struct("<Q")
+# how often outstanding UDP requests are checked for a timeout
+CHECK_INTERVAL = 0.01
+DEFAULT_RR_TIMEOUT = 1.0
+RECV_SIZE = 65536
+
+def rr_sizes(params):
+    '''Request and response sizes of a request/response test. UDP
+    requests and responses carry the whole sequence number.
+    '''
+    request = params.get("request_size") or DEFAULT_REQUEST
+    response = params.get("response_size") or DEFAULT_RESPONSE
+    if params.get("udp"):
+        return (max(request, SEQ.size), max(response, SEQ.size))
+    return (request, response)
+
+def stamp_response(response, request):
+    '''Copy the sequence number at the start of request into response'''
+    size = min(SEQ.size, len(request), len(response))
+    response[:size] = request[:size]
+
+class RRLoop():
+    '''Drive all request/response streams of a test from one thread.
+    Small transactions on hundreds of streams are dominated by
+    per-thread overhead, one selector loop avoids it. The loop starts
+    once every stream attached to it has been started.
+    '''
+    def __init__(self, params):
+        self.params = params
+        self.streams = []
+        self.started = []
+        self.done = False
+        self.worker = None
+
+    def attach(self, stream):
+        '''A stream for this loop has been created'''
+        self.streams.append(stream)
+
+    def rearm(self, params):
+        '''Prepare to run another test with the same streams'''
+        if self.worker is not None and self.worker.is_alive():
+            return
+        self.params = params
+        self.started = []
+        self.done = False
+        self.worker = None
+
+    def add(self, stream):
+        '''A stream has been started, run the loop once all have'''
+        self.started.append(stream)
+        if len(self.started) == len(self.streams):
+            self.worker = threading.Thread(target=self.run, name="rr")
+            self.worker.start()
+
+    def run(self):
+        '''Run transactions on all streams for the test duration'''
+        selector = selectors.DefaultSelector()
+        now = time.clock_gettime(time.CLOCK_MONOTONIC)
+        end = now + self.params["time"]
+        for stream in self.streams:
+            stream.lock.acquire()
+        # the locks are released whatever happens, results are collected under them
+        try:
+            for stream in self.streams:
+                stream.start_time = now
+                stream.begin(selector, now)
+            next_check = now + CHECK_INTERVAL
+            while not self.done and now < end:
+                events = selector.select(min(end - now, CHECK_INTERVAL))
+                now = time.clock_gettime(time.CLOCK_MONOTONIC)
+                for (key, mask) in events:
+                    key.data.event(mask, now)
+                if now >= next_check:
+                    for stream in self.streams:
+                        stream.check_timeout(now)
+                    next_check = now + CHECK_INTERVAL
+        except OSError:
+            # connection errors end the test, the results so far are kept
+            pass
+        finally:
+            try:
+                for stream in self.streams:
+                    stream.stop(selector)
+                    stream.finish(now)
+            finally:
+                for stream in self.streams:
+                    stream.lock.release()
+                selector.close()
+
+class RRStream():
+    '''Request/response behaviour shared by TCP and UDP streams'''
+
+    def setup_rr(self, loop):
+        '''Set up transaction state'''
+        self.loop = loop
+        loop.attach(self)
+        (request_size, response_size) = rr_sizes(self.params)
+        self.request_buff = bytearray(request_size)
+        self.response_size = response_size
+        self.pending = 0
+        # bytes of the current request already sent and the selector
+        # watching the stream, it waits for writable while a request is
+        # only partly sent
+        self.unsent = 0
+        self.selector = None
+        self.writing = False
+        self.sent_at = 0.0
+        self.seq = 0
+        self.transactions = 0
+        self.timeouts = 0
+        self.rtt = Histogram()
+        self.timeout = self.config.get("rr_timeout", DEFAULT_RR_TIMEOUT)
+
+    def reset(self, params):
+        '''Prepare an already connected stream for another test'''
+        super().reset(params)
+        self.loop.rearm(params)
+        (request_size, response_size) = rr_sizes(params)
+        self.request_buff = bytearray(request_size)
+        self.response_size = response_size
+        self.writing = False
+        self.transactions = 0
+        self.timeouts = 0
+        self.rtt = Histogram()
+
+    def start(self):
+        '''Hand the stream to the loop instead of running a thread'''
+        self.sock.setblocking(False)
+        self.loop.add(self)
+
+    def begin(self, selector, now):
+        '''Register with the loop and send the first request'''
+        self.selector = selector
+        selector.register(self.sock, selectors.EVENT_READ, self)
+        self.request(now)
+
+    def event(self, mask, now):
+        '''The stream socket is ready'''
+        if mask & selectors.EVENT_WRITE:
+            self.flush()
+        if mask & selectors.EVENT_READ:
+            self.readable(now)
+
+    def stop(self, selector):
+        '''Unregister from the loop, if the stream got as far as registering'''
+        try:
+            selector.unregister(self.sock)
+        except KeyError:
+            pass
+
+    def request(self, now):
+        '''Send the next request'''
+        self.seq = self.seq + 1
+        stamp_response(self.request_buff, SEQ.pack(self.seq))
+        self.sent_at = now
+        self.pending = self.response_size
+        self.unsent = 0
+        self.flush()
+
+    def flush(self):
+        '''Send as much of the current request as the socket takes,
+        waiting for it to become writable if some is left
+        '''
+        view = memoryview(self.request_buff)
+        while self.unsent < len(view):
+            try:
+                self.unsent = self.unsent + self.sock.send(view[self.unsent:])
+            except BlockingIOError:
+                break
+        writing = self.unsent < len(view)
+        if writing != self.writing:
+            events = selectors.EVENT_READ
+            if writing:
+                events = events | selectors.EVENT_WRITE
+            self.selector.modify(self.sock, events, self)
+            self.writing = writing
+
+    def complete(self, now):
+        '''A response has fully arrived, start the next transaction'''
+        self.rtt.record(now - self.sent_at)
+        self.transactions = self.transactions + 1
+        self.counters.packet_count = self.transactions
+        self.request(now)
+
+    # pylint: disable=unused-argument
+    def check_timeout(self, now):
+        '''Retry lost requests, only needed for UDP'''
+
+    def finish(self, now):
+        '''Fill in the stream result'''
+        seconds = now - self.start_time
+        self.result.update({"bytes": self.total,
+                            "retransmits": 0,
+                            "jitter": 0.0,
+                            "errors": self.timeouts,
+                            "packets": self.transactions,
+                            "out_of_order": 0,
+                            "start_time": 0,
+                            "end_time": seconds,
+                            "transactions": self.transactions,
+                            "transactions_per_second": 0.0})
+        if seconds > 0:
+            self.result["transactions_per_second"] = self.transactions / seconds
+        if self.rtt.total > 0:
+            self.result["rtt"] = self.rtt.percentiles()
+            self.result["rtt_histogram"] = self.rtt.to_json()
+
+    def shutdown(self):
+        '''Stop the loop, then the stream'''
+        self.loop.done = True
+        self.worker = self.loop.worker
+        super().shutdown()
+
+class TCPRRClient(RRStream, TCPClient):
+    '''TCP request/response stream'''
+    def __init__(self, config, params, stream_id, loop):
+        super().__init__(config, params, stream_id)
+        self.setup_rr(loop)
+
+    def readable(self, now):
+        '''Part of a response has arrived'''
+        try:
+            received = len(self.sock.recv(RECV_SIZE))
+        except BlockingIOError:
+            return
+        if received == 0:
+            self.loop.done = True
+            return
+        self.total = self.total + received
+        self.pending = self.pending - received
+        if self.pending <= 0:
+            self.complete(now)
+
+class UDPRRClient(RRStream, UDPClient):
+    '''UDP request/response stream'''
+    def __init__(self, config, params, stream_id, loop):
+        super().__init__(config, params, stream_id)
+        self.setup_rr(loop)
+
+    def readable(self, now):
+        '''A response datagram has arrived'''
+        try:
+            response = self.sock.recv(RECV_SIZE)
+        except BlockingIOError:
+            return
+        self.total = self.total + len(response)
+        size = min(SEQ.size, len(self.request_buff), len(response))
+        if response[:size] == self.request_buff[:size]:
+            self.complete(now)
+
+    def check_timeout(self, now):
+        '''Count the transaction as lost and send a new request'''
+        if now - self.sent_at > self.timeout:
+            self.timeouts = self.timeouts + 1
+            self.request(now)
+
+def rr_results(streams):
+    '''Transaction totals and merged RTT distribution of all streams'''
+    result = {"transactions": sum([stream.get("transactions", 0) for stream in streams]),
+              "transactions_per_second": sum([stream.get("transactions_per_second", 0.0)
+                                              for stream in streams]),
+              "timeouts": sum([stream.get("errors", 0) for stream in streams])}
+    rtt = merge_histograms(streams, "rtt_histogram")
+    if rtt is not None:
+        result["rtt"] = rtt.percentiles()
+    return result
+
+class RRResponder():
+    '''Server side of request/response streams, answers each complete
+    request with a response
+    '''
+    def __init__(self, params):
+        (self.request_size, response_size) = rr_sizes(params)
+        self.response = bytearray(response_size)
+
+    def respond_udp(self, sock, request, addr):
+        '''Answer a UDP request, echoing its sequence number'''
+        stamp_response(self.response, request)
+        sock.sendto(self.response, addr)
+
+    def respond_tcp(self, sock, pending, received):
+        '''Answer all TCP requests completed by received bytes, returns
+        the bytes of the next request received so far
+        '''
+        pending = pending + received
+        while pending >= self.request_size:
+            sock.sendall(self.response)
+            pending = pending - self.request_size
+        return pending
@@ -0,0 +1,131 @@
+#!/usr/bin/python3
+'''Iperf maximum lossless rate search'''
+
+# pyiperf, Copyright (c) 2023 RedHat Inc
+# pyiperf, Copyright (c) 2023 Cambridge Greys Ltd
+
+# This source code is licensed under both the BSD-style license (found in the
+# LICENSE file in the root directory of this source tree) and the GPLv2 (found
+# in the COPYING file in the root directory of this source tree).
+# You may select, at your option, one of the above-listed licenses.
+
+import copy
+import sys
+from iperf_control import DISPLAY_RESULTS
+from iperf_session import SessionClient, shutdown_streams
+
+# Stop when the search window is narrower than this fraction of the rate
+RESOLUTION = 0.01
+MAX_TRIALS = 20
+
+class RateSearchClient(SessionClient):
+    '''Find the highest UDP rate carried with loss under a tolerance.
+    Runs short trials as a session over the same streams, bisecting
+    between the highest rate which passed and the lowest which failed.
+    The first trial is at max_rate (bits/sec) or unlimited if it is 0,
+    if it passes that is the result.
+    '''
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, config, params, tolerance=0.0, trial=1.0, max_rate=0, output=sys.stdout):
+        spec = {"udp": True, "time": trial}
+        super().__init__(config, params, [spec], output)
+        self.plan[0]["session"] = True
+        self.tolerance = tolerance
+        self.rate = max_rate
+        self.low = 0
+        self.high = None
+        self.trials = []
+        self.resolution = RESOLUTION
+        self.max_trials = MAX_TRIALS
+
+    def converged(self):
+        '''The search is complete'''
+        if len(self.trials) >= self.max_trials:
+            return True
+        return self.high is not None and self.high - self.low <= self.resolution * self.high
+
+    def has_next(self):
+        '''Keep running trials until the search converges'''
+        return not self.converged()
+
+    def create_streams(self):
+        '''Create streams and pace them at the trial rate'''
+        result = super().create_streams()
+        for stream in self.tx_streams:
+            stream.limit = self.rate / 8 / len(self.tx_streams)
+        return result
+
+    def release_streams(self):
+        '''Streams are kept for the whole search'''
+
+    def display_results(self):
+        '''Record the outcome of a trial and narrow the search window'''
+        if not self.needs_display:
+            return
+        self.needs_display = False
+
+        duration = self.params["time"]
+        sent = sum([stream["bytes"] for stream in self.results["streams"]])
+        received = sum([stream["bytes"] for stream in self.peer_result["streams"]])
+        lost = sum([stream["errors"] for stream in self.peer_result["streams"]])
+        packets = sum([stream["packets"] for stream in self.peer_result["streams"]])
+        if packets > 0:
+            loss = lost / packets
+        else:
+            loss = 1.0
+        offered = sent * 8 / duration
+
+        self.trials.append({"trial": len(self.trials) + 1,
+                            "rate": self.rate,
+                            "offered": offered,
+                            "received": received * 8 / duration,
+                            "packets": packets,
+                            "lost": lost,
+                            "loss": loss})
+
+        if loss <= self.tolerance:
+            self.low = max(self.low, offered)
+            if self.high is None:
+                # the first trial, at max_rate or unlimited, was lossless -
+                # there is nothing above it to search
+                self.high = self.low
+        elif self.high is None:
+            self.high = offered
+        else:
+            self.high = min(self.high, offered)
+        if self.high is not None:
+            self.rate = (self.low + self.high) / 2
+
+    def next_test(self):
+        '''Schedule the next trial'''
+        test_params = copy.deepcopy(self.plan[0])
+        test_params["warm_streams"] = True
+        self.plan.append(test_params)
+        super().next_test()
+
+    def report(self):
+        '''Print the per trial table and the converged rate'''
+        self.output.write("{:>5} {:>14} {:>14} {:>14} {:>10} {:>10}\n".format(
+            "Trial", "Target Mb/s", "Offered Mb/s", "Received Mb/s", "Lost", "Loss %"))
+        for trial in self.trials:
+            self.output.write("{:>5} {:>14.3f} {:>14.3f} {:>14.3f} {:>10} {:>10.4f}\n".format(
+                trial["trial"], trial["rate"] / 1E6, trial["offered"] / 1E6,
+                trial["received"] / 1E6, trial["lost"], trial["loss"] * 100))
+        self.output.write("Max rate with loss <= {}%: {:.3f} Mbits/sec\n".format(
+            self.tolerance * 100, self.low / 1E6))
+        self.output.flush()
+
+    def end_test(self):
+        '''Finish the search'''
+        if not self.test_ended:
+            shutdown_streams(self.tx_streams)
+            self.tx_streams = []
+            self.report()
+        return super().end_test()
+
+    def state_transition(self, new_state):
+        '''Record each trial before deciding whether to run another'''
+        if new_state == DISPLAY_RESULTS and self.peer_result is not None:
+            self.display_results()
+        return super().state_transition(new_state)
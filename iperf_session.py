@@ -0,0 +1,127 @@
+#!/usr/bin/python3
+'''Iperf multi-test sessions'''
+
+# pyiperf, Copyright (c) 2023 RedHat Inc
+# pyiperf, Copyright (c) 2023 Cambridge Greys Ltd
+
+# This source code is licensed under both the BSD-style license (found in the
+# LICENSE file in the root directory of this source tree) and the GPLv2 (found
+# in the COPYING file in the root directory of this source tree).
+# You may select, at your option, one of the above-listed licenses.
+
+import copy
+import json
+import sys
+import threading
+from iperf_control import TestClient, DISPLAY_RESULTS
+
+# Params which must match for streams to be reused by the next test
+STREAM_KEYS = ["tcp", "udp", "parallel", "len", "rr", "crr", "local", "verify", "verify_seed",
+               "repeating_payload"]
+
+def make_plan(params, specs):
+    '''Expand a list of test specs into the params for each test'''
+    plan = []
+    for spec in specs:
+        test_params = copy.deepcopy(params)
+        if spec.get("udp"):
+            test_params.pop("tcp", None)
+        if spec.get("tcp"):
+            test_params.pop("udp", None)
+        test_params.update(spec)
+        test_params["session"] = True
+        test_params["warm_streams"] = False
+        plan.append(test_params)
+
+    if len(plan) > 0:
+        plan[-1]["session"] = False
+    for index in range(1, len(plan)):
+        plan[index]["warm_streams"] = \
+            all(plan[index].get(key) == plan[index - 1].get(key) for key in STREAM_KEYS)
+    return plan
+
+def shutdown_streams(streams):
+    '''Shut down a list of streams'''
+    for stream in streams:
+        stream.shutdown()
+
+class SessionClient(TestClient):
+    '''Run a list of tests against one server over one control connection.
+    Data streams are reused between tests when their parameters allow it,
+    otherwise teardown of the old streams overlaps setup of the next test.
+    Results for each test are written as a line of JSON.
+    '''
+
+    def __init__(self, config, params, specs, output=sys.stdout):
+        self.plan = make_plan(params, specs)
+        super().__init__(config, self.plan[0])
+        self.specs = specs
+        self.current = 0
+        self.output = output
+        self.teardown = None
+
+    def has_next(self):
+        '''There are more tests to run in this session'''
+        return self.current + 1 < len(self.plan)
+
+    def release_streams(self):
+        '''Keep streams for the next test or tear them down in the background'''
+        if not self.has_next():
+            super().release_streams()
+            return
+        if self.plan[self.current + 1]["warm_streams"]:
+            return
+        self.join_teardown()
+        self.teardown = threading.Thread(target=shutdown_streams, args=(self.tx_streams,), name="teardown")
+        self.teardown.start()
+        self.tx_streams = []
+
+    def join_teardown(self):
+        '''Wait for background teardown to finish'''
+        if self.teardown is not None:
+            self.teardown.join()
+            self.teardown = None
+
+    def create_streams(self):
+        '''Create streams or reuse the ones from the previous test'''
+        if not self.params.get("warm_streams"):
+            return super().create_streams()
+        for stream in self.tx_streams:
+            stream.reset(self.params)
+        return True
+
+    def open_output(self):
+        '''Session results are always written as JSON lines'''
+
+    def display_results(self):
+        '''Write the test results as a line of JSON'''
+        if self.needs_display:
+            self.needs_display = False
+            self.output.write(json.dumps({"test": self.current,
+                                          "spec": self.specs[self.current],
+                                          "result": self.results,
+                                          "peer_result": self.peer_result}) + "\n")
+            self.output.flush()
+
+    def next_test(self):
+        '''Move on to the next test in the session'''
+        self.cancel_timers()
+        self.current = self.current + 1
+        self.params = self.plan[self.current]
+        self.results = None
+        self.peer_result = None
+        self.needs_display = True
+
+    def end_test(self):
+        '''Finish the session'''
+        self.join_teardown()
+        return super().end_test()
+
+    def state_transition(self, new_state):
+        '''Transition iperf state, staying connected between tests'''
+        if new_state == DISPLAY_RESULTS and self.peer_result is not None and self.has_next():
+            self.state = new_state
+            self.display_results()
+            self.next_test()
+            return True
+        return super().state_transition(new_state)
@@ -0,0 +1,150 @@
+#!/usr/bin/python3
+'''Iperf soak test rollups'''
+
+# pyiperf, Copyright (c) 2023 RedHat Inc
+# pyiperf, Copyright (c) 2023 Cambridge Greys Ltd
+
+# This source code is licensed under both the BSD-style license (found in the
+# LICENSE file in the root directory of this source tree) and the GPLv2 (found
+# in the COPYING file in the root directory of this source tree).
+# You may select, at your option, one of the above-listed licenses.
+
+from array import array
+
+# Rollup tiers as (reporting intervals per entry, entries kept). With the
+# default 1s interval these are 10s entries for an hour and 1 min entries
+# for a day.
+TIERS = [(10, 360), (60, 1440)]
+# Raw intervals kept, enough to roll up the largest tier exactly
+RAW_SIZE = 60
+FIELDS = ["min", "max", "mean", "p50", "p90", "p99"]
+
+def percentile(ordered, percent):
+    '''Nearest rank percentile of a sorted list'''
+    return ordered[min(len(ordered) - 1, int(len(ordered) * percent / 100))]
+
+class Ring():
+    '''Fixed number of rollup entries, the oldest are overwritten'''
+    def __init__(self, span, size):
+        self.span = span
+        self.size = size
+        self.head = 0
+        self.count = 0
+        self.start = array("d", [0.0] * size)
+        self.fields = {field: array("d", [0.0] * size) for field in FIELDS}
+
+    def add(self, start, values):
+        '''Roll up a window of raw values into one entry'''
+        ordered = sorted(values)
+        slot = self.head
+        self.start[slot] = start
+        self.fields["min"][slot] = ordered[0]
+        self.fields["max"][slot] = ordered[-1]
+        self.fields["mean"][slot] = sum(ordered) / len(ordered)
+        self.fields["p50"][slot] = percentile(ordered, 50)
+        self.fields["p90"][slot] = percentile(ordered, 90)
+        self.fields["p99"][slot] = percentile(ordered, 99)
+        self.head = (slot + 1) % self.size
+        self.count = min(self.count + 1, self.size)
+
+    def to_json(self, interval):
+        '''Entries oldest first, one list per field'''
+        slots = [(self.head - self.count + offset) % self.size for offset in range(self.count)]
+        result = {"seconds": self.span * interval,
+                  "start": [self.start[slot] for slot in slots]}
+        for field in FIELDS:
+            result[field] = [self.fields[field][slot] for slot in slots]
+        return result
+
+class Series():
+    '''Rollups of one metric of one stream'''
+    def __init__(self):
+        self.raw = array("d", [0.0] * RAW_SIZE)
+        self.raw_start = array("d", [0.0] * RAW_SIZE)
+        self.count = 0
+        self.rolled = [0] * len(TIERS)
+        self.tiers = [Ring(span, size) for (span, size) in TIERS]
+        self.minimum = None
+        self.maximum = None
+        self.total = 0.0
+
+    def window(self, length):
+        '''The last length raw values and the start of the oldest'''
+        slots = [(self.count - length + offset) % RAW_SIZE for offset in range(length)]
+        return (self.raw_start[slots[0]], [self.raw[slot] for slot in slots])
+
+    def add(self, start, value):
+        '''Add one interval value, rolling up every tier which is due'''
+        slot = self.count % RAW_SIZE
+        self.raw[slot] = value
+        self.raw_start[slot] = start
+        self.count = self.count + 1
+        if self.minimum is None or value < self.minimum:
+            self.minimum = value
+        if self.maximum is None or value > self.maximum:
+            self.maximum = value
+        self.total = self.total + value
+        for index in range(len(self.tiers)):
+            if self.count - self.rolled[index] == self.tiers[index].span:
+                self.tiers[index].add(*self.window(self.tiers[index].span))
+                self.rolled[index] = self.count
+
+    def finish(self):
+        '''Roll up the partial windows left at the end of the test'''
+        for index in range(len(self.tiers)):
+            if self.count > self.rolled[index]:
+                self.tiers[index].add(*self.window(self.count - self.rolled[index]))
+                self.rolled[index] = self.count
+
+    def to_json(self, interval):
+        '''Whole test summary and the rollups'''
+        result = {"count": self.count, "min": self.minimum, "max": self.maximum, "mean": None}
+        if self.count > 0:
+            result["mean"] = self.total / self.count
+        result["rollups"] = [tier.to_json(interval) for tier in self.tiers]
+        return result
+
+class SoakRecorder():
+    '''Per stream interval rollups for long tests. Memory use depends
+    only on the number of streams, not on the length of the test.
+    '''
+    def __init__(self, interval):
+        self.interval = interval
+        self.streams = {}
+
+    def record(self, stream, start, values):
+        '''Add interval values for a stream'''
+        series = self.streams.setdefault(stream, {})
+        for (metric, value) in values.items():
+            if metric not in series:
+                series[metric] = Series()
+            series[metric].add(start, value)
+
+    def add(self, start, seconds, samples, netstat=None):
+        '''Add an interval of per stream byte, packet and CPU deltas and
+        optionally the kernel counter deltas, rolled up as rates per second
+        '''
+        if netstat is not None:
+            self.record("netstat", start, {key: value / seconds for (key, value) in netstat.items()
+                                           if key != "interface"})
+        total = {"bits_per_second": 0.0, "packets_per_second": 0.0}
+        for sample in samples:
+            values = {"bits_per_second": sample["bytes"] * 8 / seconds,
+                      "packets_per_second": sample["packets"] / seconds}
+            if sample.get("cpu") is not None:
+                values["cpu_percent"] = 100 * sample["cpu"] / seconds
+            for metric in values:
+                total[metric] = total.get(metric, 0.0) + values[metric]
+            self.record(sample["socket"], start, values)
+        self.record("sum", start, total)
+
+    def to_json(self):
+        '''Rollups for the results'''
+        streams = []
+        for (stream, series) in self.streams.items():
+            entry = {"socket": stream}
+            for (metric, values) in series.items():
+                values.finish()
+                entry[metric] = values.to_json(self.interval)
+            streams.append(entry)
+        return {"interval": self.interval, "streams": streams}
@@ -0,0 +1,222 @@
+#!/usr/bin/python3
+'''Iperf repeat until stable runner'''
+
+# pyiperf, Copyright (c) 2023 RedHat Inc
+# pyiperf, Copyright (c) 2023 Cambridge Greys Ltd
+
+# This source code is licensed under both the BSD-style license (found in the
+# LICENSE file in the root directory of this source tree) and the GPLv2 (found
+# in the COPYING file in the root directory of this source tree).
+# You may select, at your option, one of the above-listed licenses.
+
+import copy
+import math
+import statistics
+import sys
+from iperf_control import DISPLAY_RESULTS
+from iperf_session import SessionClient, shutdown_streams
+
+METRICS = ["throughput", "loss", "latency"]
+DEFAULT_WARMUP = 1
+# measured runs needed before the confidence interval is trusted
+MIN_RUNS = 3
+DEFAULT_MAX_RUNS = 20
+DEFAULT_CONFIDENCE = 0.95
+# target confidence interval half width as a fraction of the mean
+DEFAULT_WIDTH = 0.02
+# Tukey fences, runs further than this many IQRs outside the quartiles
+OUTLIER_IQR = 1.5
+
+def t_cdf(t, df):
+    '''Student's t distribution function for an integer df, closed form'''
+    if df % 2 == 0:
+        term = 1.0
+        total = 1.0
+        for k in range(1, df // 2):
+            term = term * (2 * k - 1) / (2 * k) * df / (df + t * t)
+            total = total + term
+        return 0.5 + t / (2 * math.sqrt(df + t * t)) * total
+    theta = math.atan(t / math.sqrt(df))
+    total = 0.0
+    if df > 1:
+        term = 1.0
+        total = 1.0
+        for k in range(1, (df - 1) // 2):
+            term = term * 2 * k / (2 * k + 1) * math.cos(theta) ** 2
+            total = total + term
+    return 0.5 + (theta + math.sin(theta) * math.cos(theta) * total) / math.pi
+
+def t_quantile(probability, df):
+    '''Student's t quantile, solved by bisection on the exact
+    distribution function. The runner only has a handful of degrees of
+    freedom, where expansions around the normal quantile are too far off
+    at high confidence.
+    '''
+    (low, high) = (-1.0, 1.0)
+    while t_cdf(high, df) < probability:
+        high = high * 2
+    while t_cdf(low, df) > probability:
+        low = low * 2
+    for _ in range(100):
+        middle = (low + high) / 2
+        if t_cdf(middle, df) < probability:
+            low = middle
+        else:
+            high = middle
+    return (low + high) / 2
+
+def summarize(values, confidence):
+    '''Mean, confidence interval, coefficient of variation and outliers'''
+    result = {"runs": len(values), "mean": None, "ci": None, "half_width": None, "cov": None,
+              "outliers": []}
+    if len(values) == 0:
+        return result
+    mean = statistics.mean(values)
+    result["mean"] = mean
+    if len(values) < 2:
+        return result
+    stdev = statistics.stdev(values)
+    half = t_quantile((1 + confidence) / 2, len(values) - 1) * stdev / math.sqrt(len(values))
+    result["ci"] = [mean - half, mean + half]
+    result["half_width"] = half
+    if mean != 0:
+        result["cov"] = stdev / abs(mean)
+    if len(values) >= 4:
+        (low, _, high) = statistics.quantiles(values, n=4)
+        fence = OUTLIER_IQR * (high - low)
+        result["outliers"] = [index for (index, value) in enumerate(values)
+                              if value < low - fence or value > high + fence]
+    return result
+
+class StableClient(SessionClient):
+    '''Repeat a test until the confidence interval of a metric is narrow
+    enough or the run budget is spent. Warm-up runs are discarded. The
+    runs are a session over the same streams, so server and streams stay
+    warm between repetitions.
+    '''
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, config, params, metric="throughput", width=DEFAULT_WIDTH,
+                 warmup=DEFAULT_WARMUP, max_runs=DEFAULT_MAX_RUNS,
+                 confidence=DEFAULT_CONFIDENCE, output=sys.stdout):
+        super().__init__(config, params, [{}], output)
+        self.plan[0]["session"] = True
+        self.metric = metric
+        self.width = width
+        self.warmup = warmup
+        self.max_runs = max(max_runs, warmup + MIN_RUNS)
+        self.confidence = confidence
+        self.runs = []
+
+    def measured(self):
+        '''Runs which count towards the statistics'''
+        return self.runs[self.warmup:]
+
+    def stable(self):
+        '''The confidence interval of the metric is narrow enough'''
+        values = [run[self.metric] for run in self.measured() if run[self.metric] is not None]
+        if len(values) < MIN_RUNS:
+            return False
+        summary = summarize(values, self.confidence)
+        return summary["half_width"] <= self.width * abs(summary["mean"])
+
+    def has_next(self):
+        '''Keep repeating until stable or out of runs'''
+        return len(self.runs) < self.max_runs and not self.stable()
+
+    def release_streams(self):
+        '''Streams are kept for all repetitions'''
+
+    def display_results(self):
+        '''Record the metrics of a run'''
+        if not self.needs_display:
+            return
+        self.needs_display = False
+
+        if self.params.get("reverse") is None:
+            received = self.peer_result
+        else:
+            received = self.results
+        duration = self.params["time"]
+        run = {"run": len(self.runs) + 1,
+               "warmup": len(self.runs) < self.warmup,
+               "throughput": sum([stream["bytes"] for stream in received["streams"]]) * 8 / duration,
+               "loss": None,
+               "latency": None}
+        if self.params.get("udp") is not None:
+            packets = sum([stream["packets"] for stream in received["streams"]])
+            lost = sum([stream["errors"] for stream in received["streams"]])
+            if packets > 0:
+                run["loss"] = 100 * lost / packets
+        if self.results.get("rr") is not None and self.results["rr"].get("rtt") is not None:
+            run["latency"] = self.results["rr"]["rtt"]["p50"]
+        elif received.get("delay") is not None:
+            run["latency"] = received["delay"]["p50"]
+        self.runs.append(run)
+
+    def next_test(self):
+        '''Schedule another repetition'''
+        test_params = copy.deepcopy(self.plan[0])
+        test_params["warm_streams"] = True
+        self.plan.append(test_params)
+        super().next_test()
+
+    def summary(self):
+        '''Statistics of every metric over the measured runs'''
+        result = {"metric": self.metric,
+                  "confidence": self.confidence,
+                  "width": self.width,
+                  "warmup": self.warmup,
+                  "stable": self.stable(),
+                  "runs": self.runs}
+        for metric in METRICS:
+            values = [run[metric] for run in self.measured() if run[metric] is not None]
+            if len(values) > 0:
+                result[metric] = summarize(values, self.confidence)
+        return result
+
+    def report(self):
+        '''Print the per run table and the statistics'''
+        summary = self.summary()
+        self.output.write("{:>4} {:>14} {:>10} {:>14}\n".format("Run", "Mbits/sec", "Loss %",
+                                                                 "Latency ms"))
+        for run in self.runs:
+            self.output.write("{:>4} {:>14.3f} {:>10} {:>14}{}\n".format(
+                run["run"], run["throughput"] / 1E6,
+                "-" if run["loss"] is None else "{:.4f}".format(run["loss"]),
+                "-" if run["latency"] is None else "{:.4f}".format(run["latency"] * 1E3),
+                " (warm-up)" if run["warmup"] else ""))
+        scales = {"throughput": (1E-6, "Mbits/sec"), "loss": (1, "%"), "latency": (1E3, "ms")}
+        for metric in METRICS:
+            stats = summary.get(metric)
+            if stats is None or stats["ci"] is None:
+                continue
+            (scale, unit) = scales[metric]
+            outliers = [self.warmup + index + 1 for index in stats["outliers"]]
+            self.output.write("{} mean {:.4f} {} {:.0f}% CI [{:.4f}, {:.4f}] +-{:.2f}% CoV {} "
+                              "outlier runs {}\n".format(
+                                  metric, stats["mean"] * scale, unit, self.confidence * 100,
+                                  stats["ci"][0] * scale, stats["ci"][1] * scale,
+                                  100 * stats["half_width"] / abs(stats["mean"])
+                                  if stats["mean"] != 0 else 0.0,
+                                  "-" if stats["cov"] is None else "{:.2f}%".format(stats["cov"] * 100),
+                                  outliers if len(outliers) > 0 else "none"))
+        if summary["stable"]:
+            self.output.write("Stable after {} runs\n".format(len(self.runs)))
+        else:
+            self.output.write("Not stable within {} runs\n".format(len(self.runs)))
+        self.output.flush()
+
+    def end_test(self):
+        '''Finish the repetitions'''
+        if not self.test_ended:
+            shutdown_streams(self.tx_streams)
+            self.tx_streams = []
+            self.report()
+        return super().end_test()
+
+    def state_transition(self, new_state):
+        '''Record each run before deciding whether to run another'''
+        if new_state == DISPLAY_RESULTS and self.peer_result is not None:
+            self.display_results()
+        return super().state_transition(new_state)
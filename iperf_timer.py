@@ -0,0 +1,158 @@
+#!/usr/bin/python3
+'''Iperf timer wheel'''
+
+# pyiperf, Copyright (c) 2023 RedHat Inc
+# pyiperf, Copyright (c) 2023 Cambridge Greys Ltd
+
+# This source code is licensed under both the BSD-style license (found in the
+# LICENSE file in the root directory of this source tree) and the GPLv2 (found
+# in the COPYING file in the root directory of this source tree).
+# You may select, at your option, one of the above-listed licenses.
+
+import time
+from iperf_histogram import Histogram
+
+# Resolution of the wheel in nanoseconds
+TICK = 1000000
+# Each level has 2^WHEEL_BITS slots, a slot of level n spans 2^(WHEEL_BITS*n)
+# ticks. Four levels reach 2^32 ticks, about 49 days.
+WHEEL_BITS = 8
+SLOTS = 1 << WHEEL_BITS
+MASK = SLOTS - 1
+LEVELS = 4
+
+def monotonic():
+    '''The clock all timers and streams run on'''
+    return time.clock_gettime(time.CLOCK_MONOTONIC)
+
+def monotonic_ns():
+    '''The same clock in nanoseconds, ticks are counted in integers so
+    a wakeup at the start of a tick always sees that tick
+    '''
+    return time.clock_gettime_ns(time.CLOCK_MONOTONIC)
+
+class Timer():
+    '''A scheduled callback, cancel() it to stop it from firing'''
+    def __init__(self, wheel, deadline, expires, callback, args):
+        self.wheel = wheel
+        self.deadline = deadline
+        self.expires = expires
+        self.callback = callback
+        self.args = args
+        self.slot = None
+
+    def cancel(self):
+        '''Stop the timer from firing, harmless if it already has'''
+        self.callback = None
+        if self.slot is not None:
+            self.slot.remove(self)
+            self.slot = None
+            self.wheel.count = self.wheel.count - 1
+
+class TimerWheel():
+    '''Hierarchical timer wheel. Timers are filed in the slot of the
+    level matching how far out they expire and cascade down a level each
+    time the level below wraps, so scheduling and cancelling cost the
+    same however many timers are pending. The wheel has no thread of its
+    own, the thread owning it waits for at most timeout() and then calls
+    run(). Callbacks run on that thread. How late each timer fires is
+    recorded in lateness.
+    '''
+    def __init__(self, tick=TICK):
+        self.tick = tick
+        self.current = monotonic_ns() // tick
+        self.levels = [[[] for _ in range(SLOTS)] for _ in range(LEVELS)]
+        self.ready = []
+        # timers which have not fired or been cancelled
+        self.count = 0
+        self.lateness = Histogram()
+
+    def schedule(self, delay, callback, *args):
+        '''Run callback(*args) in delay seconds'''
+        return self.schedule_at(monotonic() + delay, callback, *args)
+
+    def schedule_at(self, deadline, callback, *args):
+        '''Run callback(*args) at a monotonic deadline'''
+        # rounded up, a timer never fires early
+        timer = Timer(self, deadline, -(-int(deadline * 1E9) // self.tick), callback, args)
+        self.insert(timer)
+        self.count = self.count + 1
+        return timer
+
+    def insert(self, timer):
+        '''File a timer in the slot it expires in'''
+        delta = timer.expires - self.current
+        if delta <= 0:
+            slot = self.ready
+        else:
+            level = 0
+            while level < LEVELS - 1 and delta >= 1 << (WHEEL_BITS * (level + 1)):
+                level = level + 1
+            slot = self.levels[level][(timer.expires >> (WHEEL_BITS * level)) & MASK]
+        slot.append(timer)
+        timer.slot = slot
+
+    def cascade(self, level):
+        '''Move the timers of the current slot of a level down a level'''
+        slot = self.levels[level][(self.current >> (WHEEL_BITS * level)) & MASK]
+        timers = list(slot)
+        slot.clear()
+        for timer in timers:
+            self.insert(timer)
+
+    def next_expiry(self):
+        '''Tick at which the wheel next has work to do, None if idle'''
+        if len(self.ready) > 0:
+            return self.current
+        found = None
+        for level in range(LEVELS):
+            shift = WHEEL_BITS * level
+            index = self.current >> shift
+            # a timer may sit a whole turn ahead in the slot just passed
+            for step in range(1, SLOTS + 1):
+                if len(self.levels[level][(index + step) & MASK]) > 0:
+                    # a slot above level 0 is cascaded when its first tick comes up
+                    start = (index + step) << shift
+                    if found is None or start < found:
+                        found = start
+                    break
+        return found
+
+    def timeout(self):
+        '''Seconds until the next timer is due, None if there is none'''
+        expiry = self.next_expiry()
+        if expiry is None:
+            return None
+        return max(expiry * self.tick - monotonic_ns(), 0) / 1E9
+
+    def run(self):
+        '''Fire every timer which is due, returns how many fired'''
+        target = monotonic_ns() // self.tick
+        fired = 0
+        while True:
+            while len(self.ready) > 0:
+                timer = self.ready.pop(0)
+                timer.slot = None
+                self.count = self.count - 1
+                callback = timer.callback
+                timer.callback = None
+                self.lateness.record(max(monotonic() - timer.deadline, 0))
+                callback(*timer.args)
+                fired = fired + 1
+            if self.current >= target:
+                return fired
+            # ticks with nothing to fire or cascade are skipped
+            expiry = self.next_expiry()
+            if expiry is None or expiry > target:
+                self.current = target
+                return fired
+            self.current = max(expiry, self.current + 1)
+            for level in range(1, LEVELS):
+                if self.current & ((1 << (WHEEL_BITS * level)) - 1) != 0:
+                    break
+                self.cascade(level)
+            slot = self.levels[0][self.current & MASK]
+            for timer in slot:
+                timer.slot = self.ready
+            self.ready.extend(slot)
+            slot.clear()
@@ -0,0 +1,216 @@
+#!/usr/bin/python3
+'''Iperf UDP packet traces'''
+
+# pyiperf, Copyright (c) 2023 RedHat Inc
+# pyiperf, Copyright (c) 2023 Cambridge Greys Ltd
+
+# This source code is licensed under both the BSD-style license (found in the
+# LICENSE file in the root directory of this source tree) and the GPLv2 (found
+# in the COPYING file in the root directory of this source tree).
+# You may select, at your option, one of the above-listed licenses.
+
+from argparse import ArgumentParser
+import json
+import mmap
+import os
+import struct
+
+MAGIC = b"PYIPTRC1"
+TRACE_VERSION = 1
+# magic, version, record size, capacity, records written - padded to 64
+HEADER = struct.Struct("<8sIIQQ")
+HEADER_SIZE = 64
+# sequence, sender timestamp in ns, receive timestamp in ns
+RECORD = struct.Struct("<Qqq")
+DEFAULT_RECORDS = 1 << 20
+# records processed at a time by the analyzer
+CHUNK = 1 << 22
+DEFAULT_BIN = 1.0
+
+def trace_path(path, stream_id):
+    '''Trace file of a stream'''
+    return "{}.{}".format(path, stream_id)
+
+class TraceRecorder():
+    '''Append fixed width packet records to a preallocated memory mapped
+    file. Once the file is full further packets are only counted. The
+    record count in the header is written when the trace is closed.
+    '''
+    def __init__(self, path, capacity=DEFAULT_RECORDS):
+        self.capacity = capacity
+        self.count = 0
+        self.dropped = 0
+        self.offset = HEADER_SIZE
+        size = HEADER_SIZE + capacity * RECORD.size
+        self.file = open(path, "w+b")
+        try:
+            # allocate now so that a full disk fails here, not with SIGBUS mid test
+            os.posix_fallocate(self.file.fileno(), 0, size)
+        except AttributeError:
+            self.file.truncate(size)
+        self.map = mmap.mmap(self.file.fileno(), size)
+        HEADER.pack_into(self.map, 0, MAGIC, TRACE_VERSION, RECORD.size, capacity, 0)
+        self.pack_into = RECORD.pack_into
+
+    def record(self, seq, sec, usec, received):
+        '''Record a packet, received is the receive time in ns'''
+        if self.count == self.capacity:
+            self.dropped = self.dropped + 1
+            return
+        self.pack_into(self.map, self.offset, seq, sec * 1000000000 + usec * 1000, received)
+        self.offset = self.offset + RECORD.size
+        self.count = self.count + 1
+
+    def close(self):
+        '''Write the record count and release the file'''
+        if self.map is None:
+            return
+        HEADER.pack_into(self.map, 0, MAGIC, TRACE_VERSION, RECORD.size, self.capacity, self.count)
+        self.map.flush()
+        self.map.close()
+        self.map = None
+        self.file.close()
+
+def load(path):
+    '''Map a trace file as a NumPy record array'''
+    # pylint: disable=import-outside-toplevel
+    import numpy as np
+
+    with open(path, "rb") as trace:
+        (magic, version, record_size, capacity, count) = HEADER.unpack(trace.read(HEADER.size))
+    if magic != MAGIC or version != TRACE_VERSION or record_size != RECORD.size:
+        raise ValueError("{} is not a pyiperf trace".format(path))
+    dtype = np.dtype([("seq", "<u8"), ("sent", "<i8"), ("received", "<i8")])
+    if count == 0:
+        # not closed - use the records written before the recorder died
+        # in chunks from the end, the last written record ends the trace
+        records = np.memmap(path, dtype=dtype, mode="r", offset=HEADER_SIZE, shape=(capacity,))
+        for end in range(capacity, 0, -CHUNK):
+            written = np.flatnonzero(records["seq"][max(end - CHUNK, 0):end])
+            if len(written) > 0:
+                count = max(end - CHUNK, 0) + int(written[-1]) + 1
+                break
+    return np.memmap(path, dtype=dtype, mode="r", offset=HEADER_SIZE, shape=(max(count, 1),))[:count]
+
+def log_histogram_percentiles(counts, edges, percents):
+    '''Percentiles from a histogram, upper edge of the bucket'''
+    # pylint: disable=import-outside-toplevel
+    import numpy as np
+
+    total = counts.sum()
+    cumulative = np.cumsum(counts)
+    result = {}
+    for percent in percents:
+        index = int(np.searchsorted(cumulative, total * percent / 100))
+        result[str(percent)] = float(edges[min(index + 1, len(edges) - 1)])
+    return result
+
+def analyze(path, bin_seconds=DEFAULT_BIN):
+    '''Loss bursts, reordering, delay over time and inter-arrival times
+    of a trace. Work is done in chunks so traces larger than memory can
+    be analyzed. Delay is only meaningful if sender and receiver clocks
+    agree.
+    '''
+    # pylint: disable=import-outside-toplevel
+    import numpy as np
+
+    records = load(path)
+    count = len(records)
+    result = {"path": path, "packets": count}
+    if count == 0:
+        return result
+
+    max_seq = 0
+    for start in range(0, count, CHUNK):
+        max_seq = max(max_seq, int(records["seq"][start:start + CHUNK].max()))
+    # one byte per sequence number
+    present = np.zeros(max_seq + 1, dtype=np.uint8)
+    reordered = 0
+    max_depth = 0
+    running = 0
+    depth_counts = np.zeros(64, dtype=np.int64)
+    first = int(records["received"][0])
+    last_received = None
+    edges = np.logspace(0, 11, 111)
+    gap_counts = np.zeros(len(edges) - 1, dtype=np.int64)
+    bins = int((int(records["received"][-1]) - first) / (bin_seconds * 1E9)) + 1
+    delay_sum = np.zeros(bins)
+    delay_min = np.full(bins, np.inf)
+    delay_max = np.full(bins, -np.inf)
+    bin_counts = np.zeros(bins, dtype=np.int64)
+
+    for start in range(0, count, CHUNK):
+        chunk = records[start:start + CHUNK]
+        seq = chunk["seq"].astype(np.int64)
+        present[seq] = 1
+
+        # reorder depth - how far behind the highest sequence seen so far
+        highest = np.maximum.accumulate(np.concatenate(([running], seq)))[:-1]
+        running = max(running, int(seq.max()))
+        depth = highest - seq
+        late = depth > 0
+        reordered = reordered + int(late.sum())
+        if late.any():
+            max_depth = max(max_depth, int(depth.max()))
+            depth_counts = depth_counts + np.bincount(
+                np.minimum(np.log2(depth[late]).astype(np.int64), 63), minlength=64)
+
+        received = chunk["received"]
+        if last_received is None:
+            gaps = np.diff(received)
+        else:
+            gaps = np.diff(np.concatenate(([last_received], received)))
+        last_received = int(received[-1])
+        gap_counts = gap_counts + np.histogram(np.maximum(gaps, 1), bins=edges)[0]
+
+        delay = (received - chunk["sent"]) / 1E9
+        index = np.minimum(((received - first) / (bin_seconds * 1E9)).astype(np.int64), bins - 1)
+        delay_sum = delay_sum + np.bincount(index, weights=delay, minlength=bins)
+        bin_counts = bin_counts + np.bincount(index, minlength=bins)
+        np.minimum.at(delay_min, index, delay)
+        np.maximum.at(delay_max, index, delay)
+
+    # loss bursts are runs of missing sequence numbers, they start at 1
+    missing = np.concatenate(([0], 1 - present[1:], [0])).astype(np.int8)
+    edges_missing = np.diff(missing)
+    bursts = np.flatnonzero(edges_missing == -1) - np.flatnonzero(edges_missing == 1)
+    result["lost"] = int(bursts.sum())
+    result["loss_bursts"] = {"count": len(bursts),
+                             "max": int(bursts.max()) if len(bursts) > 0 else 0,
+                             "mean": float(bursts.mean()) if len(bursts) > 0 else 0.0,
+                             "lengths": {str(length): int(number) for (length, number) in
+                                         zip(*np.unique(bursts, return_counts=True))}}
+    result["reorder"] = {"packets": reordered,
+                         "max_depth": max_depth,
+                         "depth_log2": {str(1 << index): int(depth_counts[index])
+                                        for index in np.flatnonzero(depth_counts)}}
+    result["inter_arrival_ns"] = log_histogram_percentiles(gap_counts, edges, [50, 90, 99, 99.9])
+    used = np.flatnonzero(bin_counts)
+    result["delay"] = {"bin_seconds": bin_seconds,
+                       "start": [float(index * bin_seconds) for index in used],
+                       "mean": [float(delay_sum[index] / bin_counts[index]) for index in used],
+                       "min": [float(delay_min[index]) for index in used],
+                       "max": [float(delay_max[index]) for index in used]}
+    return result
+
+def main():
+    '''Analyze pyiperf UDP packet traces'''
+
+    aparser = ArgumentParser(description=main.__doc__)
+    aparser.add_argument(
+        'files',
+        help='trace files, one per stream',
+        nargs='+')
+
+    aparser.add_argument(
+        '--bin',
+        help='seconds per bin for delay over time, default 1',
+        type=float,
+        default=DEFAULT_BIN)
+
+    args = vars(aparser.parse_args())
+    for path in args["files"]:
+        print(json.dumps(analyze(path, args["bin"])))
+
+if __name__ == "__main__":
+    main()
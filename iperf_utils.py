@@ -13,6 +13,8 @@ import json
 import random
 import struct
 import re
+import sys
+import sysconfig
 
 RNDCHARS = "abcdefghijklmnopqrstuvwxyz234567"
 COOKIE_SIZE = 37
@@ -20,6 +22,16 @@ JSONL = "!i"
 
 BWIDTH_RE = re.compile(r"(\d+)([K,k,M,m,G,g])")
 
+def free_threaded():
+    '''Running on a free-threaded CPython with the GIL off, stream
+    threads then run on all cores at once instead of taking turns
+    '''
+    if not sysconfig.get_config_var("Py_GIL_DISABLED"):
+        return False
+    # an extension module which needs the GIL can turn it back on
+    #pylint: disable=protected-access
+    return not sys._is_gil_enabled()
+
 def bandwidth(arg):
     '''Translate bandwidth prefix'''
     ret = arg
@@ -48,22 +60,33 @@ def json_send(sock, data):
     '''Send JSON data'''
     buff = json.dumps(data).encode("ascii", "ignore")
     try:
-        if sock.send(struct.pack(JSONL, len(buff))) < 4 or sock.send(buff) < len(buff):
-            return False
+        sock.sendall(struct.pack(JSONL, len(buff)) + buff)
     except OSError:
         return False
     return True
 
 
+def recv_exact(sock, length):
+    '''Receive exactly length bytes, None if the peer closes first'''
+    buff = bytearray()
+    while len(buff) < length:
+        data = sock.recv(length - len(buff))
+        if len(data) == 0:
+            return None
+        buff.extend(data)
+    return bytes(buff)
+
 def json_recv(sock):
-    '''Receive JSON data'''
+    '''Receive JSON data, results of many streams span many reads'''
     try:
-        buff = sock.recv(4)
-        if len(buff) < 4:
+        buff = recv_exact(sock, 4)
+        if buff is None:
             return None
-        length = struct.unpack(JSONL, buff)[0]
-        return json.loads(sock.recv(length))
-    except OSError:
+        buff = recv_exact(sock, struct.unpack(JSONL, buff)[0])
+        if buff is None:
+            return None
+        return json.loads(buff)
+    except (OSError, ValueError):
         pass
     return None
 
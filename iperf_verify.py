@@ -0,0 +1,115 @@
+#!/usr/bin/python3
+'''Iperf payload integrity verification'''
+
+# pyiperf, Copyright (c) 2023 RedHat Inc
+# pyiperf, Copyright (c) 2023 Cambridge Greys Ltd
+
+# This source code is licensed under both the BSD-style license (found in the
+# LICENSE file in the root directory of this source tree) and the GPLv2 (found
+# in the COPYING file in the root directory of this source tree).
+# You may select, at your option, one of the above-listed licenses.
+
+import random
+import struct
+
+# Datagram n of a flow carries the pattern starting at (n % SLOTS) * STRIDE,
+# a byte stream carries the pattern repeated every PERIOD bytes
+SLOTS = 16
+STRIDE = 4093
+PERIOD = SLOTS * STRIDE
+# iperf2 style repeating payload
+REPEATING = b"0123456789"
+# the UDP header is never verified, it is the same size for 32 and 64 bit counters
+HEADER_SIZE = 12
+SEQUENCE = struct.Struct("!i")
+SEQUENCE_OFFSET = 8
+
+def make_pattern(params, size):
+    '''Seeded random or repeating pattern both ends derive from params.
+    Byte i is the same whatever the size, so ends with different buffer
+    sizes agree.
+    '''
+    if params.get("repeating_payload"):
+        base = (REPEATING * (PERIOD // len(REPEATING) + 1))[:PERIOD]
+    else:
+        base = random.Random(params.get("verify_seed", 0)).randbytes(PERIOD)
+    return (base * (size // len(base) + 1))[:size]
+
+class Payload():
+    '''Known payload of one stream. The sender takes its buffers from
+    here, the receiver compares what arrives against the pattern without
+    copying it. Only every sample-th datagram or read is checked.
+    '''
+    def __init__(self, params, size):
+        self.size = size
+        self.pattern = make_pattern(params, PERIOD + size)
+        self.view = memoryview(self.pattern)
+        self.sample = max(params.get("verify_sample") or 1, 1)
+        self.slots = None
+        # position in the stream modulo PERIOD, kept across tests on warm streams
+        self.position = 0
+        self.reads = 0
+        self.reset()
+
+    def reset(self):
+        '''Zero the counts for a new test'''
+        self.checked_packets = 0
+        self.checked_bytes = 0
+        self.corrupt_packets = 0
+        self.corrupt_bytes = 0
+
+    def datagram(self, sequence):
+        '''Preassembled datagram for a sequence number, the caller packs
+        the header into it
+        '''
+        if self.slots is None:
+            self.slots = [bytearray(self.view[slot * STRIDE:slot * STRIDE + self.size])
+                          for slot in range(SLOTS)]
+        return self.slots[sequence % SLOTS]
+
+    def chunk(self, length):
+        '''Next bytes of a stream to send'''
+        return self.view[self.position:self.position + min(length, self.size)]
+
+    def sent(self, length):
+        '''Advance the stream past bytes which went out'''
+        self.position = (self.position + length) % PERIOD
+
+    def compare(self, data, offset):
+        '''Compare received bytes with the pattern at offset'''
+        self.checked_packets = self.checked_packets + 1
+        self.checked_bytes = self.checked_bytes + len(data)
+        if self.pattern.startswith(data, offset):
+            return
+        self.corrupt_packets = self.corrupt_packets + 1
+        expected = self.view[offset:offset + len(data)]
+        self.corrupt_bytes = self.corrupt_bytes + \
+            sum(1 for (got, want) in zip(data, expected) if got != want) + \
+            max(len(data) - len(expected), 0)
+
+    def check_datagram(self, buff):
+        '''Verify the payload of a datagram, keyed by its sequence number'''
+        if len(buff) <= HEADER_SIZE:
+            return
+        sequence = SEQUENCE.unpack_from(buff, SEQUENCE_OFFSET)[0]
+        if sequence % self.sample != 0:
+            return
+        offset = (sequence % SLOTS) * STRIDE + HEADER_SIZE
+        self.compare(memoryview(buff)[HEADER_SIZE:self.size], offset)
+
+    def check_stream(self, data):
+        '''Verify the next bytes of a stream'''
+        offset = self.position
+        self.position = (self.position + len(data)) % PERIOD
+        self.reads = self.reads + 1
+        if self.reads % self.sample != 0:
+            return
+        # reads are never longer than size, the pattern extends past PERIOD by as much
+        self.compare(data, offset)
+
+    def results(self):
+        '''Verification counts for the results'''
+        return {"verify": {"checked_packets": self.checked_packets,
+                           "checked_bytes": self.checked_bytes,
+                           "corrupt_packets": self.corrupt_packets,
+                           "corrupt_bytes": self.corrupt_bytes}}
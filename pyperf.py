@@ -16,6 +16,13 @@ import json
 import sys
 from iperf_control import TestClient
 from iperf_control_server import TestServer
+from iperf_session import SessionClient
+from iperf_search import RateSearchClient
+from iperf_stable import StableClient, METRICS
+from iperf_multicast import MulticastTest, is_multicast, is_multicast6, serve
+from iperf_utils import bandwidth
+from iperf_rr import SEQ
+from iperf_metrics import ServerMetrics, MetricsServer
 
 DEFAULT_CONFIG = "config-stock.json"
 DEFAULT_PARAMS = "params.json"
@@ -23,12 +30,12 @@ NOT_SUPPORTED = "Not yet supported, use stock iperf3"
 
 UNSUPPORTED = [
     'format', 'pidfile', 'file', 'affinity', 'bind', 'bind_dev',
-    'logfile', 'forceflush', 'timestamps', 'daemon', 'one_off', 'server_bitrate_limit',
+    'timestamps', 'daemon', 'one_off', 'server_bitrate_limit',
     'idle_timeout', 'rsa_private_key_path', 'authorized_users_path', 'time_skew_threshold',
     'pacing_timer', 'fq_rate', 'bytes', 'blockcount', 'length', 'congestion',
     'no_delay', 'version4', 'version6', 'tos', 'dscp', 'flowlabel', 'zerocopy',
     'omit', 'title', 'extra_data', 'get_server_output', 'udp_counters_64bit',
-    'repeating_payload', 'dont_fragment', 'username', 'rsa_public_key_path'
+    'dont_fragment', 'username', 'rsa_public_key_path'
 ]
 
 def main():
@@ -99,9 +106,14 @@ def main():
         help='output in json format',
         action='store_true')
 
+    aparser.add_argument(
+        '--json-stream',
+        help='output in line-delimited json format, one event per line',
+        action='store_true')
+
     aparser.add_argument(
         '--logfile',
-        help='send output to a log file',
+        help='send JSON output (-J or --json-stream) to a log file',
         type=str)
 
     aparser.add_argument(
@@ -326,7 +338,7 @@ def main():
 
     aparser.add_argument(
         '--repeating-payload',
-        help='use repeating pattern in payload instead of randomized payload (like iperf2)',
+        help='--verify: use repeating pattern in payload instead of randomized payload (like iperf2)',
         action='store_true')
 
     aparser.add_argument(
@@ -349,6 +361,187 @@ def main():
         help='path to plugin to invoke',
         type=str)
 
+    aparser.add_argument(
+        '--session',
+        help='run the list of tests in json file <session> over one connection, results as json lines',
+        type=str)
+
+    aparser.add_argument(
+        '--instrument',
+        help='count loop iterations, syscalls, EAGAIN, rate limiting and stalls for each stream',
+        action='store_true')
+
+    aparser.add_argument(
+        '--netstat',
+        help='report UDP/TCP error, interface and network softirq counter changes on both hosts',
+        action='store_true')
+
+    aparser.add_argument(
+        '--soak',
+        help='long tests: report 10s and 1min rollups of each stream instead of every interval',
+        action='store_true')
+
+    aparser.add_argument(
+        '--trace',
+        help='UDP receiver: record every packet to <trace>.<stream id>, analyze with iperf_trace.py',
+        type=str)
+
+    aparser.add_argument(
+        '--trace-records',
+        help='UDP receiver: packets per trace file, default 1048576',
+        type=int)
+
+    aparser.add_argument(
+        '--rr',
+        help='request/response test, report transactions/s and round trip times',
+        action='store_true')
+
+    aparser.add_argument(
+        '--request-size',
+        help='request/response: request size in bytes, default 1, UDP 8 at least',
+        type=int)
+
+    aparser.add_argument(
+        '--response-size',
+        help='request/response: response size in bytes, default 1, UDP 8 at least',
+        type=int)
+
+    aparser.add_argument(
+        '--crr',
+        help='TCP connection rate test, connect, request, response and close per transaction',
+        action='store_true')
+
+    aparser.add_argument(
+        '--crr-listeners',
+        help='server: SO_REUSEPORT listeners answering connection rate tests, default 1',
+        type=int)
+
+    aparser.add_argument(
+        '--sink',
+        help='discard received data with MSG_TRUNC instead of copying it, Linux only',
+        action='store_true')
+
+    aparser.add_argument(
+        '--join',
+        help='server: receive UDP multicast tests sent to this group instead of serving unicast tests',
+        type=str)
+
+    aparser.add_argument(
+        '--receivers',
+        help='multicast client: number of receivers to run in this process, default 0',
+        type=int,
+        default=0)
+
+    aparser.add_argument(
+        '--ttl',
+        help='multicast client: time to live of the datagrams, default 1',
+        type=int)
+
+    aparser.add_argument(
+        '--multicast-interface',
+        help='address of the interface to send or receive multicast on',
+        type=str)
+
+    aparser.add_argument(
+        '--verify',
+        help='fill payloads with a known pattern and count corrupted packets and bytes on receive',
+        action='store_true')
+
+    aparser.add_argument(
+        '--verify-seed',
+        help='--verify: seed of the random payload pattern, default 0',
+        type=int,
+        default=0)
+
+    aparser.add_argument(
+        '--verify-sample',
+        help='--verify: check one in N packets or reads, default 1',
+        type=int,
+        default=1)
+
+    aparser.add_argument(
+        '--local',
+        help='local transport for the data streams: UNIX stream or seqpacket sockets, '
+             'or socketpairs when client and server share a process (not available from the command line)',
+        choices=["stream", "seqpacket", "socketpair"])
+
+    aparser.add_argument(
+        '--unix-path',
+        help='local transport: path of the UNIX socket, default pyiperf-<port>.sock in the temp directory',
+        type=str)
+
+    aparser.add_argument(
+        '--backend',
+        help='client data path: socket, or packet for AF_PACKET memory mapped rings (UDP only)',
+        choices=["socket", "packet"])
+
+    aparser.add_argument(
+        '--packet-interface',
+        help='packet backend: interface to use, default the one holding the local address',
+        type=str)
+
+    aparser.add_argument(
+        '--packet-blocks',
+        help='packet backend: ring size in 1MB blocks, default 8',
+        type=int)
+
+    aparser.add_argument(
+        '--metrics-port',
+        help='server: expose OpenMetrics on http://127.0.0.1:<port>/metrics',
+        type=int)
+
+    aparser.add_argument(
+        '--rate-search',
+        help='search for the highest UDP rate with loss within --loss-tolerance',
+        action='store_true')
+
+    aparser.add_argument(
+        '--loss-tolerance',
+        help='loss tolerance for --rate-search in percent, default 0',
+        type=float,
+        default=0.0)
+
+    aparser.add_argument(
+        '--trial-time',
+        help='duration of each --rate-search trial in seconds, default 1',
+        type=float,
+        default=1.0)
+
+    aparser.add_argument(
+        '--stable',
+        help='repeat the test until the confidence interval of --stable-metric is narrow enough',
+        action='store_true')
+
+    aparser.add_argument(
+        '--stable-metric',
+        help='--stable: metric to converge, default throughput',
+        choices=METRICS,
+        default="throughput")
+
+    aparser.add_argument(
+        '--stable-width',
+        help='--stable: confidence interval half width in percent of the mean, default 2',
+        type=float,
+        default=2.0)
+
+    aparser.add_argument(
+        '--stable-warmup',
+        help='--stable: warm-up runs to discard, default 1',
+        type=int,
+        default=1)
+
+    aparser.add_argument(
+        '--stable-runs',
+        help='--stable: maximum number of runs including warm-up, default 20',
+        type=int,
+        default=20)
+
+    aparser.add_argument(
+        '--confidence',
+        help='--stable: confidence level in percent, default 95',
+        type=float,
+        default=95.0)
+
     args = vars(aparser.parse_args())
 
     for unsupported in UNSUPPORTED:
@@ -384,6 +577,10 @@ def main():
             except KeyError:
                 pass
 
+    if args.get("logfile") is not None and not (args.get("json") or args.get("json_stream")):
+        print("--logfile applies only to JSON output, add -J or --json-stream")
+        sys.exit(1)
+
     if args.get("client") is not None and args.get("server"):
         print("You cannot select server and client mode at the same time")
         sys.exit(1)
@@ -392,14 +589,68 @@ def main():
         params["udp"] = 1
         del params["tcp"]
 
+    if args.get("local") is not None and (args.get("udp") or args.get("rr") or args.get("crr")):
+        print("Local transports support only stream throughput tests")
+        sys.exit(1)
+
+    if args.get("local") == "socketpair":
+        print("Socketpair streams need client and server in the same process, use stream or seqpacket")
+        sys.exit(1)
+
+    if args.get("udp") and args.get("rr") and \
+       min(args.get("request_size") or SEQ.size, args.get("response_size") or SEQ.size) < SEQ.size:
+        print("UDP requests and responses carry an {} byte sequence number, use at least {} bytes".format(
+            SEQ.size, SEQ.size))
+        sys.exit(1)
+
+    if args.get("verify") and (args.get("sink") or args.get("rr") or args.get("crr") or
+                               args.get("backend") == "packet"):
+        print("Payload verification supports only throughput tests over sockets without --sink")
+        sys.exit(1)
+
+    if args.get("backend") == "packet" and not args.get("udp"):
+        print("The packet backend supports only UDP")
+        sys.exit(1)
+
+    if is_multicast6(args.get("client")) or is_multicast6(args.get("join")):
+        print("Multicast tests support only IPv4 groups")
+        sys.exit(1)
+
+    if is_multicast(args.get("client")) and not args.get("udp"):
+        print("Multicast tests are UDP only")
+        sys.exit(1)
+
     if args.get("client") is not None:
         config["target"] = args["client"]
-        client = TestClient(config, params)
+        if is_multicast(args["client"]):
+            client = MulticastTest(config, params, args["receivers"])
+        elif args.get("rate_search"):
+            max_rate = 0
+            if config.get("bitrate") is not None:
+                max_rate = bandwidth(config["bitrate"]) * 8
+            client = RateSearchClient(config, params, args["loss_tolerance"] / 100,
+                                      args["trial_time"], max_rate)
+        elif args.get("stable"):
+            client = StableClient(config, params, args["stable_metric"], args["stable_width"] / 100,
+                                  args["stable_warmup"], args["stable_runs"], args["confidence"] / 100)
+        elif args.get("session") is not None:
+            client = SessionClient(config, params, json.load(open(args["session"])))
+        else:
+            client = TestClient(config, params)
         client.run()
 
+    if args.get("server") and args.get("join") is not None:
+        serve(config, params, args["join"])
+        return 1
+
     if args.get("server"):
+        metrics = None
+        if args.get("metrics_port") is not None:
+            metrics = ServerMetrics()
+            MetricsServer(metrics, args["metrics_port"]).start()
         while True:
             server = TestServer(config, params)
+            server.metrics = metrics
             if not server.run():
                 break
 